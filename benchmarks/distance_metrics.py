@@ -0,0 +1,82 @@
+"""
+Throughput benchmark of the nearest-facility distance metrics.
+
+Times projection + nearest-neighbor query + km conversion for every metric
+in DISTANCE_METRICS, on random points spread over metropolitan France.
+
+Usage:
+    uv run python benchmarks/distance_metrics.py --communes 35000 --facilities 10000
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from src.utils import DISTANCE_METRICS, NEAREST_FACILITY_METHODS  # noqa: E402
+
+# Bounding box of metropolitan France (latitude, longitude)
+FRANCE_BOUNDS = ((41.3, 51.1), (-5.2, 9.6))
+
+
+def random_coordinates(count: int, rng: np.random.Generator) -> np.ndarray:
+    """Draw uniform (latitude, longitude) pairs inside FRANCE_BOUNDS."""
+    (lat_min, lat_max), (lon_min, lon_max) = FRANCE_BOUNDS
+    return np.column_stack(
+        [
+            rng.uniform(lat_min, lat_max, count),
+            rng.uniform(lon_min, lon_max, count),
+        ]
+    )
+
+
+def time_metric(
+    metric: str,
+    method: str,
+    communes: np.ndarray,
+    facilities: np.ndarray,
+    repeat: int,
+) -> float:
+    """Return the best wall time (seconds) over `repeat` runs."""
+    project, to_km = DISTANCE_METRICS[metric]
+    engine = NEAREST_FACILITY_METHODS[method]
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        to_km(engine(project(communes), project(facilities)))
+        timings.append(time.perf_counter() - start)
+
+    return min(timings)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--communes", type=int, default=35_000)
+    parser.add_argument("--facilities", type=int, default=10_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--methods", nargs="+", default=["kdtree", "blocked"], help="Engines to time"
+    )
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    communes = random_coordinates(args.communes, rng)
+    facilities = random_coordinates(args.facilities, rng)
+
+    print(f"{args.communes:,} communes × {args.facilities:,} facilities")
+    print(f"{'metric':<10} {'method':<12} {'seconds':>10} {'queries/s':>14}")
+    for method in args.methods:
+        for metric in DISTANCE_METRICS:
+            seconds = time_metric(metric, method, communes, facilities, args.repeat)
+            print(
+                f"{metric:<10} {method:<12} {seconds:>10.4f} "
+                f"{args.communes / seconds:>14,.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Index build and query time of the geolocated nearest-facility distances.
+
+Spreads `--points` random facilities over `--types` facility types in
+metropolitan France, then times build_facility_index and the nearest
+queries of `--communes` commune centres for every type.
+
+Usage:
+    uv run python benchmarks/facility_points.py --points 1000000 --communes 35000
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from benchmarks.distance_metrics import random_coordinates  # noqa: E402
+from src.facilities import (  # noqa: E402
+    build_facility_index,
+    calculate_nearest_point_distances,
+)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--points", type=int, default=1_000_000)
+    parser.add_argument("--communes", type=int, default=35_000)
+    parser.add_argument("--types", type=int, default=10)
+    parser.add_argument("--metric", default="haversine")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    facilities = [f"type_{i}" for i in range(args.types)]
+    coordinates = random_coordinates(args.points, rng)
+    facility_points = pl.DataFrame(
+        {
+            "facility": rng.choice(facilities, args.points),
+            "code_commune": np.zeros(args.points, dtype=int).astype(str),
+            "latitude": coordinates[:, 0],
+            "longitude": coordinates[:, 1],
+        }
+    )
+    centres = random_coordinates(args.communes, rng)
+    communes = pl.DataFrame(
+        {
+            "code_commune": np.arange(args.communes).astype(str),
+            "latitude": centres[:, 0],
+            "longitude": centres[:, 1],
+        }
+    )
+
+    start = time.perf_counter()
+    build_facility_index(facility_points, facilities, args.metric)
+    build_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    calculate_nearest_point_distances(
+        communes.lazy(), facility_points, facilities, args.metric
+    ).collect()
+    total_seconds = time.perf_counter() - start
+
+    print(
+        f"{args.points:,} facilities of {args.types} types, "
+        f"{args.communes:,} communes, {args.metric}"
+    )
+    print(f"index build:         {build_seconds:.3f}s")
+    print(f"build + all queries: {total_seconds:.3f}s")
+    print(
+        f"queries/s:           {args.communes * args.types / (total_seconds - build_seconds):,.0f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""
+Wall time and peak memory of every pipeline stage on synthetic data.
+
+Generates (or reuses) synthetic sources with benchmarks/synthetic_data.py,
+then runs the stages of the headless pipeline one by one: DVF ingest,
+transaction aggregation, yearly stats, pivot/growth, BPE pivot, distance
+computation and final join. Each stage is timed and its resident memory is
+sampled: the growth above the level it started from and the process peak.
+The run is appended to a JSON
+history together with the commit it measured, and compared with the last
+run of the same scale so regressions show up between commits.
+
+Usage:
+    uv run python benchmarks/pipeline_stages.py --communes 35000 --dvf-rows 30000000
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+import polars as pl
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from benchmarks.synthetic_data import generate_datasets  # noqa: E402
+from src import profiling, stages  # noqa: E402
+from src.cli import (  # noqa: E402
+    DEFAULT_DISTANCE_METRIC,
+    DEFAULT_FACILITY_TYPES,
+    DEFAULT_MAX_GROWTH_PERCENT,
+    DEFAULT_MIN_GROWTH_PERCENT,
+    DEFAULT_MIN_SALES,
+    DEFAULT_YEARS_BETWEEN,
+)
+from src.utils import convert_dvf_to_parquet, setup_data_directory  # noqa: E402
+
+# Kept with the generated data, out of the source tree
+DEFAULT_HISTORY_FILE = setup_data_directory() / "benchmark_history.json"
+
+
+def run_stages(
+    data_dir: Path, scale: dict[str, int], metric: str, engine: str
+) -> dict[str, dict]:
+    """
+    Run the pipeline stage by stage, without the stage cache.
+
+    Args:
+        data_dir: Synthetic data directory, generated if needed
+        scale: communes, dvf_rows and seed of the synthetic data
+        metric: Distance metric, one of DISTANCE_METRICS
+        engine: Polars engine collecting the DVF stages
+
+    Returns:
+        Wall and CPU seconds, peak RSS above the stage start
+        (rss_delta_mb), peak RSS of the process (peak_rss_mb) and output
+        rows, by stage in run order
+    """
+    dvf_gz_path, (bpe_data_file, bpe_metadata_file), communes_path = generate_datasets(
+        data_dir, **scale
+    )
+    # Ingest is measured from scratch on every run
+    shutil.rmtree(data_dir / "dvf_parquet", ignore_errors=True)
+
+    # Only the stage blocks below are recorded, not the traced calls inside
+    profiling.enable(functions=False)
+    try:
+        with profiling.span("ingest") as record:
+            dvf_parquet_dir = convert_dvf_to_parquet(
+                dvf_gz_path, data_dir / "dvf_parquet"
+            )
+            record["rows_out"] = (
+                stages.dvf_partitions(dvf_parquet_dir).select(pl.len()).collect().item()
+            )
+
+        with profiling.span("transaction_aggregation") as record:
+            by_transaction = stages.dvf_by_transaction(
+                stages.dvf_raw_sales(dvf_parquet_dir)
+            ).collect(engine=engine)
+            record["rows_out"] = len(by_transaction)
+
+        with profiling.span("yearly_stats") as record:
+            complete_years = stages.dvf_complete_years(
+                stages.dvf_commune_yearly_stats(
+                    stages.dvf_price_per_sqm(by_transaction.lazy()), DEFAULT_MIN_SALES
+                )
+            ).collect(engine=engine)
+            record["rows_out"] = len(complete_years)
+
+        with profiling.span("pivot_growth") as record:
+            dvf_final = stages.dvf_final(
+                complete_years,
+                DEFAULT_MIN_GROWTH_PERCENT,
+                DEFAULT_MAX_GROWTH_PERCENT,
+                DEFAULT_YEARS_BETWEEN,
+            )
+            record["rows_out"] = len(dvf_final)
+
+        with profiling.span("bpe_pivot") as record:
+            label_mapping = stages.facility_label_mapping(
+                bpe_metadata_file, DEFAULT_FACILITY_TYPES
+            )
+            bpe_by_commune = stages.bpe_by_commune(
+                stages.bpe_raw_facilities(bpe_data_file, DEFAULT_FACILITY_TYPES),
+                label_mapping,
+            )
+            record["rows_out"] = len(bpe_by_commune)
+
+        with profiling.span("distances") as record:
+            bpe_with_distances = stages.bpe_with_distances(
+                bpe_by_commune, communes_path, list(label_mapping.values()), metric
+            ).collect()
+            record["rows_out"] = len(bpe_with_distances)
+
+        with profiling.span("final_join") as record:
+            final_dataset = stages.final_dataset(
+                dvf_final, bpe_with_distances.lazy()
+            ).collect()
+            record["rows_out"] = len(final_dataset)
+    finally:
+        records = profiling.disable()
+
+    return {
+        record["name"]: {
+            "seconds": round(record["wall_seconds"], 4),
+            "cpu_seconds": round(record["cpu_seconds"], 4),
+            "rss_delta_mb": round(record["rss_delta_mb"], 1),
+            "peak_rss_mb": round(record["rss_peak_mb"], 1),
+            "rows": record["rows_out"],
+        }
+        for record in records
+        if record["kind"] == "span"
+    }
+
+
+def git_revision() -> str | None:
+    """Commit of the working tree, suffixed with -dirty if it has changes."""
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty", "--exclude", "*"],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def append_history(history_file: Path, entry: dict) -> dict | None:
+    """Append a run to the history, return the previous run of the same scale."""
+    history = json.loads(history_file.read_text()) if history_file.exists() else []
+    previous = next(
+        (
+            run
+            for run in reversed(history)
+            if all(run[key] == entry[key] for key in ("scale", "metric", "engine"))
+        ),
+        None,
+    )
+    history.append(entry)
+    history_file.write_text(json.dumps(history, indent=2) + "\n")
+    return previous
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--communes", type=int, default=35_000)
+    parser.add_argument("--dvf-rows", type=int, default=1_000_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--metric", default=DEFAULT_DISTANCE_METRIC, help="Distance metric"
+    )
+    parser.add_argument(
+        "--engine", default="streaming", help="Polars engine of the DVF stages"
+    )
+    parser.add_argument(
+        "--data-dir",
+        type=Path,
+        default=None,
+        help="Synthetic data directory (default: data/synthetic/COMMUNES_DVF-ROWS)",
+    )
+    parser.add_argument(
+        "--history",
+        type=Path,
+        default=DEFAULT_HISTORY_FILE,
+        help="JSON history the run is appended to (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    scale = {"communes": args.communes, "dvf_rows": args.dvf_rows, "seed": args.seed}
+    data_dir = args.data_dir or (
+        setup_data_directory() / "synthetic" / f"{args.communes}_{args.dvf_rows}"
+    )
+
+    results = run_stages(data_dir, scale, args.metric, args.engine)
+
+    entry = {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "polars": pl.__version__,
+        "cpus": os.cpu_count(),
+        "scale": scale,
+        "metric": args.metric,
+        "engine": args.engine,
+        "stages": results,
+        "total_seconds": round(sum(r["seconds"] for r in results.values()), 4),
+    }
+    previous = append_history(args.history, entry)
+
+    print(
+        f"\n{args.communes:,} communes × {args.dvf_rows:,} DVF rows ({entry['revision']})"
+    )
+    print(
+        f"{'stage':<24} {'seconds':>9} {'+MB':>9} {'peak MB':>9} {'rows':>12} "
+        f"{'vs last':>9}"
+    )
+    for stage, result in results.items():
+        change = ""
+        if previous and stage in previous["stages"]:
+            before = previous["stages"][stage]["seconds"]
+            change = f"{(result['seconds'] / before - 1) * 100:+.0f}%" if before else ""
+        print(
+            f"{stage:<24} {result['seconds']:>9.3f} {result['rss_delta_mb']:>9.1f} "
+            f"{result['peak_rss_mb']:>9.1f} {result['rows']:>12,} {change:>9}"
+        )
+    print(f"{'total':<24} {entry['total_seconds']:>9.3f}")
+    if previous:
+        print(f"Compared with {previous['revision']} ({previous['timestamp']})")
+    print(f"Appended to {args.history}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Accuracy and speed of sketch-backed commune medians against the exact path.
+
+Draws log-normal prices per (commune, year), then compares the exact
+group_by median with price_sketches + sketch_stats for several relative
+accuracies: wall time, worst and mean relative error of the median and the
+90th percentile, and Parquet size of the sketches. Sketches are also built on
+`--shards` separate batches and merged, which must give the same result.
+
+Usage:
+    uv run python benchmarks/quantile_sketches.py --rows 3000000 --communes 35000
+"""
+
+import argparse
+import io
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from src.sketches import merge_sketches, price_sketches, sketch_stats  # noqa: E402
+
+QUANTILES = {"median_prix_m2": 0.5, "p90_prix_m2": 0.9}
+
+
+def random_prices(rows: int, communes: int, rng: np.random.Generator) -> pl.DataFrame:
+    """One row per transaction, with a price level drawn per commune."""
+    commune = rng.integers(0, communes, rows)
+    level = rng.normal(8.0, 0.6, communes)[commune]
+    return pl.DataFrame(
+        {
+            "id_mutation": np.arange(rows).astype(str),
+            "code_commune": commune.astype(str),
+            "year": rng.choice([2021, 2024], rows).astype(np.int32),
+            "prix_m2": rng.lognormal(level, 0.5),
+        }
+    )
+
+
+def timed(function):
+    """Return (result, seconds) of a zero-argument callable."""
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+def parquet_bytes(frame: pl.DataFrame) -> int:
+    buffer = io.BytesIO()
+    frame.write_parquet(buffer)
+    return buffer.tell()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=3_000_000)
+    parser.add_argument("--communes", type=int, default=35_000)
+    parser.add_argument("--shards", type=int, default=4)
+    parser.add_argument(
+        "--accuracies", nargs="+", type=float, default=[0.01, 0.005, 0.001]
+    )
+    args = parser.parse_args()
+
+    prices = random_prices(args.rows, args.communes, np.random.default_rng(0))
+    keys = ["code_commune", "year"]
+
+    exact, exact_seconds = timed(
+        lambda: (
+            prices.lazy()
+            .group_by(keys)
+            .agg(
+                pl.col("prix_m2").median().alias("median_prix_m2"),
+                pl.col("prix_m2")
+                .quantile(0.9, interpolation="linear")
+                .alias("p90_prix_m2"),
+            )
+            .collect()
+        )
+    )
+    print(f"{args.rows:,} prices, {exact.height:,} (commune, year) groups")
+    print(f"exact: {exact_seconds:.3f}s, raw prices {parquet_bytes(prices):,} bytes")
+    print(
+        f"{'accuracy':>9} {'build s':>8} {'query s':>8} {'sketch bytes':>13} "
+        f"{'median max':>11} {'median mean':>12} {'p90 max':>9} {'merged ok':>10}"
+    )
+
+    for accuracy in args.accuracies:
+        sketches, build_seconds = timed(
+            lambda: price_sketches(prices.lazy(), accuracy).collect()
+        )
+        stats, query_seconds = timed(
+            lambda: sketch_stats(sketches.lazy(), accuracy, QUANTILES).collect()
+        )
+
+        shards = [
+            price_sketches(shard.lazy(), accuracy)
+            for shard in prices.sample(fraction=1.0, shuffle=True, seed=1).iter_slices(
+                -(-args.rows // args.shards)
+            )
+        ]
+        merged = sketch_stats(merge_sketches(*shards), accuracy, QUANTILES).collect()
+        merged_ok = (
+            merged.sort(keys)
+            .select(list(QUANTILES))
+            .equals(stats.sort(keys).select(list(QUANTILES)))
+        )
+
+        errors = exact.join(stats, on=keys, suffix="_sketch").select(
+            [
+                ((pl.col(name) - pl.col(f"{name}_sketch")) / pl.col(name))
+                .abs()
+                .alias(name)
+                for name in QUANTILES
+            ]
+        )
+        print(
+            f"{accuracy:>9} {build_seconds:>8.3f} {query_seconds:>8.3f} "
+            f"{parquet_bytes(sketches):>13,} "
+            f"{errors['median_prix_m2'].max():>11.5f} "
+            f"{errors['median_prix_m2'].mean():>12.5f} "
+            f"{errors['p90_prix_m2'].max():>9.5f} {merged_ok!s:>10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
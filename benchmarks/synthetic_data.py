@@ -0,0 +1,311 @@
+"""
+Synthetic DVF, BPE and communes datasets shaped like the real downloads.
+
+Writes the three sources with the file names, columns and formats the
+pipeline expects (dvf.csv.gz, bpe/DS_BPE_2024_data.csv and its metadata,
+communes.csv.gz), at any scale, so stages can be benchmarked without the
+4 GB download. DVF rows are ordered by year then department like the
+published file. Prices follow a log-normal level per commune with a yearly
+trend, mutations hold one to three lots, and a share of the rows is meant to
+be filtered out (exchanges, overseas communes, lots without built surface).
+
+Generation is deterministic for a given seed and skipped when the data
+directory already holds the same scale.
+
+Usage:
+    uv run python benchmarks/synthetic_data.py --communes 35000 --dvf-rows 30000000
+"""
+
+import argparse
+import gzip
+import json
+import sys
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from src.cli import DEFAULT_FACILITY_TYPES  # noqa: E402
+from src.utils import setup_data_directory  # noqa: E402
+
+SYNTHETIC_PARAMS_FILE = "_synthetic.json"
+# Bumped whenever the generated files change, older data is regenerated
+SYNTHETIC_VERSION = 2
+DVF_CHUNK_ROWS = 1_000_000
+DVF_YEARS = range(2019, 2025)
+
+# Metropolitan departments, plus two overseas ones the pipeline filters out
+DEPARTMENTS = [f"{number:02d}" for number in range(1, 96) if number != 20] + [
+    "2A",
+    "2B",
+    "971",
+    "974",
+]
+
+# Extra facility types present in the file but not selected by default
+OTHER_FACILITY_TYPES = ["A101", "B316", "F303"]
+
+
+def commune_codes(count: int) -> np.ndarray:
+    """INSEE-like commune codes, spread round-robin over DEPARTMENTS."""
+    index = np.arange(count)
+    departments = np.array(DEPARTMENTS)[index % len(DEPARTMENTS)]
+    numbers = index // len(DEPARTMENTS) + 1
+    return np.array(
+        [
+            department + str(number).zfill(5 - len(department))
+            for department, number in zip(departments, numbers, strict=True)
+        ]
+    )
+
+
+def generate_communes(
+    communes_path: Path, codes: np.ndarray, rng: np.random.Generator
+) -> np.ndarray:
+    """
+    Communes file with a centre inside metropolitan France, a few missing.
+
+    Returns:
+        (latitude, longitude) of every commune centre, shape (len(codes), 2)
+    """
+    centres = np.column_stack(
+        [rng.uniform(42.5, 50.9, len(codes)), rng.uniform(-4.5, 7.8, len(codes))]
+    )
+    latitude = centres[:, 0].copy()
+    latitude[rng.random(len(codes)) < 0.001] = np.nan
+    frame = pl.DataFrame(
+        {
+            "code_insee": codes,
+            "nom_standard": np.char.add("Commune ", codes),
+            "latitude_centre": latitude,
+            "longitude_centre": centres[:, 1],
+        }
+    ).with_columns(pl.col("latitude_centre").fill_nan(None))
+
+    with gzip.open(communes_path, "wb") as output:
+        frame.write_csv(output)
+
+    return centres
+
+
+def _dvf_chunk(
+    codes: np.ndarray,
+    centres: np.ndarray,
+    price_levels: np.ndarray,
+    year: int,
+    rows: int,
+    first_mutation: int,
+    rng: np.random.Generator,
+) -> pl.DataFrame:
+    """
+    One chunk of DVF lots of a year, mutations never straddle two chunks.
+
+    Like the published file (one file per year and department, concatenated)
+    the lots are ordered by department, so each chunk adds one row group per
+    partition at ingest instead of many tiny ones. Mutations are geocoded
+    within a few km of their commune centre.
+    """
+    new_mutation = rng.random(rows) < 0.6
+    new_mutation[0] = True
+    lot_mutation = np.cumsum(new_mutation) - 1
+    mutations = lot_mutation[-1] + 1
+
+    by_code = np.argsort(codes)
+    commune = by_code[np.sort(rng.integers(0, len(codes), mutations))]
+    first_day = np.datetime64(f"{year}-01-01")
+    dates = first_day + rng.integers(0, 365, mutations)
+    # +3 %/year on top of the commune level
+    trend = 1 + 0.03 * (year - DVF_YEARS[0] + (dates - first_day).astype(int) / 365)
+    surface = rng.choice([35.0, 50.0, 70.0, 90.0, 120.0], mutations)
+    value = np.round(rng.lognormal(price_levels[commune], 0.4) * trend * surface, 2)
+    value[rng.random(mutations) < 0.01] = np.nan
+    # About 2 km around the centre, a few mutations are not geocoded
+    location = centres[commune] + rng.normal(0, 0.02, (mutations, 2))
+    location[rng.random(mutations) < 0.01] = np.nan
+
+    type_local = rng.choice([1, 2, 3, 4, 0], rows, p=[0.35, 0.35, 0.15, 0.05, 0.1])
+    lot_surface = np.where(
+        np.isin(type_local, [1, 2]),
+        surface[lot_mutation] * rng.uniform(0.8, 1.2, rows),
+        np.nan,
+    ).round()
+
+    return pl.DataFrame(
+        {
+            "id_mutation": np.char.add(
+                f"{year}-", (first_mutation + lot_mutation).astype(str)
+            ),
+            "date_mutation": dates[lot_mutation],
+            "nature_mutation": rng.choice(
+                ["Vente", "Echange", "Adjudication"], mutations, p=[0.94, 0.04, 0.02]
+            )[lot_mutation],
+            "valeur_fonciere": value[lot_mutation],
+            "code_commune": codes[commune][lot_mutation],
+            "code_type_local": type_local,
+            "surface_reelle_bati": lot_surface,
+            "longitude": location[lot_mutation, 1],
+            "latitude": location[lot_mutation, 0],
+        }
+    ).with_columns(
+        pl.col("code_commune")
+        .str.slice(0, 2)
+        .replace({"97": None})
+        .fill_null(pl.col("code_commune").str.slice(0, 3))
+        .alias("code_departement"),
+        pl.col("valeur_fonciere").fill_nan(None),
+        pl.col("code_type_local").replace(0, None),
+        pl.col(["surface_reelle_bati", "longitude", "latitude"]).fill_nan(None),
+    )
+
+
+def generate_dvf(
+    dvf_path: Path,
+    codes: np.ndarray,
+    centres: np.ndarray,
+    rows: int,
+    rng: np.random.Generator,
+) -> None:
+    """DVF lots as a gzipped CSV, written chunk by chunk in bounded memory."""
+    price_levels = rng.normal(7.6, 0.5, len(codes))
+
+    header = True
+    with gzip.open(dvf_path, "wb", compresslevel=1) as output:
+        for index, year in enumerate(DVF_YEARS):
+            # Rows split evenly across years, the first ones take the remainder
+            year_rows = rows // len(DVF_YEARS) + (index < rows % len(DVF_YEARS))
+            first_mutation = 0
+            for start in range(0, year_rows, DVF_CHUNK_ROWS):
+                chunk = _dvf_chunk(
+                    codes,
+                    centres,
+                    price_levels,
+                    year,
+                    min(DVF_CHUNK_ROWS, year_rows - start),
+                    first_mutation,
+                    rng,
+                )
+                chunk.write_csv(output, include_header=header)
+                header = False
+                first_mutation += chunk["id_mutation"].n_unique()
+
+
+def generate_bpe(
+    bpe_dir: Path, codes: np.ndarray, rng: np.random.Generator
+) -> tuple[Path, Path]:
+    """BPE data and metadata files, as extracted from the INSEE archive."""
+    facility_types = DEFAULT_FACILITY_TYPES + OTHER_FACILITY_TYPES
+    # Share of communes holding each type, from everywhere to rare
+    presence = np.linspace(0.9, 0.05, len(facility_types))
+
+    commune = np.repeat(np.arange(len(codes)), len(facility_types))
+    facility = np.tile(np.arange(len(facility_types)), len(codes))
+    kept = rng.random(len(commune)) < presence[facility]
+
+    facilities = pl.DataFrame(
+        {
+            "GEO": codes[commune[kept]],
+            "GEO_OBJECT": "COM",
+            "FACILITY_TYPE": np.array(facility_types)[facility[kept]],
+            "OBS_VALUE": rng.geometric(0.5, kept.sum()),
+            "TIME_PERIOD": 2024,
+        }
+    )
+    # Department totals, excluded by the GEO_OBJECT filter
+    departments = (
+        facilities.group_by(pl.col("GEO").str.slice(0, 2), "FACILITY_TYPE")
+        .agg(pl.col("OBS_VALUE").sum())
+        .with_columns(GEO_OBJECT=pl.lit("DEP"), TIME_PERIOD=pl.lit(2024))
+        .select(facilities.columns)
+    )
+
+    metadata = pl.DataFrame(
+        {
+            "COD_VAR": ["FACILITY_TYPE"] * len(facility_types) + ["GEO_OBJECT"] * 2,
+            "LIB_VAR": ["Type d'équipement"] * len(facility_types) + ["Niveau"] * 2,
+            "COD_MOD": facility_types + ["COM", "DEP"],
+            "LIB_MOD": [f"Équipement {code}" for code in facility_types]
+            + ["Commune", "Département"],
+        }
+    )
+
+    bpe_dir.mkdir(parents=True, exist_ok=True)
+    bpe_data_file = bpe_dir / "DS_BPE_2024_data.csv"
+    bpe_metadata_file = bpe_dir / "DS_BPE_2024_metadata.csv"
+    pl.concat([facilities, departments]).write_csv(bpe_data_file, separator=";")
+    metadata.write_csv(bpe_metadata_file, separator=";")
+
+    return bpe_data_file, bpe_metadata_file
+
+
+def generate_datasets(
+    data_dir: Path, communes: int = 35_000, dvf_rows: int = 1_000_000, seed: int = 0
+) -> tuple[Path, tuple[Path, Path], Path]:
+    """
+    Write the three synthetic sources, unless data_dir already holds them.
+
+    Args:
+        data_dir: Directory receiving the files
+        communes: Number of communes
+        dvf_rows: Number of DVF rows (lots)
+        seed: Random seed, the same seed gives the same files
+
+    Returns:
+        (DVF path, (BPE data file, BPE metadata file), communes path), like
+        download_datasets
+    """
+    dvf_path = data_dir / "dvf.csv.gz"
+    bpe_dir = data_dir / "bpe"
+    communes_path = data_dir / "communes.csv.gz"
+    bpe_files = (bpe_dir / "DS_BPE_2024_data.csv", bpe_dir / "DS_BPE_2024_metadata.csv")
+
+    params = {
+        "communes": communes,
+        "dvf_rows": dvf_rows,
+        "seed": seed,
+        "version": SYNTHETIC_VERSION,
+    }
+    params_path = data_dir / SYNTHETIC_PARAMS_FILE
+    if params_path.exists() and json.loads(params_path.read_text()) == params:
+        print(f"Synthetic datasets in {data_dir} are up to date.")
+        return dvf_path, bpe_files, communes_path
+
+    print(f"Generating {communes:,} communes and {dvf_rows:,} DVF rows...")
+    data_dir.mkdir(parents=True, exist_ok=True)
+    params_path.unlink(missing_ok=True)
+    rng = np.random.default_rng(seed)
+    codes = commune_codes(communes)
+
+    centres = generate_communes(communes_path, codes, rng)
+    generate_bpe(bpe_dir, codes, rng)
+    generate_dvf(dvf_path, codes, centres, dvf_rows, rng)
+
+    params_path.write_text(json.dumps(params))
+    print(f"Synthetic datasets written to {data_dir}")
+    return dvf_path, bpe_files, communes_path
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--communes", type=int, default=35_000)
+    parser.add_argument("--dvf-rows", type=int, default=1_000_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--data-dir",
+        type=Path,
+        default=None,
+        help="Output directory (default: data/synthetic/COMMUNES_DVF-ROWS)",
+    )
+    args = parser.parse_args()
+
+    generate_datasets(
+        args.data_dir
+        or setup_data_directory() / "synthetic" / f"{args.communes}_{args.dvf_rows}",
+        args.communes,
+        args.dvf_rows,
+        args.seed,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -12,23 +12,33 @@ def _():
     import sys
 
     sys.path.insert(0, str(Path(__file__).parent.parent))
+    from src import profiling, stages
+    from src.commune_graph import COMMUNE_GRAPH_DIR, commune_graph
+    from src.facilities import load_facility_points
+    from src.outputs import default_output_path, scan_output, write_dataset
+    from src.stage_cache import StageCache
     from src.utils import (
         setup_data_directory,
-        download_dvf_dataset,
-        download_bpe_dataset,
-        download_communes_dataset,
-        calculate_nearest_facility_distance_matrix,
+        download_datasets,
+        convert_dvf_to_parquet,
     )
 
     return (
+        COMMUNE_GRAPH_DIR,
         Path,
-        calculate_nearest_facility_distance_matrix,
-        download_bpe_dataset,
-        download_communes_dataset,
-        download_dvf_dataset,
+        StageCache,
+        commune_graph,
+        convert_dvf_to_parquet,
+        default_output_path,
+        download_datasets,
+        load_facility_points,
         mo,
         pl,
+        profiling,
+        scan_output,
         setup_data_directory,
+        stages,
+        write_dataset,
     )
 
 
@@ -90,22 +100,39 @@ def _(mo):
 
 
 @app.cell
-def _(setup_data_directory):
+def _(StageCache, profiling, setup_data_directory):
     DATA_DIR = setup_data_directory()
-    return (DATA_DIR,)
+
+    # Revalidate local files against the servers (ETag / Last-Modified)
+    REFRESH_DATASETS = False
+
+    # Stage outputs are reused across runs while their inputs and parameters match
+    stage_cache = StageCache(DATA_DIR / "stage_cache")
+
+    # Set to a path (e.g. DATA_DIR / "trace.json") to profile every stage,
+    # the trace and a per-stage summary are produced once the dataset is saved
+    PROFILE_TRACE_FILE = None
+    if PROFILE_TRACE_FILE is not None:
+        profiling.enable()
+    return DATA_DIR, PROFILE_TRACE_FILE, REFRESH_DATASETS, stage_cache
 
 
 @app.cell
-def _(
-    DATA_DIR,
-    download_bpe_dataset,
-    download_communes_dataset,
-    download_dvf_dataset,
-):
-    dvf_csv_path = download_dvf_dataset(DATA_DIR)
-    bpe_data_file, bpe_metadata_file = download_bpe_dataset(DATA_DIR)
-    communes_path = download_communes_dataset(DATA_DIR)
-    return bpe_data_file, bpe_metadata_file, communes_path, dvf_csv_path
+def _(DATA_DIR, REFRESH_DATASETS, convert_dvf_to_parquet, download_datasets):
+    # DVF, BPE and communes are fetched concurrently, resuming partial files
+    dvf_gz_path, (bpe_data_file, bpe_metadata_file), communes_path = download_datasets(
+        DATA_DIR, refresh=REFRESH_DATASETS
+    )
+
+    # One-time typed Parquet conversion, rebuilt only when dvf.csv.gz changes
+    dvf_parquet_dir = convert_dvf_to_parquet(dvf_gz_path, DATA_DIR / "dvf_parquet")
+    return (
+        bpe_data_file,
+        bpe_metadata_file,
+        communes_path,
+        dvf_gz_path,
+        dvf_parquet_dir,
+    )
 
 
 @app.cell(hide_code=True)
@@ -134,6 +161,13 @@ def _():
     MIN_GROWTH_PERCENT = -100
     MAX_GROWTH_PERCENT = 200
 
+    # Legacy 1° ≈ 111 km approximation, "haversine" for great-circle distances
+    DISTANCE_METRIC = "flat"
+
+    # Optional geolocated BPE file (one row per facility), distances then go to
+    # the nearest actual facility instead of the nearest commune centre holding one
+    FACILITY_POINTS_FILE = None
+
     SELECTED_FACILITY_TYPES: list[str] = [
         "B207",  # Boulangerie-pâtisserie (Indispensable)
         "B201",  # Supérette (Emergency shopping)
@@ -147,6 +181,8 @@ def _():
         "A206",  # Bureau de poste
     ]
     return (
+        DISTANCE_METRIC,
+        FACILITY_POINTS_FILE,
         MAX_GROWTH_PERCENT,
         MIN_GROWTH_PERCENT,
         MIN_SALES,
@@ -186,32 +222,8 @@ def _(mo):
 
 
 @app.cell
-def _(dvf_csv_path, pl):
-    dvf_raw_sales = (
-        pl.scan_csv(dvf_csv_path, schema_overrides={"code_commune": pl.String})
-        .select(
-            [
-                "id_mutation",
-                "date_mutation",
-                "nature_mutation",
-                "valeur_fonciere",
-                "code_commune",
-                "code_type_local",
-                "surface_reelle_bati",
-            ]
-        )
-        .with_columns(pl.col("date_mutation").str.to_date())
-        .filter(
-            (pl.col("date_mutation") >= pl.date(2021, 1, 1))
-            & (pl.col("date_mutation") <= pl.date(2024, 12, 31))
-            & (pl.col("nature_mutation") == "Vente")
-            & (pl.col("valeur_fonciere").is_not_null())
-            & (pl.col("valeur_fonciere") > 0)
-            & ~pl.col("code_commune").str.starts_with("97")
-            & ~pl.col("code_commune").str.starts_with("98")
-        )
-        .drop("nature_mutation")
-    )
+def _(dvf_parquet_dir, stages):
+    dvf_raw_sales = stages.dvf_raw_sales(dvf_parquet_dir)
     return (dvf_raw_sales,)
 
 
@@ -229,53 +241,41 @@ def _(mo):
 
 
 @app.cell
-def _(dvf_raw_sales, pl):
-    dvf_by_transaction = (
-        dvf_raw_sales.group_by("id_mutation")
-        .agg(
-            [
-                pl.col("date_mutation").first(),
-                pl.col("valeur_fonciere").first(),
-                pl.col("code_commune").first(),
-                (pl.col("code_type_local") == 4).any().alias("has_type_4"),
-                pl.col("surface_reelle_bati")
-                .fill_null(0)
-                .sum()
-                .alias("surface_reelle_bati"),
-            ]
-        )
-        .filter(~pl.col("has_type_4") & (pl.col("surface_reelle_bati") > 0))
-        .drop("has_type_4")
-    )
+def _(dvf_raw_sales, stages):
+    dvf_by_transaction = stages.dvf_by_transaction(dvf_raw_sales)
     return (dvf_by_transaction,)
 
 
 @app.cell
-def _(dvf_by_transaction, mo):
-    dvf_by_transaction_collected = dvf_by_transaction.collect()
+def _(dvf_by_transaction, dvf_gz_path, mo, stage_cache, stages):
+    # The validation counts are collected in the same pass as the stage
+    dvf_by_transaction_stages = stage_cache.cached_all(
+        {
+            "dvf_by_transaction": dvf_by_transaction,
+            "dvf_by_transaction_metrics": stages.dvf_by_transaction_metrics(
+                dvf_by_transaction
+            ),
+        },
+        inputs=[dvf_gz_path],
+        params=stages.dvf_transaction_params(),
+    )
+    dvf_by_transaction_collected, dvf_by_transaction_key = dvf_by_transaction_stages[
+        "dvf_by_transaction"
+    ]
+    dvf_by_transaction_metrics = dvf_by_transaction_stages[
+        "dvf_by_transaction_metrics"
+    ][0].row(0, named=True)
 
     mo.md(f"""
-    **Validation**: Aggregated to **{dvf_by_transaction_collected.shape[0]:,} transactions**  
-    From {dvf_by_transaction_collected["code_commune"].n_unique():,} unique municipalities
+    **Validation**: Aggregated to **{dvf_by_transaction_metrics["transactions"]:,} transactions**  
+    From {dvf_by_transaction_metrics["communes"]:,} unique municipalities
     """)
-    return (dvf_by_transaction_collected,)
+    return dvf_by_transaction_collected, dvf_by_transaction_key
 
 
 @app.cell
-def _(dvf_by_transaction_collected, pl):
-    dvf_price_per_sqm = (
-        dvf_by_transaction_collected.lazy()
-        .with_columns(
-            [
-                pl.col("date_mutation").dt.year().alias("year"),
-                (pl.col("valeur_fonciere") / pl.col("surface_reelle_bati")).alias(
-                    "prix_m2"
-                ),
-            ]
-        )
-        .drop(["date_mutation", "valeur_fonciere", "surface_reelle_bati"])
-        .filter(pl.col("year").is_in([2021, 2024]))
-    )
+def _(dvf_by_transaction_collected, stages):
+    dvf_price_per_sqm = stages.dvf_price_per_sqm(dvf_by_transaction_collected.lazy())
     return (dvf_price_per_sqm,)
 
 
@@ -291,32 +291,23 @@ def _(mo):
 
 
 @app.cell
-def _(MIN_SALES, dvf_price_per_sqm, pl):
-    dvf_commune_yearly_stats = (
-        dvf_price_per_sqm.group_by(["code_commune", "year"])
-        .agg(
-            [
-                pl.col("prix_m2").mean().alias("avg_prix_m2"),
-                pl.col("prix_m2").median().alias("median_prix_m2"),
-                pl.col("id_mutation").count().alias("count_sales"),
-            ]
-        )
-        .filter(pl.col("count_sales") >= MIN_SALES)
+def _(MIN_SALES, dvf_price_per_sqm, stages):
+    dvf_commune_yearly_stats = stages.dvf_commune_yearly_stats(
+        dvf_price_per_sqm, MIN_SALES
     )
     return (dvf_commune_yearly_stats,)
 
 
 @app.cell
-def _(dvf_commune_yearly_stats, mo, pl):
-    stats_collected = dvf_commune_yearly_stats.collect()
-
-    year_2021 = stats_collected.filter(pl.col("year") == 2021)
-    year_2024 = stats_collected.filter(pl.col("year") == 2024)
+def _(dvf_yearly_metrics, mo, pl):
+    # Collected alongside dvf_complete_years, see the Step 4 cell
+    year_2021 = dvf_yearly_metrics.filter(pl.col("year") == 2021).row(0, named=True)
+    year_2024 = dvf_yearly_metrics.filter(pl.col("year") == 2024).row(0, named=True)
 
     mo.md(f"""
     **Validation**: Aggregated by municipality and year
-    - **2021**: {year_2021.shape[0]:,} municipalities, median price/m² = {year_2021["median_prix_m2"].median():.2f} €
-    - **2024**: {year_2024.shape[0]:,} municipalities, median price/m² = {year_2024["median_prix_m2"].median():.2f} €
+    - **2021**: {year_2021["communes"]:,} municipalities, median price/m² = {year_2021["median_prix_m2"]:.2f} €
+    - **2024**: {year_2024["communes"]:,} municipalities, median price/m² = {year_2024["median_prix_m2"]:.2f} €
     """)
     return
 
@@ -333,19 +324,8 @@ def _(mo):
 
 
 @app.cell
-def _(dvf_commune_yearly_stats, pl):
-    communes_with_both_years = (
-        dvf_commune_yearly_stats.group_by("code_commune")
-        .agg(pl.col("year").unique().alias("years"))
-        .filter(
-            pl.col("years").list.contains(2021) & pl.col("years").list.contains(2024)
-        )
-        .select(["code_commune"])
-    )
-
-    dvf_complete_years = dvf_commune_yearly_stats.join(
-        communes_with_both_years, on="code_commune", how="semi"
-    )
+def _(dvf_commune_yearly_stats, stages):
+    dvf_complete_years = stages.dvf_complete_years(dvf_commune_yearly_stats)
     return (dvf_complete_years,)
 
 
@@ -364,48 +344,43 @@ def _(mo):
 def _(
     MAX_GROWTH_PERCENT,
     MIN_GROWTH_PERCENT,
+    MIN_SALES,
     YEARS_BETWEEN_2021_2024,
+    dvf_by_transaction_key,
+    dvf_commune_yearly_stats,
     dvf_complete_years,
-    pl,
+    stage_cache,
+    stages,
 ):
-    dvf_collected = dvf_complete_years.collect()
-
-    dvf_pivoted = dvf_collected.pivot(
-        on="year",
-        values=["avg_prix_m2", "median_prix_m2", "count_sales"],
-        index="code_commune",
+    # One pass: the yearly stats feed both the stage and its validation metrics
+    dvf_complete_years_stages = stage_cache.cached_all(
+        {
+            "dvf_complete_years": dvf_complete_years,
+            "dvf_yearly_metrics": stages.dvf_yearly_metrics(dvf_commune_yearly_stats),
+        },
+        upstream=[dvf_by_transaction_key],
+        params=stages.dvf_stats_params(MIN_SALES),
     )
-
-    dvf_final = (
-        dvf_pivoted.with_columns(
-            growth_prix_m2=(
-                (pl.col("median_prix_m2_2024") - pl.col("median_prix_m2_2021"))
-                / pl.col("median_prix_m2_2021")
-                * 100
-                / YEARS_BETWEEN_2021_2024
-            )
-        )
-        .filter(
-            (pl.col("growth_prix_m2") >= MIN_GROWTH_PERCENT)
-            & (pl.col("growth_prix_m2") <= MAX_GROWTH_PERCENT)
-        )
-        .select(
-            [
-                "code_commune",
-                pl.col("avg_prix_m2_2024").alias("avg_prix_m2"),
-                pl.col("median_prix_m2_2024").alias("median_prix_m2"),
-                pl.col("count_sales_2024").alias("count_sales"),
-                "growth_prix_m2",
-            ]
-        )
-        .with_columns(
-            (
-                (pl.col("growth_prix_m2") - pl.col("growth_prix_m2").mean())
-                / pl.col("growth_prix_m2").std()
-            ).alias("growth_prix_m2_standardized")
-        )
+    dvf_collected, dvf_complete_years_key = dvf_complete_years_stages[
+        "dvf_complete_years"
+    ]
+    dvf_yearly_metrics = dvf_complete_years_stages["dvf_yearly_metrics"][0]
+
+    # Only this step reruns when the growth bounds change
+    dvf_final, dvf_final_key = stage_cache.cached(
+        "dvf_final",
+        lambda: stages.dvf_final(
+            dvf_collected,
+            MIN_GROWTH_PERCENT,
+            MAX_GROWTH_PERCENT,
+            YEARS_BETWEEN_2021_2024,
+        ),
+        upstream=[dvf_complete_years_key],
+        params=stages.dvf_final_params(
+            MIN_GROWTH_PERCENT, MAX_GROWTH_PERCENT, YEARS_BETWEEN_2021_2024
+        ),
     )
-    return (dvf_final,)
+    return dvf_final, dvf_yearly_metrics
 
 
 @app.cell(hide_code=True)
@@ -483,27 +458,9 @@ def _(mo):
 
 
 @app.cell
-def _(SELECTED_FACILITY_TYPES: list[str], bpe_data_file, pl):
-    bpe_raw_facilities = (
-        pl.scan_csv(
-            bpe_data_file,
-            separator=";",
-            schema_overrides={"GEO": pl.String},
-        )
-        .select(
-            [
-                "GEO",
-                "GEO_OBJECT",
-                "FACILITY_TYPE",
-                "OBS_VALUE",
-            ]
-        )
-        .filter(pl.col("GEO_OBJECT").is_in(["ARM", "COM"]))
-        .filter(pl.col("FACILITY_TYPE").is_in(SELECTED_FACILITY_TYPES))
-        .filter(
-            ~pl.col("GEO").str.starts_with("97") & ~pl.col("GEO").str.starts_with("98")
-        )
-        .drop("GEO_OBJECT")
+def _(SELECTED_FACILITY_TYPES: list[str], bpe_data_file, stages):
+    bpe_raw_facilities = stages.bpe_raw_facilities(
+        bpe_data_file, SELECTED_FACILITY_TYPES
     )
     return (bpe_raw_facilities,)
 
@@ -523,21 +480,10 @@ def _(mo):
 
 
 @app.cell
-def _(SELECTED_FACILITY_TYPES: list[str], bpe_metadata_file, pl):
-    facility_type_labels = (
-        pl.read_csv(
-            bpe_metadata_file,
-            separator=";",
-        )
-        .filter(pl.col("COD_VAR") == "FACILITY_TYPE")
-        .select(["COD_MOD", "LIB_MOD"])
-        .filter(pl.col("COD_MOD").is_in(SELECTED_FACILITY_TYPES))
-        .unique()
+def _(SELECTED_FACILITY_TYPES: list[str], bpe_metadata_file, stages):
+    label_mapping = stages.facility_label_mapping(
+        bpe_metadata_file, SELECTED_FACILITY_TYPES
     )
-
-    label_mapping = {
-        row["COD_MOD"]: row["LIB_MOD"] for row in facility_type_labels.to_dicts()
-    }
     return (label_mapping,)
 
 
@@ -550,7 +496,7 @@ def _(mo):
 
     **Operations**:
     1. Rename `GEO` → `code_commune` for consistency with DVF
-    2. Cast facility counts to Int64
+    2. Keep facility counts as read (UInt32, see `src/schemas.py`)
     3. Pivot on `FACILITY_TYPE` with sum aggregation (handles duplicate codes)
     4. Fill nulls with 0 (municipality doesn't have this facility)
     5. Rename columns using label mapping
@@ -562,22 +508,22 @@ def _(mo):
 
 
 @app.cell
-def _(bpe_raw_facilities, label_mapping, pl):
-    bpe_by_commune = (
-        bpe_raw_facilities.collect()
-        .rename({"GEO": "code_commune"})
-        .with_columns(pl.col("OBS_VALUE").cast(pl.Int64))
-        .pivot(
-            on="FACILITY_TYPE",
-            values="OBS_VALUE",
-            index="code_commune",
-            aggregate_function="sum",
-        )
-        .fill_null(0)
-        .rename(label_mapping)
-        .with_columns(pl.sum_horizontal(pl.exclude("code_commune")).alias("Total"))
+def _(
+    SELECTED_FACILITY_TYPES: list[str],
+    bpe_data_file,
+    bpe_metadata_file,
+    bpe_raw_facilities,
+    label_mapping,
+    stage_cache,
+    stages,
+):
+    bpe_by_commune, bpe_by_commune_key = stage_cache.cached(
+        "bpe_by_commune",
+        lambda: stages.bpe_by_commune(bpe_raw_facilities, label_mapping),
+        inputs=[bpe_data_file, bpe_metadata_file],
+        params=stages.bpe_by_commune_params(SELECTED_FACILITY_TYPES),
     )
-    return (bpe_by_commune,)
+    return bpe_by_commune, bpe_by_commune_key
 
 
 @app.cell(hide_code=True)
@@ -626,37 +572,15 @@ def _(mo):
 
     **Distance Calculation**:
     For each of the 10 service types, compute geodesic distance to the nearest municipality offering that service.
-    Uses vectorized NumPy operations for performance on ~35,000 municipalities.
+    All service types are computed in a single pass over one collected frame, using a KD-tree spatial index.
     """)
     return
 
 
 @app.cell
-def _(bpe_by_commune, communes_path, label_mapping, pl):
-    communes_gps = (
-        pl.scan_csv(communes_path, schema_overrides={"code_insee": pl.Utf8})
-        .select(["code_insee", "latitude_centre", "longitude_centre"])
-        .rename({"code_insee": "code_commune"})
-    )
-
-    bpe_with_gps = (
-        bpe_by_commune.lazy()
-        .join(
-            communes_gps,
-            on="code_commune",
-            how="left",
-        )
-        .with_columns(
-            [
-                pl.col("latitude_centre").alias("latitude"),
-                pl.col("longitude_centre").alias("longitude"),
-            ]
-        )
-        .drop(["latitude_centre", "longitude_centre"])
-    )
-
+def _(label_mapping):
     facility_columns = list(label_mapping.values())
-    return bpe_with_gps, facility_columns
+    return (facility_columns,)
 
 
 @app.cell(hide_code=True)
@@ -675,18 +599,76 @@ def _(mo):
 
 @app.cell
 def _(
-    bpe_with_gps,
-    calculate_nearest_facility_distance_matrix,
-    facility_columns,
+    COMMUNE_GRAPH_DIR,
+    DATA_DIR,
+    DISTANCE_METRIC,
+    FACILITY_POINTS_FILE,
+    Path,
+    bpe_by_commune,
+    bpe_by_commune_key,
+    bpe_data_file,
+    commune_graph,
+    communes_path,
+    label_mapping,
+    load_facility_points,
+    stage_cache,
+    stages,
 ):
-    bpe_with_distances = bpe_with_gps
-    for facility_code in facility_columns:
-        print(f"Calculating distance to {facility_code}...")
-        bpe_with_distances = calculate_nearest_facility_distance_matrix(
-            bpe_with_distances, facility_code
+    import functools as _functools
+
+    facility_points_inputs = (
+        [Path(FACILITY_POINTS_FILE)] if FACILITY_POINTS_FILE is not None else []
+    )
+
+    # Points and graph are loaded at most once, and only on a cache miss
+    @_functools.cache
+    def _facility_points():
+        if not facility_points_inputs:
+            return None
+        return load_facility_points(facility_points_inputs[0], label_mapping)
+
+    # Commune centre distances are looked up in the persistent neighbour
+    # graph, shared with headless runs
+    @_functools.cache
+    def _graph():
+        if facility_points_inputs:
+            return None
+        return commune_graph(
+            communes_path, DATA_DIR / COMMUNE_GRAPH_DIR, DISTANCE_METRIC
         )
 
-    print("Distance calculations complete!")
+    # Distances are cached per facility type, keyed on the BPE and communes
+    # files: adding a code to SELECTED_FACILITY_TYPES only computes its column
+    _distances, _distance_keys = {}, []
+    for _facility_type, _facility_column in label_mapping.items():
+        _distances[_facility_column], _distance_key = stage_cache.cached(
+            "facility_distances",
+            lambda _column=_facility_column: stages.facility_distances(
+                bpe_by_commune,
+                communes_path,
+                _column,
+                DISTANCE_METRIC,
+                facility_points=_facility_points(),
+                graph=_graph(),
+            ),
+            inputs=[bpe_data_file, communes_path, *facility_points_inputs],
+            params=stages.facility_distances_params(
+                _facility_type, DISTANCE_METRIC, bool(facility_points_inputs)
+            ),
+        )
+        _distance_keys.append(_distance_key)
+
+    bpe_with_distances, _ = stage_cache.cached(
+        "bpe_with_distances",
+        lambda: stages.join_facility_distances(
+            bpe_by_commune,
+            communes_path,
+            _distances,
+            facility_points=bool(facility_points_inputs),
+        ),
+        inputs=[communes_path],
+        upstream=[bpe_by_commune_key, *_distance_keys],
+    )
     return (bpe_with_distances,)
 
 
@@ -704,64 +686,94 @@ def _(mo):
 
 
 @app.cell
-def _(bpe_with_distances, dvf_final):
-    bpe_to_join = bpe_with_distances.unique()
-
-    final_dataset_with_distances = dvf_final.lazy().join(
-        bpe_to_join, on="code_commune", how="inner"
+def _(bpe_with_distances, dvf_final, stages):
+    final_dataset_with_distances = stages.final_dataset(
+        dvf_final, bpe_with_distances.lazy()
     )
     return (final_dataset_with_distances,)
 
 
 @app.cell
-def _(Path, final_dataset_with_distances):
-    output_file = Path(__file__).parent.parent / "data" / "final_dataset.csv"
-    output_file.parent.mkdir(parents=True, exist_ok=True)
-
-    collected_dataset = final_dataset_with_distances.collect()
-    collected_dataset.write_csv(output_file)
+def _(
+    DATA_DIR,
+    default_output_path,
+    final_dataset_with_distances,
+    scan_output,
+    write_dataset,
+):
+    # "csv", "parquet", "ipc" (Arrow) or "partitioned-parquet" (one file per
+    # department), typed formats keep dtypes and dictionary-encode communes
+    OUTPUT_FORMAT = "csv"
+    output_file = default_output_path(DATA_DIR, OUTPUT_FORMAT, "final_dataset")
+
+    # Sunk from the lazy plan, then validated from a scan of the output, the
+    # dataset is never collected as a whole
+    output_schema = write_dataset(
+        final_dataset_with_distances, output_file, OUTPUT_FORMAT
+    )
+    final_dataset_scan = scan_output(output_file, OUTPUT_FORMAT)
 
     print(f"Final dataset with distances saved to {output_file}")
-    print(f"Shape: {collected_dataset.shape}")
-    print(f"Columns: {collected_dataset.columns}")
-    return (collected_dataset,)
+    print(f"Shape: ({output_schema['rows']}, {len(output_schema['columns'])})")
+    print(f"Columns: {[column['name'] for column in output_schema['columns']]}")
+    return final_dataset_scan, output_schema
 
 
 @app.cell(hide_code=True)
-def _(collected_dataset, facility_columns, mo):
+def _(facility_columns, final_dataset_scan, mo, output_schema, pl):
     distance_cols = [f"distance_{fc}" for fc in facility_columns]
 
-    null_counts = {
-        "Real Estate": collected_dataset.select(["median_prix_m2", "growth_prix_m2"])
-        .null_count()
-        .to_dicts()[0],
-        "Facilities": collected_dataset.select(facility_columns)
-        .null_count()
-        .sum_horizontal()[0],
-        "Distances": collected_dataset.select(distance_cols)
-        .null_count()
-        .sum_horizontal()[0],
-    }
+    # One streaming aggregate over the written file
+    validation = (
+        final_dataset_scan.select(
+            pl.col("median_prix_m2").null_count().alias("median_nulls"),
+            pl.col("growth_prix_m2").null_count().alias("growth_nulls"),
+            pl.sum_horizontal(pl.col(facility_columns).null_count()).alias(
+                "facility_nulls"
+            ),
+            pl.sum_horizontal(pl.col(distance_cols).null_count()).alias(
+                "distance_nulls"
+            ),
+            pl.max_horizontal(pl.col(distance_cols).max()).alias("max_distance"),
+        )
+        .collect(engine="streaming")
+        .row(0, named=True)
+    )
 
     mo.md(f"""
     ## Final Dataset Validation
 
-    **Shape**: {collected_dataset.shape[0]:,} municipalities × {collected_dataset.shape[1]} columns
+    **Shape**: {output_schema["rows"]:,} municipalities × {len(output_schema["columns"])} columns
 
     **Null Values Check**:
-    - Real estate metrics: {null_counts["Real Estate"]["median_prix_m2"]} nulls in median_prix_m2, {null_counts["Real Estate"]["growth_prix_m2"]} in growth_prix_m2
-    - Facilities counts: {null_counts["Facilities"]} total nulls
-    - Distance metrics: {null_counts["Distances"]} total nulls
+    - Real estate metrics: {validation["median_nulls"]} nulls in median_prix_m2, {validation["growth_nulls"]} in growth_prix_m2
+    - Facilities counts: {validation["facility_nulls"]} total nulls
+    - Distance metrics: {validation["distance_nulls"]} total nulls
 
     **Distance Statistics** (municipalities without local facility):
-    - Max distance encountered: {collected_dataset.select(distance_cols).max().max_horizontal()[0]:.2f} km
+    - Max distance encountered: {validation["max_distance"]:.2f} km
     """)
     return
 
 
 @app.cell
-def _(collected_dataset):
-    collected_dataset
+def _(final_dataset_scan):
+    # First rows only, the full dataset is in the output file
+    final_dataset_scan.head(1000).collect()
+    return
+
+
+@app.cell
+def _(PROFILE_TRACE_FILE, output_schema, profiling):
+    # Runs after the final dataset is saved, all traced stages are recorded
+    if PROFILE_TRACE_FILE is not None and output_schema is not None:
+        profile_records = profiling.disable()
+        profiling.write_chrome_trace(profile_records, PROFILE_TRACE_FILE)
+        print(f"Trace written to {PROFILE_TRACE_FILE}")
+        profile_summary = profiling.summary_table(profile_records)
+    else:
+        profile_summary = None
+    profile_summary
     return
 
 
@@ -0,0 +1,843 @@
+"""
+Headless entry point running the pipeline without the marimo UI.
+
+`tableau-storytelling run` executes the same stage graph as
+notebooks/pipeline.py, minus the display-only cells, and writes the final
+dataset. DVF stages are collected with Polars' streaming engine so the
+multi-GB scans run in bounded memory. Stage outputs share the notebook's
+cache (both key the shared stages with the stages.*_params helpers), a
+headless run warms the notebook and vice versa.
+
+Usage:
+    uv run tableau-storytelling run --metric haversine --min-sales 3
+    uv run tableau-storytelling run --format parquet
+    uv run tableau-storytelling run --panel
+    uv run tableau-storytelling run --grid hex --grid-km 0.5 2 10
+    uv run tableau-storytelling run --memory-budget 6000
+"""
+
+import argparse
+import time
+from pathlib import Path
+
+import polars as pl
+
+from src import profiling, stages
+from src.commune_graph import COMMUNE_GRAPH_DIR, CommuneGraph, commune_graph
+from src.facilities import facility_points_from_counts, load_facility_points
+from src.grid import DEFAULT_GRID_KM, GRID_SHAPES
+from src.incremental import scan_dvf_aggregates, update_dvf_aggregates
+from src.outputs import OUTPUT_FORMATS, default_output_path, write_dataset
+from src.sharding import merge_shards, run_shards
+from src.stage_cache import StageCache
+from src.utils import (
+    DISTANCE_METRICS,
+    convert_dvf_to_parquet,
+    download_datasets,
+    setup_data_directory,
+)
+
+# Defaults mirror the configuration cell of notebooks/pipeline.py
+DEFAULT_MIN_SALES = 2
+DEFAULT_YEARS_BETWEEN = 4
+DEFAULT_MIN_GROWTH_PERCENT = -100
+DEFAULT_MAX_GROWTH_PERCENT = 200
+DEFAULT_DISTANCE_METRIC = "flat"
+DEFAULT_FACILITY_TYPES = [
+    "B207",
+    "B201",
+    "B202",
+    "B105",
+    "C107",
+    "C108",
+    "D265",
+    "D307",
+    "A203",
+    "A206",
+]
+
+COLLECT_ENGINES = ("streaming", "in-memory", "auto")
+
+
+def run_pipeline(
+    data_dir: Path,
+    output_file: Path,
+    output_format: str = "csv",
+    min_sales: int = DEFAULT_MIN_SALES,
+    years_between: int = DEFAULT_YEARS_BETWEEN,
+    min_growth_percent: float = DEFAULT_MIN_GROWTH_PERCENT,
+    max_growth_percent: float = DEFAULT_MAX_GROWTH_PERCENT,
+    facility_types: list[str] | None = None,
+    metric: str = DEFAULT_DISTANCE_METRIC,
+    engine: str = "streaming",
+    refresh: bool = False,
+    use_cache: bool = True,
+    incremental: bool = False,
+    median_accuracy: float | None = None,
+    workers: int | None = None,
+    shard_dir: Path | None = None,
+    facility_points_file: Path | None = None,
+    knn: list[int] | None = None,
+    radii_km: list[float] | None = None,
+    nearest_commune: bool = False,
+    panel: bool = False,
+    grid: str | None = None,
+    grid_km: list[float] | None = None,
+    low_memory: bool = False,
+    memory_budget_mb: float | None = None,
+) -> dict:
+    """
+    Run every pipeline stage and write the final dataset.
+
+    Args:
+        data_dir: Directory holding the downloaded datasets and caches
+        output_file: File (directory if partitioned) receiving the final dataset
+        output_format: One of OUTPUT_FORMATS, the dataset is sunk without
+            being collected as a whole
+        min_sales: Minimum sales per (commune, year) to keep its statistics
+        years_between: Number of years the growth is annualized over
+        min_growth_percent: Lower bound of the kept annual growth (%)
+        max_growth_percent: Upper bound of the kept annual growth (%)
+        facility_types: BPE facility codes, DEFAULT_FACILITY_TYPES if None
+        metric: Distance metric, a key of DISTANCE_METRICS
+        engine: Polars engine collecting the DVF stages, one of COLLECT_ENGINES
+        refresh: Revalidate downloaded files against the servers
+        use_cache: Reuse and store stage outputs in data_dir/stage_cache
+        incremental: Aggregate DVF through the stored per-(commune, year)
+            aggregates of data_dir/dvf_aggregates, updating only the changed
+            year/department partitions
+        median_accuracy: Read medians from quantile sketches with this
+            relative accuracy instead of computing them exactly; incremental
+            aggregates and department shards then store sketches, merged
+            when read back
+        workers: If set, aggregate DVF by department on this many processes
+            (see src.sharding)
+        shard_dir: Directory receiving the department shards, possibly
+            shared with `tableau-storytelling shard` workers on other
+            machines, data_dir/dvf_shards if None
+        facility_points_file: Geolocated BPE file (one row per facility), if
+            set distances go to the nearest actual facility
+        knn: Ranks n of extra distance_{facility}_k{n} columns
+        radii_km: Radii r of extra count_{facility}_within_{r}km columns
+        nearest_commune: Add the code_commune of the nearest facility of
+            each type (nearest_commune_{facility} columns)
+        panel: Aggregate every DVF year and write one row per commune and
+            pair of years (see stages.dvf_panel) instead of the 2021 → 2024
+            growth, years_between is then taken from each window
+        grid: Cell shape, one of GRID_SHAPES; if set, write price statistics
+            and facility distances per grid cell and year (every year with
+            panel) instead of per commune
+        grid_km: Cell sizes of the grid, DEFAULT_GRID_KM if None
+        low_memory: Never hold the transaction-level DVF stages in memory,
+            they are streamed to checkpoints in the stage cache and scanned
+            back (see StageCache.checkpoint); with use_cache=False the
+            checkpoints are still written, but never reused
+        memory_budget_mb: Resident memory (MB) the low-memory run should fit
+            in, the transaction-level DVF stages are then aggregated in
+            parts sized from the budget left (see _max_part_bytes). Pair it
+            with profiling.enable(max_rss_mb=...) to check it per stage
+
+    Returns:
+        Sidecar schema of the written dataset (see write_dataset)
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(
+            f"Unknown output format {output_format!r}, expected one of {OUTPUT_FORMATS}"
+        )
+    if engine not in COLLECT_ENGINES:
+        raise ValueError(
+            f"Unknown engine {engine!r}, expected one of {COLLECT_ENGINES}"
+        )
+    if metric not in DISTANCE_METRICS:
+        raise ValueError(
+            f"Unknown metric {metric!r}, expected one of {sorted(DISTANCE_METRICS)}"
+        )
+    if (panel or grid is not None) and (incremental or workers is not None):
+        raise ValueError(
+            "panel and grid read the DVF sales, the incremental aggregates and "
+            "the department shards only hold commune statistics of the growth years"
+        )
+    if grid is not None and grid not in GRID_SHAPES:
+        raise ValueError(f"Unknown grid shape {grid!r}, expected one of {GRID_SHAPES}")
+    if grid is not None and median_accuracy is not None:
+        raise ValueError("Grid cells have exact medians, median_accuracy is unused")
+    if grid is not None and output_format == "partitioned-parquet":
+        raise ValueError("Grid cells have no department to partition by")
+    if low_memory and engine != "streaming":
+        raise ValueError("low_memory streams every DVF stage, engine must be streaming")
+    if memory_budget_mb is not None and not low_memory:
+        raise ValueError("memory_budget_mb sizes the low_memory parts, set low_memory")
+    facility_types = list(facility_types or DEFAULT_FACILITY_TYPES)
+    # Sales of every year for the panel, of 2021-2024 otherwise
+    dvf_years = None if panel else stages.GROWTH_YEARS
+
+    start = time.perf_counter()
+    data_dir.mkdir(parents=True, exist_ok=True)
+    # Low-memory checkpoints spill to the cache even when it is not reused
+    stage_cache = StageCache(
+        data_dir / "stage_cache" if use_cache or low_memory else None,
+        reuse=use_cache,
+    )
+    shard_dir = shard_dir or data_dir / "dvf_shards"
+
+    dvf_gz_path, (bpe_data_file, bpe_metadata_file), communes_path = download_datasets(
+        data_dir, refresh=refresh
+    )
+    with profiling.span("dvf_ingest"):
+        dvf_parquet_dir = convert_dvf_to_parquet(dvf_gz_path, data_dir / "dvf_parquet")
+
+    if grid is not None:
+        # Grid cells take the place of communes, no commune stage runs
+        return _write_output(
+            _grid_dataset(
+                stage_cache,
+                dvf_gz_path,
+                dvf_parquet_dir,
+                (bpe_data_file, bpe_metadata_file),
+                communes_path,
+                facility_types,
+                facility_points_file,
+                grid,
+                list(grid_km or DEFAULT_GRID_KM),
+                min_sales,
+                dvf_years,
+                metric,
+                engine,
+                low_memory,
+                memory_budget_mb,
+            ),
+            output_file,
+            output_format,
+            engine,
+            start,
+        )
+
+    # DVF, each stage and its validation metrics are collected in one pass
+    if incremental:
+        # Only the partitions changed since the last run are re-aggregated
+        aggregates_dir = data_dir / "dvf_aggregates"
+        dvf_upstream_key = update_dvf_aggregates(
+            dvf_parquet_dir, aggregates_dir, median_accuracy=median_accuracy
+        )
+        dvf_commune_yearly_stats = scan_dvf_aggregates(
+            aggregates_dir, median_accuracy=median_accuracy
+        ).filter(pl.col("count_sales") >= min_sales)
+    elif workers is not None:
+        # Departments are aggregated in separate processes (or machines)
+        # Shards claimed by other live workers are awaited, those of dead
+        # workers taken over
+        set_dir = run_shards(
+            dvf_parquet_dir,
+            shard_dir,
+            workers,
+            wait_for_claims=True,
+            median_accuracy=median_accuracy,
+        )
+        dvf_upstream_key = set_dir.name
+        dvf_commune_yearly_stats = (
+            merge_shards(dvf_parquet_dir, set_dir, median_accuracy)
+            .filter(pl.col("year").is_in(list(stages.GROWTH_YEARS)))
+            .filter(pl.col("count_sales") >= min_sales)
+        )
+    else:
+        dvf_by_transaction = stages.dvf_by_transaction(
+            stages.dvf_raw_sales(dvf_parquet_dir, years=dvf_years)
+        )
+        if low_memory:
+            # Aggregated department by department into a checkpoint scanned
+            # back, the metrics then stream from it
+            dvf_by_transaction, dvf_upstream_key = stage_cache.checkpoint(
+                "dvf_by_transaction",
+                stages.dvf_by_transaction_parts(
+                    dvf_parquet_dir,
+                    years=dvf_years,
+                    max_part_bytes=_max_part_bytes(memory_budget_mb),
+                ),
+                inputs=[dvf_gz_path],
+                params=stages.dvf_transaction_params(dvf_years),
+            )
+            metrics, _ = stage_cache.cached(
+                "dvf_by_transaction_metrics",
+                lambda: stages.dvf_by_transaction_metrics(dvf_by_transaction).collect(
+                    engine=engine
+                ),
+                inputs=[dvf_gz_path],
+                params=stages.dvf_transaction_params(dvf_years),
+            )
+        else:
+            dvf_by_transaction_stages = stage_cache.cached_all(
+                {
+                    "dvf_by_transaction": dvf_by_transaction,
+                    "dvf_by_transaction_metrics": stages.dvf_by_transaction_metrics(
+                        dvf_by_transaction
+                    ),
+                },
+                inputs=[dvf_gz_path],
+                params=stages.dvf_transaction_params(dvf_years),
+                engine=engine,
+            )
+            dvf_by_transaction, dvf_upstream_key = dvf_by_transaction_stages[
+                "dvf_by_transaction"
+            ]
+            metrics = dvf_by_transaction_stages["dvf_by_transaction_metrics"][0]
+        print(
+            f"{metrics['transactions'][0]:,} transactions "
+            f"in {metrics['communes'][0]:,} municipalities"
+        )
+
+        dvf_commune_yearly_stats = stages.dvf_commune_yearly_stats(
+            stages.dvf_price_per_sqm(dvf_by_transaction.lazy(), years=dvf_years),
+            min_sales,
+            median_accuracy,
+        )
+
+    dvf_stats_params = stages.dvf_stats_params(min_sales, median_accuracy)
+    if panel:
+        # Every year pair from the same statistics, no pivot per window
+        dvf_panel_stages = stage_cache.cached_all(
+            {
+                "dvf_panel": stages.dvf_panel(
+                    dvf_commune_yearly_stats, min_growth_percent, max_growth_percent
+                ),
+                "dvf_yearly_metrics": stages.dvf_yearly_metrics(
+                    dvf_commune_yearly_stats
+                ),
+            },
+            upstream=[dvf_upstream_key],
+            params={
+                **dvf_stats_params,
+                "min_growth_percent": min_growth_percent,
+                "max_growth_percent": max_growth_percent,
+            },
+            engine=engine,
+        )
+        dvf_final = dvf_panel_stages["dvf_panel"][0]
+        dvf_yearly_metrics = dvf_panel_stages["dvf_yearly_metrics"][0]
+    else:
+        dvf_complete_years_stages = stage_cache.cached_all(
+            {
+                "dvf_complete_years": stages.dvf_complete_years(
+                    dvf_commune_yearly_stats
+                ),
+                "dvf_yearly_metrics": stages.dvf_yearly_metrics(
+                    dvf_commune_yearly_stats
+                ),
+            },
+            upstream=[dvf_upstream_key],
+            params=dvf_stats_params,
+            engine=engine,
+        )
+        dvf_collected, dvf_complete_years_key = dvf_complete_years_stages[
+            "dvf_complete_years"
+        ]
+        dvf_yearly_metrics = dvf_complete_years_stages["dvf_yearly_metrics"][0]
+
+        dvf_final, _ = stage_cache.cached(
+            "dvf_final",
+            lambda: stages.dvf_final(
+                dvf_collected, min_growth_percent, max_growth_percent, years_between
+            ),
+            upstream=[dvf_complete_years_key],
+            params=stages.dvf_final_params(
+                min_growth_percent, max_growth_percent, years_between
+            ),
+        )
+
+    for year in dvf_yearly_metrics.iter_rows(named=True):
+        print(
+            f"{year['year']}: {year['communes']:,} municipalities, "
+            f"median price/m² = {year['median_prix_m2']:.2f} €"
+        )
+
+    # BPE
+    label_mapping, (bpe_by_commune, bpe_by_commune_key) = _bpe_by_commune(
+        stage_cache, bpe_data_file, bpe_metadata_file, facility_types
+    )
+
+    # Geolocated points are read at most once, and only on a cache miss
+    facility_points = None
+
+    def load_points() -> pl.DataFrame | None:
+        nonlocal facility_points
+        if facility_points is None and facility_points_file is not None:
+            facility_points = load_facility_points(facility_points_file, label_mapping)
+        return facility_points
+
+    # Commune centre lookups share the persistent graph of the communes,
+    # memory-mapped at most once, and only on a cache miss
+    graph = None
+
+    def load_graph() -> CommuneGraph | None:
+        nonlocal graph
+        if graph is None and facility_points_file is None:
+            graph = commune_graph(communes_path, data_dir / COMMUNE_GRAPH_DIR, metric)
+        return graph
+
+    # Distances are cached per facility type, keyed on the BPE and communes
+    # files rather than on the selection: changing the selected types only
+    # computes the new ones
+    points_inputs = [facility_points_file] if facility_points_file is not None else []
+    distances, distance_keys = {}, []
+    for facility_type, facility_column in label_mapping.items():
+        distances[facility_column], distance_key = stage_cache.cached(
+            "facility_distances",
+            lambda facility_column=facility_column: stages.facility_distances(
+                bpe_by_commune,
+                communes_path,
+                facility_column,
+                metric,
+                facility_points=load_points(),
+                graph=load_graph(),
+            ),
+            inputs=[bpe_data_file, communes_path] + points_inputs,
+            params=stages.facility_distances_params(
+                facility_type, metric, facility_points_file is not None
+            ),
+        )
+        distance_keys.append(distance_key)
+
+    bpe_with_distances, bpe_with_distances_key = stage_cache.cached(
+        "bpe_with_distances",
+        lambda: stages.join_facility_distances(
+            bpe_by_commune,
+            communes_path,
+            distances,
+            facility_points=facility_points_file is not None,
+        ),
+        inputs=[communes_path],
+        upstream=[bpe_by_commune_key, *distance_keys],
+    )
+
+    if knn or radii_km or nearest_commune:
+        # kNN, nearest provider and radius counts from one index per type
+        bpe_with_distances, _ = stage_cache.cached(
+            "bpe_facility_queries",
+            lambda: stages.bpe_facility_queries(
+                bpe_with_distances,
+                list(label_mapping.values()),
+                metric,
+                k=knn or [],
+                radii_km=radii_km or [],
+                nearest_commune=nearest_commune,
+                facility_points=load_points(),
+                graph=load_graph(),
+            ),
+            inputs=points_inputs,
+            upstream=[bpe_with_distances_key],
+            params={
+                "knn": knn,
+                "radii_km": radii_km,
+                "nearest_commune": nearest_commune,
+            },
+        )
+
+    # Final join, sunk to the output without collecting it
+    return _write_output(
+        stages.final_dataset(dvf_final, bpe_with_distances.lazy()),
+        output_file,
+        output_format,
+        engine,
+        start,
+    )
+
+
+def _bpe_by_commune(
+    stage_cache: StageCache,
+    bpe_data_file: Path,
+    bpe_metadata_file: Path,
+    facility_types: list[str],
+) -> tuple[dict[str, str], tuple[pl.DataFrame, str]]:
+    """Facility label mapping and the cached bpe_by_commune stage."""
+    label_mapping = stages.facility_label_mapping(bpe_metadata_file, facility_types)
+    return label_mapping, stage_cache.cached(
+        "bpe_by_commune",
+        lambda: stages.bpe_by_commune(
+            stages.bpe_raw_facilities(bpe_data_file, facility_types), label_mapping
+        ),
+        inputs=[bpe_data_file, bpe_metadata_file],
+        params=stages.bpe_by_commune_params(facility_types),
+    )
+
+
+def _max_part_bytes(memory_budget_mb: float | None) -> int | None:
+    """
+    Group-by memory of a low-memory DVF part, None without a budget.
+
+    A part gets half of the budget left above the current resident memory,
+    the other half covers the streaming engine's buffers and the allocator
+    not returning freed pages at once.
+    """
+    if memory_budget_mb is None:
+        return None
+    rss = profiling.current_rss()
+    available = int(memory_budget_mb * 1024**2) - rss
+    if available <= 0:
+        raise ValueError(
+            f"The memory budget of {memory_budget_mb:,.0f} MB is below the "
+            f"{rss / 1024**2:,.0f} MB already resident"
+        )
+    return available // 2
+
+
+def _grid_dataset(
+    stage_cache: StageCache,
+    dvf_gz_path: Path,
+    dvf_parquet_dir: Path,
+    bpe_files: tuple[Path, Path],
+    communes_path: Path,
+    facility_types: list[str],
+    facility_points_file: Path | None,
+    grid: str,
+    grid_km: list[float],
+    min_sales: int,
+    dvf_years: tuple[int, ...] | None,
+    metric: str,
+    engine: str,
+    low_memory: bool = False,
+    memory_budget_mb: float | None = None,
+) -> pl.LazyFrame:
+    """Grid cell statistics with distances to facilities, see run_pipeline."""
+    grid_stats_params = {
+        "grid": grid,
+        "grid_km": grid_km,
+        "min_sales": min_sales,
+        "years": dvf_years,
+    }
+    if low_memory:
+        # Transactions are aggregated by department first, see run_pipeline
+        by_transaction, _ = stage_cache.checkpoint(
+            "dvf_grid_transactions",
+            stages.dvf_by_transaction_parts(
+                dvf_parquet_dir,
+                years=dvf_years,
+                coordinates=True,
+                max_part_bytes=_max_part_bytes(memory_budget_mb),
+            ),
+            inputs=[dvf_gz_path],
+            params=stages.dvf_transaction_params(dvf_years),
+        )
+        grid_stats, _ = stage_cache.checkpoint(
+            "dvf_grid_stats",
+            stages.dvf_grid_stats(
+                dvf_parquet_dir,
+                grid,
+                grid_km,
+                min_sales,
+                dvf_years,
+                by_transaction=by_transaction,
+            ),
+            inputs=[dvf_gz_path],
+            params=grid_stats_params,
+        )
+    else:
+        # Binned straight from the DVF scan, streamed in one pass
+        grid_stats, _ = stage_cache.cached(
+            "dvf_grid_stats",
+            lambda: stages.dvf_grid_stats(
+                dvf_parquet_dir, grid, grid_km, min_sales, dvf_years
+            ).collect(engine=engine),
+            inputs=[dvf_gz_path],
+            params=grid_stats_params,
+        )
+
+    label_mapping, (bpe_by_commune, _) = _bpe_by_commune(
+        stage_cache, *bpe_files, facility_types
+    )
+    if facility_points_file is not None:
+        facility_points = load_facility_points(facility_points_file, label_mapping)
+    else:
+        # Without geolocated facilities, they sit at their commune centre
+        facility_points = facility_points_from_counts(
+            stages.bpe_with_gps(bpe_by_commune, communes_path),
+            list(label_mapping.values()),
+        )
+
+    return stages.grid_with_distances(
+        grid_stats, facility_points, list(label_mapping.values()), metric
+    )
+
+
+def _write_output(
+    dataset: pl.LazyFrame,
+    output_file: Path,
+    output_format: str,
+    engine: str,
+    start: float,
+) -> dict:
+    """Sink the dataset with write_dataset and report it."""
+    with profiling.span("final_dataset") as record:
+        output_schema = write_dataset(dataset, output_file, output_format, engine)
+        record["rows_out"] = output_schema["rows"]
+
+    print(f"Final dataset with distances saved to {output_file} ({output_format})")
+    print(f"Shape: ({output_schema['rows']}, {len(output_schema['columns'])})")
+    print(f"Pipeline completed in {time.perf_counter() - start:.1f}s")
+
+    return output_schema
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """Command line interface of the tableau-storytelling script."""
+    parser = argparse.ArgumentParser(
+        prog="tableau-storytelling",
+        description="DVF x BPE pipeline producing the Tableau dataset.",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run = subparsers.add_parser(
+        "run", help="Run the whole pipeline headless and write the final dataset"
+    )
+    run.add_argument(
+        "--data-dir",
+        type=Path,
+        default=setup_data_directory(),
+        help="Dataset and cache directory (default: %(default)s)",
+    )
+    run.add_argument(
+        "--output",
+        type=Path,
+        default=None,
+        help="Final dataset path (default: DATA_DIR/final_dataset, or panel_dataset "
+        "with --panel, + format suffix)",
+    )
+    run.add_argument(
+        "--format",
+        choices=OUTPUT_FORMATS,
+        default="csv",
+        help="Final dataset format, typed formats keep dtypes and "
+        "dictionary-encode commune codes (default: %(default)s)",
+    )
+    run.add_argument("--min-sales", type=int, default=DEFAULT_MIN_SALES)
+    run.add_argument("--years-between", type=int, default=DEFAULT_YEARS_BETWEEN)
+    run.add_argument(
+        "--grid",
+        choices=GRID_SHAPES,
+        default=None,
+        help="Write price statistics and facility distances per square or "
+        "hexagonal cell and year instead of per commune",
+    )
+    run.add_argument(
+        "--grid-km",
+        type=float,
+        nargs="+",
+        default=DEFAULT_GRID_KM,
+        metavar="KM",
+        help="Cell sizes of --grid, all binned in one pass (default: %(default)s)",
+    )
+    run.add_argument(
+        "--panel",
+        action="store_true",
+        help="Aggregate every DVF year and write the growth of every commune "
+        "between every pair of years (one row per commune and window)",
+    )
+    run.add_argument(
+        "--min-growth-percent", type=float, default=DEFAULT_MIN_GROWTH_PERCENT
+    )
+    run.add_argument(
+        "--max-growth-percent", type=float, default=DEFAULT_MAX_GROWTH_PERCENT
+    )
+    run.add_argument(
+        "--facility-types",
+        nargs="+",
+        default=DEFAULT_FACILITY_TYPES,
+        metavar="CODE",
+        help="BPE facility codes (default: the 10 essential services)",
+    )
+    run.add_argument(
+        "--metric",
+        choices=sorted(DISTANCE_METRICS),
+        default=DEFAULT_DISTANCE_METRIC,
+        help="Distance metric (default: %(default)s)",
+    )
+    run.add_argument(
+        "--engine",
+        choices=COLLECT_ENGINES,
+        default="streaming",
+        help="Polars engine for the DVF stages (default: %(default)s)",
+    )
+    run.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Revalidate downloaded files against the servers",
+    )
+    run.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Re-aggregate only the DVF year/department partitions that changed",
+    )
+    run.add_argument(
+        "--median-accuracy",
+        type=float,
+        default=None,
+        metavar="ALPHA",
+        help="Approximate medians with mergeable sketches within this relative "
+        "error (e.g. 0.005), exact by default",
+    )
+    run.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Aggregate DVF by department on this many processes",
+    )
+    run.add_argument(
+        "--shard-dir",
+        type=Path,
+        default=None,
+        help="Department shard directory, may be shared with `shard` workers "
+        "(default: DATA_DIR/dvf_shards)",
+    )
+    run.add_argument(
+        "--facility-points",
+        type=Path,
+        default=None,
+        metavar="FILE",
+        help="Geolocated BPE file (TYPEQU, DEPCOM, LATITUDE, LONGITUDE), "
+        "distances then go to the nearest actual facility",
+    )
+    run.add_argument(
+        "--knn",
+        type=int,
+        nargs="+",
+        default=None,
+        metavar="N",
+        help="Add the distance to the N-th nearest facility of each type",
+    )
+    run.add_argument(
+        "--radius-km",
+        type=float,
+        nargs="+",
+        default=None,
+        metavar="R",
+        help="Add the number of facilities of each type within R km",
+    )
+    run.add_argument(
+        "--nearest-commune",
+        action="store_true",
+        help="Add the commune of the nearest facility of each type",
+    )
+    run.add_argument(
+        "--profile",
+        type=Path,
+        default=None,
+        metavar="TRACE",
+        help="Write a Chrome trace of every stage to this JSON file and print "
+        "a per-stage summary",
+    )
+    run.add_argument("--no-cache", action="store_true", help="Recompute every stage")
+    run.add_argument(
+        "--low-memory",
+        action="store_true",
+        help="Stream the transaction-level DVF stages through Parquet "
+        "checkpoints instead of holding them in memory, and print the peak "
+        "memory of every stage",
+    )
+    run.add_argument(
+        "--memory-budget",
+        type=float,
+        default=None,
+        metavar="MB",
+        help="Resident memory the run should fit in, implies --low-memory: "
+        "the DVF transactions are aggregated in parts sized from it, and the "
+        "stage taking memory above it fails with MemoryError",
+    )
+
+    shard = subparsers.add_parser(
+        "shard",
+        help="Aggregate unclaimed DVF departments into a shared shard directory",
+    )
+    shard.add_argument(
+        "--data-dir",
+        type=Path,
+        default=setup_data_directory(),
+        help="Directory holding the converted dvf_parquet dataset "
+        "(default: %(default)s)",
+    )
+    shard.add_argument(
+        "--shard-dir",
+        type=Path,
+        default=None,
+        help="Department shard directory (default: DATA_DIR/dvf_shards)",
+    )
+    shard.add_argument("--workers", type=int, default=None)
+    shard.add_argument(
+        "--median-accuracy",
+        type=float,
+        default=None,
+        metavar="ALPHA",
+        help="Write price sketches of this relative error, the --median-accuracy "
+        "of the run the shards are for",
+    )
+
+    return parser
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = build_parser().parse_args(argv)
+
+    if args.command == "run":
+        # Stages are profiled to check the budget and report peak memory,
+        # traced functions only when a trace is asked for
+        profile = (
+            args.profile is not None
+            or args.low_memory
+            or args.memory_budget is not None
+        )
+        if profile:
+            profiling.enable(
+                functions=args.profile is not None, max_rss_mb=args.memory_budget
+            )
+        try:
+            run_pipeline(
+                args.data_dir,
+                args.output
+                or default_output_path(
+                    args.data_dir,
+                    args.format,
+                    "grid_dataset"
+                    if args.grid
+                    else "panel_dataset"
+                    if args.panel
+                    else "final_dataset",
+                ),
+                output_format=args.format,
+                min_sales=args.min_sales,
+                years_between=args.years_between,
+                min_growth_percent=args.min_growth_percent,
+                max_growth_percent=args.max_growth_percent,
+                facility_types=args.facility_types,
+                metric=args.metric,
+                engine=args.engine,
+                refresh=args.refresh,
+                use_cache=not args.no_cache,
+                incremental=args.incremental,
+                median_accuracy=args.median_accuracy,
+                workers=args.workers,
+                shard_dir=args.shard_dir,
+                facility_points_file=args.facility_points,
+                knn=args.knn,
+                radii_km=args.radius_km,
+                nearest_commune=args.nearest_commune,
+                panel=args.panel,
+                grid=args.grid,
+                grid_km=args.grid_km,
+                low_memory=args.low_memory or args.memory_budget is not None,
+                memory_budget_mb=args.memory_budget,
+            )
+        finally:
+            if profile:
+                records = profiling.disable()
+                profiling.print_summary(records)
+            if args.profile is not None:
+                profiling.write_chrome_trace(records, args.profile)
+                print(f"Trace written to {args.profile}")
+    elif args.command == "shard":
+        run_shards(
+            args.data_dir / "dvf_parquet",
+            args.shard_dir or args.data_dir / "dvf_shards",
+            args.workers,
+            median_accuracy=args.median_accuracy,
+        )
+
+
+if __name__ == "__main__":
+    main()
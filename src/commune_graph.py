@@ -0,0 +1,343 @@
+"""
+Persistent neighbour graph of all communes.
+
+The commune set of communes.csv almost never changes, yet every distance
+stage used to rebuild its geometry from scratch, once per facility type.
+Here the k nearest communes and the communes within a radius of each
+commune centre are computed once, stored as CSR arrays (row pointers,
+neighbour rows, distances in km, neighbours sorted by distance) and loaded
+back with np.load(mmap_mode="r"): loading is zero-copy and every process
+reading the graph shares the same pages of the OS cache.
+
+A graph is stored under graph_dir/<key>, the key hashing the content of the
+communes file, the metric and the graph sizes, so a new communes file or
+metric builds a new graph and never reads a stale one. Rows are the located
+communes sorted by code, a commune is not its own neighbour.
+
+Distance features then become sparse lookups: the nearest commune holding a
+facility is the first flagged neighbour of the kNN list, and counts (or any
+sum, e.g. smoothed prices as sum of prices / sum of ones) within a radius
+are sums over the radius list.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+import polars as pl
+from scipy.spatial import cKDTree
+
+from src.facilities import KM_TO_PROJECTED
+from src.profiling import traced
+from src.schemas import COMMUNES_COLUMNS, scan_typed_csv
+from src.utils import DISTANCE_METRICS, content_hash
+
+# Bumped whenever the stored layout changes, older graphs are rebuilt
+GRAPH_VERSION = 1
+GRAPH_MANIFEST = "graph.json"
+COMMUNE_GRAPH_DIR = "commune_graph"
+DEFAULT_GRAPH_K = 32
+DEFAULT_GRAPH_RADIUS_KM = 10.0
+
+GRAPH_ARRAYS = (
+    "codes",
+    "points",
+    "knn_indptr",
+    "knn_indices",
+    "knn_distances",
+    "radius_indptr",
+    "radius_indices",
+    "radius_distances",
+)
+
+
+class CommuneGraph(NamedTuple):
+    """
+    Memory-mapped neighbour graph, see load_commune_graph.
+
+    codes holds the code_commune of each row (sorted), points the projected
+    centres of the metric. The kNN and radius lists of row i are
+    indices[indptr[i]:indptr[i + 1]], at distances[...] km.
+    """
+
+    metric: str
+    radius_km: float
+    codes: np.ndarray
+    points: np.ndarray
+    knn_indptr: np.ndarray
+    knn_indices: np.ndarray
+    knn_distances: np.ndarray
+    radius_indptr: np.ndarray
+    radius_indices: np.ndarray
+    radius_distances: np.ndarray
+
+
+def _csr_indptr(rows: np.ndarray, count: int) -> np.ndarray:
+    return np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=count))])
+
+
+@traced
+def build_commune_graph(
+    communes_path: Path,
+    graph_dir: Path,
+    metric: str = "flat",
+    k: int = DEFAULT_GRAPH_K,
+    radius_km: float = DEFAULT_GRAPH_RADIUS_KM,
+) -> Path:
+    """
+    Build the neighbour graph of the communes, unless it is already stored.
+
+    Args:
+        communes_path: Communes file providing the commune centres
+        graph_dir: Directory holding the graphs, one subdirectory each
+        metric: Distance metric, one of DISTANCE_METRICS
+        k: Number of nearest communes kept per commune
+        radius_km: Radius of the neighbour lists in km
+
+    Returns:
+        Directory of the graph, to pass to load_commune_graph
+    """
+    if metric not in DISTANCE_METRICS:
+        raise ValueError(
+            f"Unknown metric {metric!r}, expected one of {list(DISTANCE_METRICS)}"
+        )
+    if k < 1 or radius_km <= 0:
+        raise ValueError(f"k and radius_km must be positive, got {k!r}, {radius_km!r}")
+
+    params = {
+        "communes": content_hash(communes_path),
+        "metric": metric,
+        "k": k,
+        "radius_km": radius_km,
+        "version": GRAPH_VERSION,
+    }
+    key = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+    graph_path = graph_dir / key[:32]
+    if (graph_path / GRAPH_MANIFEST).exists():
+        return graph_path
+
+    print(
+        f"Building the commune neighbour graph ({metric}, k={k}, {radius_km:g} km)..."
+    )
+    project, to_km = DISTANCE_METRICS[metric]
+    communes = (
+        scan_typed_csv(communes_path, COMMUNES_COLUMNS)
+        .select(
+            pl.col("code_insee").cast(pl.String),
+            "latitude_centre",
+            "longitude_centre",
+        )
+        .drop_nulls()
+        .unique("code_insee", keep="first")
+        .sort("code_insee")
+        .collect()
+    )
+    count = len(communes)
+    if not count:
+        raise ValueError(f"No commune of {communes_path} has a centre")
+    points = project(
+        communes.select(["latitude_centre", "longitude_centre"]).to_numpy()
+    )
+    tree = cKDTree(points)
+
+    # k + 1 nearest, then each commune is removed from its own list (the
+    # last neighbour goes if co-located communes pushed it out). A single
+    # commune gets k = 0: it is queried for 2 (k=1 returns 1-d arrays), its
+    # missing neighbour comes back as index count and is dropped
+    k = min(k, count - 1)
+    distances, indices = tree.query(points, k=max(k, 1) + 1, workers=-1)
+    distances, indices = distances.reshape(count, -1), indices.reshape(count, -1)
+    kept = (indices != np.arange(count)[:, None]) & (indices < count)
+    kept[kept.all(axis=1), -1] = False
+
+    # Every pair within the radius, ordered by row then distance
+    pairs = tree.sparse_distance_matrix(
+        tree, KM_TO_PROJECTED[metric](radius_km), output_type="ndarray"
+    )
+    pairs = pairs[pairs["i"] != pairs["j"]]
+    pairs = pairs[np.lexsort((pairs["v"], pairs["i"]))]
+
+    arrays = {
+        "codes": communes["code_insee"].to_numpy().astype(str),
+        "points": points,
+        "knn_indptr": (
+            np.arange(0, count * k + 1, k, dtype=np.int64)
+            if k
+            else np.zeros(count + 1, dtype=np.int64)
+        ),
+        "knn_indices": indices[kept].astype(np.int32),
+        "knn_distances": to_km(distances[kept]),
+        "radius_indptr": _csr_indptr(pairs["i"], count),
+        "radius_indices": pairs["j"].astype(np.int32),
+        "radius_distances": to_km(pairs["v"]),
+    }
+
+    # Written aside then renamed, a concurrent build of the same graph wins
+    # or loses as a whole
+    graph_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = Path(tempfile.mkdtemp(dir=graph_dir, prefix=".tmp-"))
+    for name, array in arrays.items():
+        np.save(tmp_path / f"{name}.npy", array)
+    manifest = {**params, "communes_file": communes_path.name, "rows": count}
+    manifest["edges"] = {"knn": count * k, "radius": len(pairs)}
+    (tmp_path / GRAPH_MANIFEST).write_text(json.dumps(manifest, indent=2) + "\n")
+    try:
+        os.rename(tmp_path, graph_path)
+    except OSError:
+        if not (graph_path / GRAPH_MANIFEST).exists():
+            raise
+        shutil.rmtree(tmp_path)
+
+    print(f"Commune graph: {count:,} communes, {len(pairs):,} pairs within the radius")
+    return graph_path
+
+
+def load_commune_graph(graph_path: Path) -> CommuneGraph:
+    """Memory-map a graph written by build_commune_graph, nothing is copied."""
+    manifest = json.loads((graph_path / GRAPH_MANIFEST).read_text())
+    return CommuneGraph(
+        metric=manifest["metric"],
+        radius_km=manifest["radius_km"],
+        **{
+            name: np.load(graph_path / f"{name}.npy", mmap_mode="r")
+            for name in GRAPH_ARRAYS
+        },
+    )
+
+
+def commune_graph(
+    communes_path: Path,
+    graph_dir: Path,
+    metric: str = "flat",
+    k: int = DEFAULT_GRAPH_K,
+    radius_km: float = DEFAULT_GRAPH_RADIUS_KM,
+) -> CommuneGraph:
+    """Load the graph of the communes file, building it on first use."""
+    return load_commune_graph(
+        build_commune_graph(communes_path, graph_dir, metric, k, radius_km)
+    )
+
+
+def graph_rows(graph: CommuneGraph, codes: np.ndarray) -> np.ndarray:
+    """Graph row of each code_commune, -1 for communes without a centre."""
+    codes = np.asarray(codes, dtype=str)
+    rows = np.searchsorted(graph.codes, codes)
+    found = rows < len(graph.codes)
+    found[found] = graph.codes[rows[found]] == codes[found]
+    return np.where(found, rows, -1)
+
+
+def nearest_flagged(graph: CommuneGraph, flagged: np.ndarray) -> np.ndarray:
+    """
+    Distance in km from every commune to the nearest flagged commune.
+
+    Read from the kNN lists, only the communes without a flagged neighbour
+    among them fall back to a KD-tree over the flagged centres.
+
+    Args:
+        graph: Commune graph
+        flagged: Boolean array over the graph rows
+
+    Returns:
+        Distances over the graph rows, 0 for flagged communes, NaN if no
+        commune is flagged
+    """
+    distances = np.full(len(graph.codes), np.nan)
+    if not flagged.any():
+        return distances
+
+    if len(graph.knn_indices):
+        neighbours = graph.knn_indices.reshape(len(graph.codes), -1)
+        hits = flagged[neighbours]
+        first = hits.argmax(axis=1)
+        found = hits[np.arange(len(first)), first]
+        distances[found] = graph.knn_distances.reshape(len(first), -1)[
+            found, first[found]
+        ]
+    distances[flagged] = 0.0
+
+    missing = np.isnan(distances)
+    if missing.any():
+        _, to_km = DISTANCE_METRICS[graph.metric]
+        tree = cKDTree(graph.points[flagged])
+        nearest, _ = tree.query(graph.points[missing], k=1, workers=-1)
+        distances[missing] = to_km(nearest)
+
+    return distances
+
+
+def radius_sum(graph: CommuneGraph, values: np.ndarray, radius_km: float) -> np.ndarray:
+    """
+    Sum of values over each commune and its neighbours within radius_km.
+
+    Args:
+        graph: Commune graph
+        values: Numeric array over the graph rows
+        radius_km: Radius in km, at most the radius the graph was built with
+
+    Returns:
+        Float64 sums over the graph rows
+    """
+    if radius_km > graph.radius_km:
+        raise ValueError(
+            f"Radius {radius_km:g} km exceeds the graph radius {graph.radius_km:g} km"
+        )
+    within = graph.radius_distances <= radius_km
+    rows = np.repeat(np.arange(len(graph.codes)), np.diff(graph.radius_indptr))
+    return values + np.bincount(
+        rows[within],
+        weights=values[graph.radius_indices[within]],
+        minlength=len(graph.codes),
+    )
+
+
+@traced
+def graph_radius_counts(
+    dataset: pl.LazyFrame,
+    graph: CommuneGraph,
+    facility_codes: list[str],
+    radii_km: list[float],
+) -> pl.LazyFrame:
+    """
+    Facilities within each radius of the commune centres, from the graph.
+
+    Counts the facilities of the communes whose centre is within the radius,
+    like the batch queries over facility_points_from_counts.
+
+    Args:
+        dataset: LazyFrame with columns [code_commune, *facility_codes]
+        graph: Commune graph, built with a radius of at least max(radii_km)
+        facility_codes: Facility count columns
+        radii_km: Radii r of the count_{facility}_within_{r}km columns (UInt32)
+
+    Returns:
+        dataset with the added columns, null for communes without a centre
+    """
+    collected = dataset.collect()
+    communes = collected.select(["code_commune", *facility_codes]).unique()
+    rows = graph_rows(graph, communes["code_commune"].cast(pl.String).to_numpy())
+    located = rows >= 0
+
+    columns = []
+    for facility_code in facility_codes:
+        values = np.zeros(len(graph.codes))
+        values[rows[located]] = communes[facility_code].fill_null(0).to_numpy()[located]
+        for radius in radii_km:
+            counts = np.zeros(len(communes), dtype=np.uint32)
+            counts[located] = radius_sum(graph, values, radius)[rows[located]]
+            columns.append(
+                pl.Series(
+                    f"count_{facility_code}_within_{radius:g}km",
+                    counts,
+                    dtype=pl.UInt32,
+                ).scatter(np.flatnonzero(~located), None)
+            )
+
+    counts_complete = communes.select("code_commune").with_columns(columns)
+
+    return collected.lazy().join(counts_complete.lazy(), on="code_commune", how="left")
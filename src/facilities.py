@@ -0,0 +1,297 @@
+"""
+Distances from communes to individual, geolocated facilities.
+
+The default distances (calculate_nearest_facility_distances) go from commune
+centre to commune centre, and a commune holding a facility is at 0 km. With
+the geolocated BPE (one row per facility, hundreds of thousands to millions
+of points) every commune instead gets its true distance to the nearest
+facility. Each facility type gets one KD-tree, built in O(M log M) and
+queried for all communes at once, so memory stays linear in the points.
+
+The same index answers batch queries (calculate_facility_queries): k-th
+nearest distances, code_commune of the nearest facility and facility counts
+within a radius, for every commune and type from a single build. Commune
+facility counts can stand in for geolocated points through
+facility_points_from_counts.
+"""
+
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+from scipy.spatial import cKDTree
+
+from src.profiling import traced
+from src.schemas import FACILITY_POINTS_TYPES, scan_typed_csv
+from src.utils import DISTANCE_METRICS, EARTH_RADIUS_KM, KM_PER_DEGREE
+
+# Geolocated BPE column -> name used here
+FACILITY_POINTS_COLUMNS = {
+    "TYPEQU": "facility",
+    "DEPCOM": "code_commune",
+    "LATITUDE": "latitude",
+    "LONGITUDE": "longitude",
+}
+
+# Radius in km -> radius in the projected space of each metric
+KM_TO_PROJECTED = {
+    "flat": lambda km: km / KM_PER_DEGREE,
+    "haversine": lambda km: 2 * np.sin(km / (2 * EARTH_RADIUS_KM)),
+}
+
+
+@traced
+def load_facility_points(
+    points_path: Path,
+    label_mapping: dict[str, str],
+    columns: dict[str, str] | None = None,
+    separator: str = ";",
+) -> pl.DataFrame:
+    """
+    Load metropolitan facility coordinates of the selected types.
+
+    Args:
+        points_path: Geolocated BPE file, CSV (optionally .gz) or Parquet
+        label_mapping: Facility code -> label, as from facility_label_mapping;
+            only these types are kept and they are renamed to their label
+        columns: Source column -> facility / code_commune / latitude /
+            longitude, FACILITY_POINTS_COLUMNS by default
+        separator: CSV field separator
+
+    Returns:
+        One row per facility: facility (label), code_commune, latitude, longitude
+    """
+    columns = columns or FACILITY_POINTS_COLUMNS
+
+    if points_path.suffix == ".parquet":
+        scan = pl.scan_parquet(points_path)
+    else:
+        scan = scan_typed_csv(
+            points_path,
+            {
+                source: FACILITY_POINTS_TYPES[target]
+                for source, target in columns.items()
+            },
+            separator=separator,
+        )
+
+    return (
+        scan.select(list(columns))
+        .rename(columns)
+        .cast(FACILITY_POINTS_TYPES)
+        .filter(pl.col("facility").is_in(list(label_mapping)))
+        .filter(
+            ~pl.col("code_commune").cat.starts_with("97")
+            & ~pl.col("code_commune").cat.starts_with("98")
+        )
+        .drop_nulls(["latitude", "longitude"])
+        .with_columns(pl.col("facility").replace_strict(label_mapping))
+        .collect()
+    )
+
+
+@traced
+def facility_points_from_counts(
+    bpe_with_gps: pl.DataFrame | pl.LazyFrame, facility_columns: list[str]
+) -> pl.DataFrame:
+    """
+    Use commune centres as facility points, one per counted facility.
+
+    Lets the batch queries run without the geolocated BPE: a commune with
+    three pharmacies yields three points at its centre, so radius counts and
+    k-th nearest distances count facilities, not communes.
+
+    Args:
+        bpe_with_gps: Output of bpe_with_gps (counts and coordinates)
+        facility_columns: Facility labels (count columns) to convert
+
+    Returns:
+        Rows like load_facility_points: facility, code_commune, latitude, longitude
+    """
+    return (
+        bpe_with_gps.lazy()
+        .unpivot(
+            on=facility_columns,
+            index=["code_commune", "latitude", "longitude"],
+            variable_name="facility",
+            value_name="count",
+        )
+        .filter(pl.col("count") > 0)
+        .drop_nulls(["latitude", "longitude"])
+        .select(
+            pl.col(["facility", "code_commune", "latitude", "longitude"]).repeat_by(
+                pl.col("count")
+            )
+        )
+        .explode(["facility", "code_commune", "latitude", "longitude"])
+        .collect()
+    )
+
+
+@traced
+def build_facility_index(
+    facility_points: pl.DataFrame, facilities: list[str], metric: str = "flat"
+) -> dict[str, tuple[cKDTree, np.ndarray] | None]:
+    """
+    Build one KD-tree per facility type, in projected coordinates.
+
+    Args:
+        facility_points: Output of load_facility_points
+        facilities: Facility labels to index
+        metric: Distance metric, one of DISTANCE_METRICS
+
+    Returns:
+        (KD-tree, code_commune of each indexed point) by facility label, None
+        for types without any point
+    """
+    if metric not in DISTANCE_METRICS:
+        raise ValueError(
+            f"Unknown metric {metric!r}, expected one of {list(DISTANCE_METRICS)}"
+        )
+    project, _ = DISTANCE_METRICS[metric]
+
+    index = {}
+    for facility, points in facility_points.partition_by(
+        "facility", as_dict=True, include_key=False
+    ).items():
+        if facility[0] in facilities:
+            coordinates = project(points.select(["latitude", "longitude"]).to_numpy())
+            # Unbalanced, non-compacted trees build about twice as fast on
+            # millions of points and answer nearest queries nearly as quickly
+            tree = cKDTree(coordinates, balanced_tree=False, compact_nodes=False)
+            index[facility[0]] = (tree, points["code_commune"].to_numpy())
+
+    return {facility: index.get(facility) for facility in facilities}
+
+
+@traced
+def calculate_facility_queries(
+    dataset: pl.LazyFrame,
+    facility_points: pl.DataFrame,
+    facilities: list[str],
+    metric: str = "flat",
+    k: list[int] | tuple[int, ...] = (1,),
+    radii_km: list[float] | tuple[float, ...] = (),
+    nearest_commune: bool = False,
+    key: list[str] | None = None,
+) -> pl.LazyFrame:
+    """
+    Answer kNN, nearest-provider and radius-count queries in one batch.
+
+    Each facility type is indexed once, then every commune centre is queried
+    for the max(k) nearest points (giving all k-th distances and the nearest
+    provider at once) and for the points within each radius.
+
+    Args:
+        dataset: LazyFrame with columns [*key, latitude, longitude]
+        facility_points: Output of load_facility_points or
+            facility_points_from_counts
+        facilities: Facility labels to query
+        metric: Distance metric, one of DISTANCE_METRICS
+        k: Ranks n of the distance_{facility}_k{n} columns (Float64, km)
+        radii_km: Radii r of the count_{facility}_within_{r}km columns (UInt32)
+        nearest_commune: Add nearest_commune_{facility} (String), the
+            code_commune of the nearest facility
+        key: Columns identifying a query point, ["code_commune"] by default
+            (e.g. grid cells, see src.grid)
+
+    Returns:
+        dataset with the added columns, null for points without
+        coordinates, and null distances / providers when a type has fewer
+        than n points
+    """
+    if any(n < 1 for n in k):
+        raise ValueError(f"k must contain ranks >= 1, got {k!r}")
+
+    index = build_facility_index(facility_points, facilities, metric)
+    project, to_km = DISTANCE_METRICS[metric]
+    to_projected = KM_TO_PROJECTED[metric]
+
+    key = key or ["code_commune"]
+    collected = dataset.collect()
+    communes = collected.select([*key, "latitude", "longitude"]).unique()
+    located = (
+        communes["latitude"].is_not_null() & communes["longitude"].is_not_null()
+    ).to_numpy()
+    points = project(
+        communes.filter(pl.Series(located)).select(["latitude", "longitude"]).to_numpy()
+    )
+    max_k = max([*k, 1 if nearest_commune else 0], default=0)
+
+    columns = []
+    for facility in facilities:
+        tree, codes = index[facility] or (None, np.array([], dtype=object))
+
+        if max_k:
+            # Missing neighbours (fewer than max_k points) stay NaN -> null
+            distances = np.full((len(communes), max_k), np.nan)
+            neighbours = np.full((len(communes), max_k), -1)
+            if tree is not None:
+                raw, indices = tree.query(points, k=[*range(1, max_k + 1)], workers=-1)
+                found = np.isfinite(raw)
+                raw[found] = to_km(raw[found])
+                raw[~found] = np.nan
+                distances[located], neighbours[located] = raw, indices
+
+            for n in k:
+                columns.append(
+                    pl.Series(
+                        f"distance_{facility}_k{n}",
+                        distances[:, n - 1],
+                        nan_to_null=True,
+                    )
+                )
+            if nearest_commune:
+                found = ~np.isnan(distances[:, 0])
+                nearest = np.full(len(communes), None, dtype=object)
+                nearest[found] = codes[neighbours[found, 0]]
+                columns.append(
+                    pl.Series(
+                        f"nearest_commune_{facility}", nearest.tolist(), dtype=pl.String
+                    )
+                )
+
+        for radius in radii_km:
+            counts = np.zeros(len(communes), dtype=np.uint32)
+            if tree is not None:
+                counts[located] = tree.query_ball_point(
+                    points, to_projected(radius), return_length=True, workers=-1
+                )
+            columns.append(
+                pl.Series(
+                    f"count_{facility}_within_{radius:g}km", counts, dtype=pl.UInt32
+                ).scatter(np.flatnonzero(~located), None)
+            )
+
+    queries = communes.select(key).with_columns(columns)
+
+    return collected.lazy().join(queries.lazy(), on=key, how="left")
+
+
+@traced
+def calculate_nearest_point_distances(
+    dataset: pl.LazyFrame,
+    facility_points: pl.DataFrame,
+    facilities: list[str],
+    metric: str = "flat",
+    key: list[str] | None = None,
+) -> pl.LazyFrame:
+    """
+    Distance in km from each commune centre to the nearest facility point.
+
+    Args:
+        dataset: LazyFrame with columns [*key, latitude, longitude]
+        facility_points: Output of load_facility_points
+        facilities: Facility labels to compute distances for
+        metric: Distance metric, one of DISTANCE_METRICS
+        key: Columns identifying a query point, ["code_commune"] by default
+
+    Returns:
+        dataset with added columns distance_{facility}, null for communes
+        without coordinates and for types without any point
+    """
+    return calculate_facility_queries(
+        dataset, facility_points, facilities, metric=metric, k=[1], key=key
+    ).rename(
+        {f"distance_{facility}_k1": f"distance_{facility}" for facility in facilities}
+    )
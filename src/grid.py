@@ -0,0 +1,197 @@
+"""
+Sub-commune grid cells of DVF transactions.
+
+Commune statistics hide the variation inside Paris, Lyon and Marseille
+arrondissements and inside large rural communes. Here transactions are
+binned by their own coordinates into square or hexagonal cells, at several
+resolutions at once.
+
+Coordinates are projected with the sinusoidal projection (x = R·λ·cos φ,
+y = R·φ), which preserves areas: a cell covers the same ground area
+anywhere in France. Cell ids are Polars expressions, so binning streams
+with the DVF scan, and all resolutions come from the same pass: the
+projected transactions are computed once and every resolution adds its
+cell ids to them before a single group-by.
+
+A cell is identified by (resolution_km, cell_x, cell_y), its integer
+coordinates on the grid of that resolution (axial q, r for hexagons), and
+carries the latitude/longitude of its centre for maps and distances. A
+hexagon of resolution s has the area of the s × s square, so both shapes
+compare at the same resolution.
+"""
+
+import math
+
+import polars as pl
+
+from src.utils import EARTH_RADIUS_KM
+
+GRID_SHAPES = ("square", "hex")
+DEFAULT_GRID_KM = [0.5, 2.0, 10.0]
+GRID_KEYS = ["resolution_km", "cell_x", "cell_y"]
+
+# Circumradius of the hexagon with the area of the unit square
+HEX_RADIUS_PER_KM = math.sqrt(2 / (3 * math.sqrt(3)))
+
+
+def _check_grid(shape: str, resolutions_km: list[float]) -> None:
+    if shape not in GRID_SHAPES:
+        raise ValueError(f"Unknown grid shape {shape!r}, expected one of {GRID_SHAPES}")
+    if not resolutions_km or any(size <= 0 for size in resolutions_km):
+        raise ValueError(
+            f"Grid resolutions must be positive km, got {resolutions_km!r}"
+        )
+
+
+def project(latitude: pl.Expr, longitude: pl.Expr) -> tuple[pl.Expr, pl.Expr]:
+    """Sinusoidal projection of degrees to (x, y) in km."""
+    return (
+        longitude.radians() * latitude.radians().cos() * EARTH_RADIUS_KM,
+        latitude.radians() * EARTH_RADIUS_KM,
+    )
+
+
+def _unproject(x: pl.Expr, y: pl.Expr) -> tuple[pl.Expr, pl.Expr]:
+    """Inverse of project, (x, y) in km to (latitude, longitude) in degrees."""
+    latitude = y / EARTH_RADIUS_KM
+    return (
+        latitude.degrees(),
+        (x / (EARTH_RADIUS_KM * latitude.cos())).degrees(),
+    )
+
+
+def cell_ids(
+    shape: str, size_km: float, x: pl.Expr, y: pl.Expr
+) -> tuple[pl.Expr, pl.Expr]:
+    """
+    Cell coordinates of points on the grid of one resolution.
+
+    Args:
+        shape: One of GRID_SHAPES
+        size_km: Side of the square cells (hexagons of the same area)
+        x: Projected x of the points in km, see project
+        y: Projected y of the points in km
+
+    Returns:
+        (cell_x, cell_y) Int32 expressions, axial (q, r) for hexagons
+    """
+    _check_grid(shape, [size_km])
+
+    if shape == "square":
+        cell_x, cell_y = (x / size_km).floor(), (y / size_km).floor()
+    else:
+        # Pointy-top hexagons: fractional axial coordinates, then the cube
+        # coordinate with the largest rounding error is rebuilt from the
+        # other two so that q + r + s stays 0
+        radius = size_km * HEX_RADIUS_PER_KM
+        q = (math.sqrt(3) / 3 * x - y / 3) / radius
+        r = 2 / 3 * y / radius
+        s = -q - r
+        q_round, r_round, s_round = q.round(), r.round(), s.round()
+        q_error, r_error, s_error = (
+            (q_round - q).abs(),
+            (r_round - r).abs(),
+            (s_round - s).abs(),
+        )
+        cell_x = (
+            pl.when((q_error > r_error) & (q_error > s_error))
+            .then(-r_round - s_round)
+            .otherwise(q_round)
+        )
+        cell_y = (
+            pl.when((q_error > r_error) & (q_error > s_error))
+            .then(r_round)
+            .when(r_error > s_error)
+            .then(-q_round - s_round)
+            .otherwise(r_round)
+        )
+
+    return cell_x.cast(pl.Int32).alias("cell_x"), cell_y.cast(pl.Int32).alias("cell_y")
+
+
+def cell_centres(shape: str) -> tuple[pl.Expr, pl.Expr]:
+    """Latitude and longitude of the centre of (resolution_km, cell_x, cell_y)."""
+    size = pl.col("resolution_km")
+    if shape == "square":
+        x = (pl.col("cell_x") + 0.5) * size
+        y = (pl.col("cell_y") + 0.5) * size
+    else:
+        radius = size * HEX_RADIUS_PER_KM
+        x = radius * math.sqrt(3) * (pl.col("cell_x") + pl.col("cell_y") / 2)
+        y = radius * 1.5 * pl.col("cell_y")
+
+    latitude, longitude = _unproject(x, y)
+    return latitude.alias("latitude"), longitude.alias("longitude")
+
+
+def bin_points(
+    frame: pl.LazyFrame, shape: str, resolutions_km: list[float]
+) -> pl.LazyFrame:
+    """
+    Repeat every located row once per resolution, with its cell.
+
+    The points are projected once and each resolution adds its cell ids to
+    the same rows. Polars caches the shared input, so the frame is read once
+    for all resolutions (concatenating is much faster than exploding a list
+    of cells).
+
+    Args:
+        frame: LazyFrame with latitude and longitude columns (degrees)
+        shape: One of GRID_SHAPES
+        resolutions_km: Cell sizes, see cell_ids
+
+    Returns:
+        The located rows of frame (coordinates dropped) with resolution_km,
+        cell_x and cell_y, len(resolutions_km) times as many rows
+    """
+    _check_grid(shape, resolutions_km)
+    x, y = project(pl.col("latitude"), pl.col("longitude"))
+    projected = (
+        frame.drop_nulls(["latitude", "longitude"])
+        .with_columns(x.alias("x_km"), y.alias("y_km"))
+        .drop(["latitude", "longitude"])
+    )
+
+    return pl.concat(
+        [
+            projected.with_columns(
+                pl.lit(float(size)).alias("resolution_km"),
+                *cell_ids(shape, size, pl.col("x_km"), pl.col("y_km")),
+            ).drop(["x_km", "y_km"])
+            for size in resolutions_km
+        ]
+    )
+
+
+def grid_price_stats(
+    price_per_sqm: pl.LazyFrame,
+    shape: str,
+    resolutions_km: list[float],
+    keys: list[str] | None = None,
+) -> pl.LazyFrame:
+    """
+    Price statistics of every cell, at every resolution, in one group-by.
+
+    Args:
+        price_per_sqm: Transactions with prix_m2, latitude and longitude
+        shape: One of GRID_SHAPES
+        resolutions_km: Cell sizes, see cell_ids
+        keys: Extra grouping columns, ["year"] by default
+
+    Returns:
+        One row per (resolution_km, cell_x, cell_y, *keys) with avg_prix_m2,
+        median_prix_m2, count_sales and the latitude/longitude of the cell
+        centre
+    """
+    keys = ["year"] if keys is None else keys
+
+    return (
+        bin_points(price_per_sqm, shape, resolutions_km)
+        .group_by([*GRID_KEYS, *keys])
+        .agg(
+            pl.col("prix_m2").mean().alias("avg_prix_m2"),
+            pl.col("prix_m2").median().alias("median_prix_m2"),
+            pl.len().alias("count_sales"),
+        )
+        .with_columns(*cell_centres(shape))
+    )
@@ -0,0 +1,222 @@
+"""
+Incremental per-(commune, year) DVF aggregates.
+
+DVF is republished twice a year with most past years unchanged. Instead of
+re-aggregating every year on each refresh, the statistics of each
+(commune, year) group are stored next to the Parquet dataset, one file per
+annee/code_departement partition. A partition is recomputed only when its
+fingerprint, an order-independent hash of its rows, differs from the one
+recorded when it was last aggregated. Only the partitions of the years read
+downstream (the growth years by default) are fingerprinted and stored.
+
+A (commune, year) group never spans two partitions, so a recomputed
+partition simply replaces the stored rows of its communes. With a median
+accuracy, price sketches (src.sketches) are stored instead of statistics and
+merged when scanned back.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+import polars as pl
+
+from src import stages
+from src.sketches import SKETCH_COLUMNS, merge_sketches, sketch_stats
+from src.stage_cache import code_version
+
+AGGREGATES_STATE_FILE = "_state.json"
+AGGREGATES_COLUMNS = [
+    "code_commune",
+    "year",
+    "avg_prix_m2",
+    "median_prix_m2",
+    "count_sales",
+]
+
+
+def _partition_name(annee: int, code_departement: str) -> str:
+    return f"annee={annee}/code_departement={code_departement}"
+
+
+def dvf_partition_fingerprints(
+    dvf_parquet_dir: Path, years: tuple[int, ...] | None = stages.GROWTH_YEARS
+) -> dict[str, str]:
+    """
+    Fingerprint the partitions of the given years, in one pass.
+
+    The fingerprint combines the row count with the wrapping sum of the row
+    hashes, so it ignores row order and row group layout, which may change
+    when the dataset is rebuilt from a new dvf.csv.gz.
+
+    Args:
+        dvf_parquet_dir: DVF Parquet dataset built by convert_dvf_to_parquet
+        years: Years of the partitions, every year if None
+
+    Returns:
+        Fingerprint by partition name (annee=YYYY/code_departement=XX)
+    """
+    scan = stages.dvf_partitions(dvf_parquet_dir, years=None)
+    if years is not None:
+        scan = scan.filter(pl.col("annee").is_in(list(years)))
+    data_columns = [
+        name
+        for name in scan.collect_schema().names()
+        if name not in ("annee", "code_departement")
+    ]
+
+    fingerprints = (
+        scan.group_by(["annee", "code_departement"])
+        .agg(
+            pl.len().alias("rows"),
+            pl.struct(data_columns).hash(seed=0).sum().alias("row_hashes"),
+        )
+        .collect()
+    )
+
+    return {
+        _partition_name(row["annee"], row["code_departement"]): (
+            f"{row['rows']}:{row['row_hashes']:016x}"
+        )
+        for row in fingerprints.iter_rows(named=True)
+    }
+
+
+def _load_state(aggregates_dir: Path) -> dict:
+    state_path = aggregates_dir / AGGREGATES_STATE_FILE
+    if not state_path.exists():
+        return {}
+    return json.loads(state_path.read_text())
+
+
+def _save_state(aggregates_dir: Path, state: dict) -> None:
+    state_path = aggregates_dir / AGGREGATES_STATE_FILE
+    tmp_path = state_path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(state, indent=2, sort_keys=True))
+    os.replace(tmp_path, state_path)
+
+
+def update_dvf_aggregates(
+    dvf_parquet_dir: Path,
+    aggregates_dir: Path,
+    years: tuple[int, ...] | None = stages.GROWTH_YEARS,
+    median_accuracy: float | None = None,
+) -> str:
+    """
+    Bring the stored aggregates up to date with the DVF Parquet dataset.
+
+    Only new or changed partitions are aggregated, all in one collect_all,
+    and their files replaced. Partitions gone from the source, or of years
+    no longer requested, are deleted. Any code or Polars upgrade, or a
+    different median_accuracy, invalidates every partition.
+
+    Args:
+        dvf_parquet_dir: DVF Parquet dataset built by convert_dvf_to_parquet
+        aggregates_dir: Directory holding the stored aggregates
+        years: Years kept in the aggregates, the years scan_dvf_aggregates
+            reads (every year if None)
+        median_accuracy: If set, price sketches of this relative accuracy
+            are stored instead of exact statistics
+
+    Returns:
+        Version of the aggregates, changes whenever any partition does
+        (usable as an upstream stage key)
+    """
+    aggregates_dir.mkdir(parents=True, exist_ok=True)
+    fingerprints = dvf_partition_fingerprints(dvf_parquet_dir, years)
+    version = {
+        "code": code_version(),
+        "polars": pl.__version__,
+        "median_accuracy": median_accuracy,
+    }
+
+    state = _load_state(aggregates_dir)
+    stored = state.get("partitions", {}) if state.get("version") == version else {}
+
+    changed = [name for name, fp in fingerprints.items() if stored.get(name) != fp]
+    removed = [name for name in stored if name not in fingerprints]
+
+    if changed or removed:
+        print(
+            f"DVF aggregates: recomputing {len(changed)} of "
+            f"{len(fingerprints)} partitions, {len(removed)} removed..."
+        )
+        # Forget the touched partitions first, an interrupted update redoes them
+        kept = {
+            name: fp
+            for name, fp in stored.items()
+            if name not in changed and name not in removed
+        }
+        _save_state(aggregates_dir, {"version": version, "partitions": kept})
+
+        for name in changed + removed:
+            shutil.rmtree(aggregates_dir / name, ignore_errors=True)
+
+        plans = []
+        for name in changed:
+            annee, code_departement = (part.split("=")[1] for part in name.split("/"))
+            partition = (pl.col("annee") == int(annee)) & (
+                pl.col("code_departement") == code_departement
+            )
+            if median_accuracy is None:
+                plan = stages.dvf_partition_aggregates(
+                    dvf_parquet_dir, partition, years
+                ).select(AGGREGATES_COLUMNS)
+            else:
+                plan = stages.dvf_partition_sketches(
+                    dvf_parquet_dir, median_accuracy, partition, years
+                ).select(SKETCH_COLUMNS)
+            plans.append(plan)
+
+        for name, frame in zip(changed, pl.collect_all(plans), strict=True):
+            partition_dir = aggregates_dir / name
+            partition_dir.mkdir(parents=True, exist_ok=True)
+            frame.write_parquet(partition_dir / "part-0.parquet")
+            kept[name] = fingerprints[name]
+
+        _save_state(aggregates_dir, {"version": version, "partitions": kept})
+        print("DVF aggregates up to date.")
+    else:
+        print("DVF aggregates: all partitions up to date.")
+
+    digest = hashlib.sha256(
+        json.dumps(
+            {"partitions": fingerprints, "median_accuracy": median_accuracy},
+            sort_keys=True,
+        ).encode()
+    )
+    return digest.hexdigest()
+
+
+def scan_dvf_aggregates(
+    aggregates_dir: Path,
+    years: tuple[int, ...] = stages.GROWTH_YEARS,
+    median_accuracy: float | None = None,
+) -> pl.LazyFrame:
+    """
+    Lazily scan the stored aggregates of the given years.
+
+    The result has the columns of dvf_commune_year_aggregates, so the
+    min_sales filter and the following stages apply unchanged. The
+    median_accuracy must be the one of the last update_dvf_aggregates, the
+    stored sketches of all partitions are then merged and read back.
+    """
+    version = _load_state(aggregates_dir).get("version", {})
+    if version.get("median_accuracy") != median_accuracy:
+        raise ValueError(
+            f"Aggregates in {aggregates_dir} were not updated with "
+            f"median_accuracy={median_accuracy!r}, run update_dvf_aggregates first"
+        )
+    scan = pl.scan_parquet(
+        aggregates_dir / "**" / "*.parquet",
+        hive_partitioning=True,
+        hive_schema={"annee": pl.Int32, "code_departement": pl.String},
+    ).filter(pl.col("annee").is_in(list(years)))
+    if median_accuracy is None:
+        return scan.select(AGGREGATES_COLUMNS)
+
+    return sketch_stats(
+        merge_sketches(scan.select(SKETCH_COLUMNS)), median_accuracy
+    ).select(AGGREGATES_COLUMNS)
@@ -0,0 +1,155 @@
+"""
+Writers of the final dataset for Tableau.
+
+The dataset is sunk from its lazy plan straight to disk, never collected as
+a whole, in one of OUTPUT_FORMATS:
+
+- csv: plain text, as before, Tableau re-parses and infers every column
+- parquet: typed, compressed, commune codes dictionary-encoded
+- ipc: Arrow IPC (Feather v2) file, the same types, fastest to load
+- partitioned-parquet: one Parquet file per department under hive
+  directories (code_departement=XX), for extracts refreshed per region
+
+Typed formats keep the pipeline dtypes and store code_commune as a
+Categorical, written as an Arrow dictionary. Every output gets a sidecar
+JSON schema (column names and dtypes, row count, partitioning) next to it,
+so downstream refreshes can check the layout without reading the data.
+"""
+
+import json
+import shutil
+from pathlib import Path
+
+import polars as pl
+
+OUTPUT_FORMATS = ("csv", "parquet", "ipc", "partitioned-parquet")
+OUTPUT_SUFFIXES = {
+    "csv": ".csv",
+    "parquet": ".parquet",
+    "ipc": ".arrow",
+    "partitioned-parquet": "",
+}
+OUTPUT_SCHEMA_SUFFIX = ".schema.json"
+
+# Columns stored as dictionaries (Categorical) in the typed formats
+DICTIONARY_COLUMNS = ["code_commune"]
+PARTITION_COLUMN = "code_departement"
+
+
+def _check_format(output_format: str) -> None:
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(
+            f"Unknown output format {output_format!r}, expected one of {OUTPUT_FORMATS}"
+        )
+
+
+def default_output_path(data_dir: Path, output_format: str, name: str) -> Path:
+    """data_dir/name with the suffix of the format (a directory if partitioned)."""
+    _check_format(output_format)
+    return data_dir / f"{name}{OUTPUT_SUFFIXES[output_format]}"
+
+
+def schema_path(output_path: Path) -> Path:
+    """Sidecar schema file of an output, e.g. final_dataset.parquet.schema.json."""
+    return output_path.with_name(output_path.name + OUTPUT_SCHEMA_SUFFIX)
+
+
+def scan_output(output_path: Path, output_format: str) -> pl.LazyFrame:
+    """Lazily read back a dataset written by write_dataset."""
+    _check_format(output_format)
+    if output_format == "csv":
+        return pl.scan_csv(
+            output_path,
+            schema_overrides={column: pl.String for column in DICTIONARY_COLUMNS},
+        )
+    if output_format == "ipc":
+        return pl.scan_ipc(output_path)
+    if output_format == "partitioned-parquet":
+        return pl.scan_parquet(
+            output_path / "**" / "*.parquet",
+            hive_partitioning=True,
+            hive_schema={PARTITION_COLUMN: pl.String},
+        )
+    return pl.scan_parquet(output_path)
+
+
+def write_dataset(
+    dataset: pl.LazyFrame,
+    output_path: Path,
+    output_format: str = "csv",
+    engine: str = "streaming",
+) -> dict:
+    """
+    Sink a dataset to disk in the given format and write its sidecar schema.
+
+    Args:
+        dataset: Lazy plan of the dataset, executed by the sink
+        output_path: File to write, or directory for partitioned-parquet
+            (replaced as a whole, so no stale department survives)
+        output_format: One of OUTPUT_FORMATS, partitioned-parquet needs a
+            code_commune column (partitioned by department)
+        engine: Polars engine executing the plan
+
+    Returns:
+        The sidecar schema: format, path, rows, columns (name and dtype) and
+        partition columns
+    """
+    _check_format(output_format)
+    columns = dataset.collect_schema().names()
+    if output_format == "partitioned-parquet" and "code_commune" not in columns:
+        raise ValueError("partitioned-parquet output needs a code_commune column")
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+
+    if output_format != "csv":
+        dataset = dataset.with_columns(
+            pl.col(column).cast(pl.Categorical)
+            for column in DICTIONARY_COLUMNS
+            if column in columns
+        )
+
+    partition_by = []
+    if output_format == "csv":
+        dataset.sink_csv(output_path, engine=engine)
+    elif output_format == "parquet":
+        dataset.sink_parquet(output_path, engine=engine)
+    elif output_format == "ipc":
+        # Plain (large) strings rather than string views, readable by any
+        # Arrow consumer
+        dataset.sink_ipc(
+            output_path,
+            compression="zstd",
+            compat_level=pl.CompatLevel.oldest(),
+            engine=engine,
+        )
+    else:
+        partition_by = [PARTITION_COLUMN]
+        dataset = dataset.with_columns(
+            pl.col("code_commune")
+            .cast(pl.String)
+            .str.slice(0, 2)
+            .alias(PARTITION_COLUMN)
+        )
+        shutil.rmtree(output_path, ignore_errors=True)
+        dataset.sink_parquet(
+            pl.PartitionBy(output_path, key=PARTITION_COLUMN, include_key=False),
+            mkdir=True,
+            engine=engine,
+        )
+
+    # Declared types, also for CSV where they tell readers how to parse it
+    schema = {
+        "format": output_format,
+        "path": output_path.name,
+        "rows": scan_output(output_path, output_format)
+        .select(pl.len())
+        .collect()
+        .item(),
+        "columns": [
+            {"name": name, "dtype": str(dtype)}
+            for name, dtype in dataset.collect_schema().items()
+        ],
+        "partition_by": partition_by,
+    }
+    schema_path(output_path).write_text(json.dumps(schema, indent=2) + "\n")
+
+    return schema
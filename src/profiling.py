@@ -0,0 +1,339 @@
+"""
+Per-stage profiling of pipeline runs.
+
+Stage functions and src.utils functions are decorated with `traced`, and
+stage collections are wrapped in `span`. While profiling is enabled each call
+records its wall time, process CPU time, peak resident memory above the level
+it started from, input and output row counts and, for lazy outputs, the
+optimized Polars plan. Records are written as a Chrome trace (open it in
+chrome://tracing or https://ui.perfetto.dev) and summarized per stage.
+
+A session can also check a memory budget: the span that takes resident
+memory above it raises MemoryError once it ends, naming the stage, so a run
+that does not fit its node fails early instead of swapping or being killed
+by the OOM killer. Native Polars allocations cannot be capped or
+interrupted (RLIMIT_AS would count the GBs of address space Polars reserves
+but never touches), so callers keep memory under the budget by sizing
+their work from it (see run_pipeline) and the budget is checked per span
+rather than per allocation. Nested spans all see the process memory, so
+only the innermost span that crossed the budget is named, and memory grown
+above it outside any span is reported by the next outermost span.
+
+Profiling is off by default, a traced call then costs a single global
+lookup. CPU time is process-wide, so it includes Polars' worker threads and,
+for overlapping calls (the concurrent downloads), the other threads.
+
+Usage:
+    profiling.enable()
+    run_pipeline(...)
+    records = profiling.disable()
+    profiling.write_chrome_trace(records, Path("trace.json"))
+    profiling.print_summary(records)
+"""
+
+import functools
+import json
+import os
+import resource
+import threading
+import time
+from collections.abc import Callable
+from contextlib import contextmanager
+from pathlib import Path
+
+import polars as pl
+
+RSS_SAMPLE_SECONDS = 0.005
+# Interval of the RSS counter written to the trace, peaks use every sample
+RSS_TRACE_SECONDS = 0.1
+
+
+def current_rss() -> int:
+    """Resident memory of this process in bytes."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Outside Linux only the high-water mark is known (bytes on macOS)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class _Profile:
+    """Records of an enabled profiling session and its RSS sampler."""
+
+    def __init__(self, functions: bool, max_rss: int | None) -> None:
+        self.functions = functions
+        self.max_rss = max_rss
+        self.start = time.perf_counter()
+        self.records: list[dict] = []
+        self.open_peaks: dict[int, int] = {}
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.sampler = threading.Thread(target=self._sample, daemon=True)
+        self.sampler.start()
+
+    def _sample(self) -> None:
+        last_traced = -RSS_TRACE_SECONDS
+        while not self.done.wait(RSS_SAMPLE_SECONDS):
+            rss = current_rss()
+            now = time.perf_counter() - self.start
+            with self.lock:
+                if now - last_traced >= RSS_TRACE_SECONDS:
+                    last_traced = now
+                    self.records.append(
+                        {"kind": "rss", "start": now, "rss_mb": rss / 1024**2}
+                    )
+                for span_id, peak in self.open_peaks.items():
+                    self.open_peaks[span_id] = max(peak, rss)
+
+
+_PROFILE: _Profile | None = None
+
+
+def enable(functions: bool = True, max_rss_mb: float | None = None) -> None:
+    """
+    Start recording, discarding any previous session.
+
+    Args:
+        functions: Record the calls of traced functions, otherwise only the
+            explicit spans (no plan explanations inside measured blocks)
+        max_rss_mb: Memory budget, a span taking resident memory above it
+            (MB) raises MemoryError when it ends
+    """
+    global _PROFILE
+    disable()
+    max_rss = None if max_rss_mb is None else int(max_rss_mb * 1024**2)
+    if max_rss is not None and max_rss <= current_rss():
+        raise ValueError(
+            f"The memory budget of {max_rss_mb:,.0f} MB is below the "
+            f"{current_rss() / 1024**2:,.0f} MB already resident"
+        )
+    _PROFILE = _Profile(functions, max_rss)
+
+
+def disable() -> list[dict]:
+    """
+    Stop recording and return the records of the session, by start time.
+
+    Span records have kind "span", sampled process memory has kind "rss".
+    """
+    global _PROFILE
+    profile, _PROFILE = _PROFILE, None
+    if profile is None:
+        return []
+
+    profile.done.set()
+    profile.sampler.join()
+    return sorted(profile.records, key=lambda record: record["start"])
+
+
+def is_enabled() -> bool:
+    return _PROFILE is not None
+
+
+@contextmanager
+def span(name: str, rows_in: int | None = None):
+    """
+    Record a block of code as one stage.
+
+    Yields a dict the block may fill with rows_out and plan. When profiling
+    is disabled the dict is discarded.
+    """
+    profile = _PROFILE
+    if profile is None:
+        yield {}
+        return
+
+    record = {
+        "kind": "span",
+        "name": name,
+        "thread": threading.get_ident(),
+        "rows_in": rows_in,
+    }
+    span_id = id(record)
+    rss = current_rss()
+    with profile.lock:
+        profile.open_peaks[span_id] = rss
+    start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    finally:
+        wall, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+        with profile.lock:
+            peak = max(profile.open_peaks.pop(span_id), current_rss())
+            outermost = not profile.open_peaks
+        record.update(
+            start=start - profile.start,
+            wall_seconds=wall,
+            cpu_seconds=cpu,
+            rss_delta_mb=(peak - rss) / 1024**2,
+            rss_peak_mb=peak / 1024**2,
+        )
+        with profile.lock:
+            profile.records.append(record)
+
+    # The span crossing the budget raises, spans nested in it and already
+    # above it are left to it; the outermost span also reports memory grown
+    # above the budget outside any span
+    if profile.max_rss is None or peak <= profile.max_rss:
+        return
+    budget = f"the budget of {profile.max_rss / 1024**2:,.0f} MB"
+    if rss <= profile.max_rss:
+        raise MemoryError(
+            f"{name} took resident memory from {rss / 1024**2:,.0f} MB to "
+            f"{peak / 1024**2:,.0f} MB, above {budget}"
+        )
+    if outermost:
+        raise MemoryError(
+            f"Resident memory was already {rss / 1024**2:,.0f} MB, above "
+            f"{budget}, when {name} started"
+        )
+
+
+def _rows(frame) -> int | None:
+    return len(frame) if isinstance(frame, pl.DataFrame) else None
+
+
+def describe_output(record: dict, output) -> None:
+    """Add the row count of a DataFrame or the optimized plan of a LazyFrame."""
+    if isinstance(output, pl.LazyFrame):
+        try:
+            record["plan"] = output.explain()
+        except pl.exceptions.PolarsError as error:
+            record["plan"] = f"unavailable: {error}"
+    else:
+        record["rows_out"] = _rows(output)
+
+
+def traced(function: Callable) -> Callable:
+    """Record every call of a function as a span named after it."""
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if _PROFILE is None or not _PROFILE.functions:
+            return function(*args, **kwargs)
+
+        rows = [_rows(value) for value in (*args, *kwargs.values())]
+        rows_in = sum(count for count in rows if count is not None)
+        with span(
+            f"{function.__module__.removeprefix('src.')}.{function.__qualname__}",
+            rows_in=rows_in if any(count is not None for count in rows) else None,
+        ) as record:
+            output = function(*args, **kwargs)
+            describe_output(record, output)
+        return output
+
+    return wrapper
+
+
+def write_chrome_trace(records: list[dict], trace_path: Path) -> None:
+    """
+    Write records as a Chrome trace event file.
+
+    Every record is a complete event on the track of its thread, with its
+    CPU time, memory, rows and plan as arguments. Sampled RSS is a counter.
+    """
+    pid = os.getpid()
+    events = []
+    for record in records:
+        if record["kind"] == "rss":
+            events.append(
+                {
+                    "name": "rss",
+                    "ph": "C",
+                    "ts": record["start"] * 1e6,
+                    "pid": pid,
+                    "args": {"mb": record["rss_mb"]},
+                }
+            )
+            continue
+
+        events.append(
+            {
+                "name": record["name"],
+                "cat": "stage",
+                "ph": "X",
+                "ts": record["start"] * 1e6,
+                "dur": record["wall_seconds"] * 1e6,
+                "pid": pid,
+                "tid": record["thread"],
+                "args": {
+                    key: value
+                    for key, value in record.items()
+                    if key
+                    in (
+                        "cpu_seconds",
+                        "rss_delta_mb",
+                        "rss_peak_mb",
+                        "rows_in",
+                        "rows_out",
+                        "plan",
+                    )
+                    and value is not None
+                },
+            }
+        )
+
+    trace_path.parent.mkdir(parents=True, exist_ok=True)
+    trace_path.write_text(json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}))
+
+
+def summary_table(records: list[dict]) -> pl.DataFrame:
+    """
+    Calls, total wall and CPU time, peak memory and rows per span name.
+
+    peak_rss_delta_mb is the growth of resident memory during the span,
+    peak_rss_mb the resident memory of the whole process at its peak.
+    """
+    spans = [record for record in records if record["kind"] == "span"]
+    if not spans:
+        return pl.DataFrame()
+
+    def total(column: str) -> pl.Expr:
+        # Null, not 0, for spans that never report rows
+        return (
+            pl.when(pl.col(column).is_not_null().any())
+            .then(pl.col(column).sum())
+            .alias(column)
+        )
+
+    return (
+        pl.DataFrame(
+            [
+                {
+                    "name": record["name"],
+                    "wall_seconds": record["wall_seconds"],
+                    "cpu_seconds": record["cpu_seconds"],
+                    "rss_delta_mb": record["rss_delta_mb"],
+                    "rss_peak_mb": record["rss_peak_mb"],
+                    "rows_in": record.get("rows_in"),
+                    "rows_out": record.get("rows_out"),
+                }
+                for record in spans
+            ],
+            schema_overrides={"rows_in": pl.Int64, "rows_out": pl.Int64},
+        )
+        .group_by("name", maintain_order=True)
+        .agg(
+            pl.len().alias("calls"),
+            pl.col("wall_seconds").sum().round(3),
+            pl.col("cpu_seconds").sum().round(3),
+            pl.col("rss_delta_mb").max().round(1).alias("peak_rss_delta_mb"),
+            pl.col("rss_peak_mb").max().round(1).alias("peak_rss_mb"),
+            total("rows_in"),
+            total("rows_out"),
+        )
+        .sort("wall_seconds", descending=True)
+    )
+
+
+def print_summary(records: list[dict]) -> None:
+    """Print summary_table, slowest first."""
+    with pl.Config(
+        tbl_rows=-1,
+        tbl_width_chars=160,
+        fmt_str_lengths=80,
+        tbl_hide_dataframe_shape=True,
+        tbl_hide_column_data_types=True,
+    ):
+        print(summary_table(records))
@@ -0,0 +1,86 @@
+"""
+Column types of every source file read by the pipeline.
+
+Sources are read with declared types instead of inferring them from the
+first rows, and columns a reader does not declare stay String, so no
+inference pass ever runs. Low-cardinality codes (facility types, geographic
+levels, mutation natures) are Categorical, counts unsigned integers and
+built surfaces Float32.
+
+Commune codes are Categorical in BPE, communes and facility points, and in
+the DVF aggregates once grouped, so the joins between them compare ids of
+one global dictionary instead of strings. Prices and coordinates stay
+Float64: DVF values reach 10^9 € with cents, beyond the 7 significant
+digits of Float32, and distances are computed from the coordinates.
+"""
+
+from pathlib import Path
+
+import polars as pl
+import pyarrow as pa
+
+# Arrow dictionaries are scanned back from Parquet as Categorical
+_DICTIONARY = pa.dictionary(pa.int32(), pa.string())
+
+# dvf.csv.gz columns kept in the Parquet dataset, as Arrow types
+DVF_COLUMNS = {
+    "id_mutation": pa.string(),
+    "date_mutation": pa.date32(),
+    "nature_mutation": _DICTIONARY,
+    "valeur_fonciere": pa.float64(),
+    # Read as String: grouping millions of lots is faster on strings, the
+    # aggregates become Categorical in dvf_final
+    "code_commune": pa.string(),
+    "code_departement": pa.string(),
+    "code_type_local": pa.uint8(),
+    "surface_reelle_bati": pa.float32(),
+    # Geocoded parcel of the lot, for the sub-commune grid (src.grid)
+    "longitude": pa.float64(),
+    "latitude": pa.float64(),
+}
+# Hive partitions of the DVF Parquet dataset
+DVF_PARTITION_COLUMNS = {"annee": pl.Int32, "code_departement": pl.String}
+
+BPE_DATA_COLUMNS = {
+    "GEO": pl.Categorical,
+    "GEO_OBJECT": pl.Categorical,
+    "FACILITY_TYPE": pl.Categorical,
+    "OBS_VALUE": pl.UInt32,
+}
+BPE_METADATA_COLUMNS = {
+    "COD_VAR": pl.String,
+    "LIB_VAR": pl.String,
+    "COD_MOD": pl.String,
+    "LIB_MOD": pl.String,
+}
+COMMUNES_COLUMNS = {
+    "code_insee": pl.Categorical,
+    "latitude_centre": pl.Float64,
+    "longitude_centre": pl.Float64,
+}
+# Geolocated facilities, by the names load_facility_points renames them to
+FACILITY_POINTS_TYPES = {
+    "facility": pl.String,
+    "code_commune": pl.Categorical,
+    "latitude": pl.Float64,
+    "longitude": pl.Float64,
+}
+
+
+def scan_typed_csv(
+    path: Path, columns: dict[str, pl.DataType], separator: str = ","
+) -> pl.LazyFrame:
+    """
+    Scan a CSV with declared column types, without schema inference.
+
+    Args:
+        path: CSV file, optionally compressed
+        columns: Column name -> Polars type, other columns are read as String
+        separator: Field separator
+
+    Returns:
+        LazyFrame of all the columns of the file
+    """
+    return pl.scan_csv(
+        path, separator=separator, infer_schema=False, schema_overrides=columns
+    )
@@ -0,0 +1,294 @@
+"""
+Department-sharded DVF aggregation across processes or machines.
+
+A mutation never spans departments and a commune lies in one department, so
+the (commune, year) statistics of each department can be computed on their
+own. Each shard writes its per-commune partial to a shared directory; the
+partials of all departments are disjoint and concatenate into the same
+frame the single-process pipeline computes. With a median accuracy the
+partials are price sketches (src.sketches), merged into the statistics.
+
+Workers claim departments with an exclusive lock file before computing
+them, so several processes or machines sharing the shard directory split
+the work without coordination. A lock names its owner and is refreshed
+while the department is computed, so the claims of crashed workers expire
+and are taken over. Shards are written atomically and kept under
+a subdirectory named after the DVF source and the code version, a new DVF
+release or code change never reuses stale shards.
+"""
+
+import hashlib
+import json
+import multiprocessing
+import os
+import socket
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+from pathlib import Path
+
+import polars as pl
+
+from src import stages
+from src.sketches import merge_sketches, sketch_stats
+from src.stage_cache import code_version
+from src.utils import DVF_PARQUET_SOURCE_FILE
+
+SHARD_LOCK_SUFFIX = ".lock"
+# Locks of departments in progress are refreshed this often, a lock left
+# unrefreshed for SHARD_LOCK_TIMEOUT_SECONDS belongs to a dead worker
+SHARD_LOCK_HEARTBEAT_SECONDS = 30
+SHARD_LOCK_TIMEOUT_SECONDS = 600
+SHARD_POLL_SECONDS = 5
+
+
+def shard_set_dir(
+    dvf_parquet_dir: Path, shard_dir: Path, median_accuracy: float | None = None
+) -> Path:
+    """Directory of the shards of this DVF source, code version and accuracy."""
+    source = (dvf_parquet_dir / DVF_PARQUET_SOURCE_FILE).read_text()
+    digest = hashlib.sha256(
+        json.dumps(
+            {
+                "source": json.loads(source),
+                "code": code_version(),
+                "median_accuracy": median_accuracy,
+            }
+        ).encode()
+    )
+    return shard_dir / digest.hexdigest()[:16]
+
+
+def dvf_departments(dvf_parquet_dir: Path) -> list[str]:
+    """Departments of the partitions read by the pipeline."""
+    return sorted(
+        stages.dvf_partitions(dvf_parquet_dir)
+        .select(pl.col("code_departement").unique())
+        .collect()["code_departement"]
+    )
+
+
+def _shard_path(set_dir: Path, code_departement: str) -> Path:
+    return set_dir / f"code_departement={code_departement}.parquet"
+
+
+def aggregate_department(
+    dvf_parquet_dir: Path,
+    set_dir: Path,
+    code_departement: str,
+    median_accuracy: float | None = None,
+) -> Path:
+    """
+    Compute and write the per-(commune, year) partial of one department.
+
+    Args:
+        dvf_parquet_dir: DVF Parquet dataset built by convert_dvf_to_parquet
+        set_dir: Shard directory returned by shard_set_dir
+        code_departement: Department to aggregate
+        median_accuracy: If set, the partial holds price sketches of this
+            relative accuracy instead of exact statistics
+
+    Returns:
+        Path to the written shard
+    """
+    shard_path = _shard_path(set_dir, code_departement)
+    tmp_path = shard_path.with_suffix(f".{os.getpid()}.tmp")
+
+    department = pl.col("code_departement") == code_departement
+    if median_accuracy is None:
+        partial = stages.dvf_partition_aggregates(dvf_parquet_dir, department)
+    else:
+        partial = stages.dvf_partition_sketches(
+            dvf_parquet_dir, median_accuracy, department
+        )
+    partial.collect().write_parquet(tmp_path)
+    os.replace(tmp_path, shard_path)
+
+    return shard_path
+
+
+def _lock_path(set_dir: Path, code_departement: str) -> Path:
+    return set_dir / f"code_departement={code_departement}{SHARD_LOCK_SUFFIX}"
+
+
+def _owner_alive(lock_path: Path) -> bool:
+    """Whether the worker holding a claim may still be computing it."""
+    try:
+        age = time.time() - lock_path.stat().st_mtime
+        owner = json.loads(lock_path.read_text())
+    except FileNotFoundError:
+        return False
+    except ValueError:
+        # Claimed but not written yet
+        owner = {}
+    if age > SHARD_LOCK_TIMEOUT_SECONDS:
+        return False
+    if owner.get("host") == socket.gethostname():
+        try:
+            os.kill(owner["pid"], 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+    return True
+
+
+def _claim(set_dir: Path, code_departement: str) -> bool:
+    """
+    Atomically claim a department, False if a live worker already did.
+
+    The lock records the owner's host and pid. A claim whose owner is gone
+    (a dead pid on this host, or a lock not refreshed for
+    SHARD_LOCK_TIMEOUT_SECONDS) is taken over.
+    """
+    lock_path = _lock_path(set_dir, code_departement)
+    for _ in range(2):
+        try:
+            descriptor = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if _owner_alive(lock_path):
+                return False
+            print(f"DVF shards: taking over the stale claim of {code_departement}")
+            lock_path.unlink(missing_ok=True)
+            continue
+        with os.fdopen(descriptor, "w") as lock:
+            json.dump(
+                {
+                    "host": socket.gethostname(),
+                    "pid": os.getpid(),
+                    "claimed_at": time.time(),
+                },
+                lock,
+            )
+        return True
+    return False
+
+
+def _aggregate_departments(
+    dvf_parquet_dir: Path,
+    set_dir: Path,
+    departments: list[str],
+    workers: int,
+    median_accuracy: float | None,
+) -> None:
+    """Compute claimed departments on a process pool, refreshing their locks."""
+    print(
+        f"DVF shards: aggregating {len(departments)} departments on {workers} processes..."
+    )
+
+    # Each process gets its share of the cores instead of all of them.
+    # Spawned children read POLARS_MAX_THREADS when importing polars.
+    previous = os.environ.get("POLARS_MAX_THREADS")
+    os.environ["POLARS_MAX_THREADS"] = str(max(1, (os.cpu_count() or 1) // workers))
+    try:
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            pending = {
+                executor.submit(
+                    aggregate_department,
+                    dvf_parquet_dir,
+                    set_dir,
+                    code,
+                    median_accuracy,
+                ): code
+                for code in departments
+            }
+            while pending:
+                done, _ = wait(pending, timeout=SHARD_LOCK_HEARTBEAT_SECONDS)
+                for future in done:
+                    future.result()
+                    del pending[future]
+                # Heartbeat, the claims of departments in progress stay fresh
+                for code in pending.values():
+                    os.utime(_lock_path(set_dir, code))
+    finally:
+        if previous is None:
+            os.environ.pop("POLARS_MAX_THREADS")
+        else:
+            os.environ["POLARS_MAX_THREADS"] = previous
+
+
+def run_shards(
+    dvf_parquet_dir: Path,
+    shard_dir: Path,
+    workers: int | None = None,
+    wait_for_claims: bool = False,
+    median_accuracy: float | None = None,
+) -> Path:
+    """
+    Compute the missing department shards with a local process pool.
+
+    Run it on several machines sharing shard_dir to spread the departments
+    across them. Departments claimed by live workers are left to them; with
+    wait_for_claims, the shards they still owe are awaited, and taken over
+    if their worker dies (see _claim), until every shard exists.
+
+    Args:
+        dvf_parquet_dir: DVF Parquet dataset built by convert_dvf_to_parquet
+        shard_dir: Shared directory holding the shards
+        workers: Number of processes, os.cpu_count() if None
+        wait_for_claims: Return only once every department has its shard
+        median_accuracy: If set, shards hold price sketches of this relative
+            accuracy (see aggregate_department)
+
+    Returns:
+        Shard directory of this DVF source and code version
+    """
+    set_dir = shard_set_dir(dvf_parquet_dir, shard_dir, median_accuracy)
+    set_dir.mkdir(parents=True, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    all_departments = dvf_departments(dvf_parquet_dir)
+
+    computed = waiting = False
+    while True:
+        missing = [
+            code for code in all_departments if not _shard_path(set_dir, code).exists()
+        ]
+        departments = [code for code in missing if _claim(set_dir, code)]
+        if departments:
+            _aggregate_departments(
+                dvf_parquet_dir, set_dir, departments, workers, median_accuracy
+            )
+            computed = True
+        elif not missing or not wait_for_claims:
+            break
+        else:
+            if not waiting:
+                print(
+                    f"DVF shards: waiting for {len(missing)} departments "
+                    "claimed by other workers..."
+                )
+                waiting = True
+            time.sleep(SHARD_POLL_SECONDS)
+
+    if computed or waiting:
+        print("DVF shards complete.")
+    else:
+        print(f"DVF shards in {set_dir}: nothing left to compute.")
+    return set_dir
+
+
+def merge_shards(
+    dvf_parquet_dir: Path, set_dir: Path, median_accuracy: float | None = None
+) -> pl.LazyFrame:
+    """
+    Concatenate the department partials into per-(commune, year) statistics.
+
+    With the median_accuracy the shards were computed with, their sketches
+    are merged and read back as the same statistics.
+
+    Raises:
+        FileNotFoundError: If a department shard is still missing
+    """
+    missing = [
+        code
+        for code in dvf_departments(dvf_parquet_dir)
+        if not _shard_path(set_dir, code).exists()
+    ]
+    if missing:
+        raise FileNotFoundError(f"Missing DVF shards in {set_dir}: {missing}")
+
+    partials = pl.scan_parquet(set_dir / "*.parquet", hive_partitioning=False)
+    if median_accuracy is None:
+        return partials
+    return sketch_stats(merge_sketches(partials), median_accuracy)
@@ -0,0 +1,149 @@
+"""
+Mergeable quantile sketches of commune-level prices.
+
+The exact `median()` of dvf_commune_yearly_stats needs every price of a
+group at once, so medians computed on separate batches or workers cannot be
+combined. A sketch can: each price falls into a logarithmic bucket
+(DDSketch), and the sketch of a (commune, year) group is the count and sum of
+its prices per bucket. Merging sketches is a group-by sum, and any quantile
+is read back within `relative_accuracy` of the exact value.
+
+Sketches are long frames (code_commune, year, bucket, count, sum_prix_m2)
+built and queried with Polars expressions, so they stream, store as compact
+Parquet and merge with pl.concat.
+"""
+
+import math
+
+import polars as pl
+
+DEFAULT_RELATIVE_ACCURACY = 0.005
+SKETCH_KEYS = ["code_commune", "year"]
+SKETCH_COLUMNS = [*SKETCH_KEYS, "bucket", "count", "sum_prix_m2"]
+DEFAULT_QUANTILES = {"median_prix_m2": 0.5}
+
+
+def _gamma(relative_accuracy: float) -> float:
+    if not 0 < relative_accuracy < 1:
+        raise ValueError(
+            f"relative_accuracy must be in (0, 1), got {relative_accuracy!r}"
+        )
+    return (1 + relative_accuracy) / (1 - relative_accuracy)
+
+
+def price_sketches(
+    price_per_sqm: pl.LazyFrame,
+    relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY,
+) -> pl.LazyFrame:
+    """
+    Sketch the prix_m2 distribution of every (commune, year) group.
+
+    Args:
+        price_per_sqm: Output of dvf_price_per_sqm (one row per transaction)
+        relative_accuracy: Maximum relative error of the quantiles read back
+
+    Returns:
+        One row per non-empty bucket: code_commune, year, bucket, count and
+        sum_prix_m2 (kept so that the exact mean survives merges)
+    """
+    log_gamma = math.log(_gamma(relative_accuracy))
+
+    return (
+        # Prices are positive by construction (positive value and surface)
+        price_per_sqm.filter(pl.col("prix_m2") > 0)
+        .with_columns(
+            (pl.col("prix_m2").log() / log_gamma).ceil().cast(pl.Int32).alias("bucket")
+        )
+        .group_by([*SKETCH_KEYS, "bucket"])
+        .agg(
+            pl.len().alias("count"),
+            pl.col("prix_m2").sum().alias("sum_prix_m2"),
+        )
+    )
+
+
+def merge_sketches(*sketches: pl.LazyFrame) -> pl.LazyFrame:
+    """Combine sketches of separate batches or workers into one."""
+    return (
+        pl.concat(sketches)
+        .group_by([*SKETCH_KEYS, "bucket"])
+        .agg(pl.col("count").sum(), pl.col("sum_prix_m2").sum())
+    )
+
+
+def sketch_stats(
+    sketches: pl.LazyFrame,
+    relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY,
+    quantiles: dict[str, float] | None = None,
+) -> pl.LazyFrame:
+    """
+    Read price statistics back from (possibly merged) sketches.
+
+    Quantiles interpolate linearly between the two closest ranks, like
+    Polars' median, each rank being estimated within relative_accuracy.
+
+    Args:
+        sketches: Output of price_sketches or merge_sketches, one row per
+            (commune, year, bucket), concatenated sketches must be merged first
+        relative_accuracy: Accuracy the sketches were built with
+        quantiles: Output column name -> quantile in [0, 1], defaults to
+            median_prix_m2 only
+
+    Returns:
+        The columns of dvf_commune_year_aggregates (code_commune, year,
+        avg_prix_m2, count_sales and the requested quantile columns)
+    """
+    gamma = _gamma(relative_accuracy)
+    quantiles = quantiles or DEFAULT_QUANTILES
+    for name, q in quantiles.items():
+        if not 0 <= q <= 1:
+            raise ValueError(f"Quantile {name!r} must be in [0, 1], got {q!r}")
+
+    # Rank positions are computed per row (window) so that the aggregation
+    # below only runs vectorized filter + min, not nested per-group sums
+    position = {name: q * (pl.col("n") - 1) for name, q in quantiles.items()}
+    rank_buckets = []
+    for name in quantiles:
+        for side, rank in (
+            ("lower", position[name].floor()),
+            ("upper", position[name].ceil()),
+        ):
+            rank_buckets.append(
+                pl.col("bucket")
+                .filter(pl.col("cumulative") > rank)
+                .min()
+                .alias(f"_{name}_{side}")
+            )
+
+    # Bucket k holds (gamma^(k-1), gamma^k], its value is the one minimizing
+    # the relative error over that range
+    def bucket_value(column: str) -> pl.Expr:
+        return 2 * pl.lit(gamma).pow(pl.col(column)) / (gamma + 1)
+
+    quantile_values = []
+    for name in quantiles:
+        lower, upper = bucket_value(f"_{name}_lower"), bucket_value(f"_{name}_upper")
+        fraction = position[name] - position[name].floor()
+        quantile_values.append((lower + (upper - lower) * fraction).alias(name))
+
+    return (
+        sketches.with_columns(
+            pl.col("count")
+            .cum_sum()
+            .over(SKETCH_KEYS, order_by="bucket")
+            .alias("cumulative"),
+            pl.col("count").sum().over(SKETCH_KEYS).alias("n"),
+        )
+        .group_by(SKETCH_KEYS)
+        .agg(
+            pl.col("sum_prix_m2").sum(),
+            pl.col("n").first(),
+            *rank_buckets,
+        )
+        .select(
+            *SKETCH_KEYS,
+            (pl.col("sum_prix_m2") / pl.col("n")).alias("avg_prix_m2"),
+            *quantile_values,
+            pl.col("n").alias("count_sales"),
+        )
+    )
@@ -0,0 +1,304 @@
+"""
+Content-addressed cache for the pipeline's intermediate frames.
+
+Each stage output is stored as Parquet under a key hashing everything that
+can change it: the content of its input files, the keys of its upstream
+stages, its parameters and the source code of the src package. Entries are
+evicted least-recently-used first once the cache exceeds its disk quota,
+except the entries used by the current run (see evict).
+
+Stages sharing a plan (a frame and its validation metrics) are collected
+together by cached_all, so the shared part is executed once. Stages too
+large for memory are checkpointed instead: sunk to their entry and scanned
+back (see checkpoint).
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+from collections.abc import Callable, Iterable
+from pathlib import Path
+
+import polars as pl
+
+from src import profiling
+from src.utils import content_hash
+
+DEFAULT_STAGE_CACHE_BYTES = 5 * 1024**3
+
+
+def code_version() -> str:
+    """Hash the source of every module in src, any code edit changes all keys."""
+    digest = hashlib.sha256()
+    for module_path in sorted(Path(__file__).parent.glob("*.py")):
+        digest.update(module_path.name.encode())
+        digest.update(module_path.read_bytes())
+    return digest.hexdigest()
+
+
+class StageCache:
+    """
+    Parquet store of stage outputs keyed by their inputs, with LRU eviction.
+
+    A cache_dir of None disables storage, every stage is then recomputed.
+    With reuse=False entries are written but never read back, so every stage
+    is recomputed while checkpoints still have a place to spill to.
+    Entries read or written through an instance are never evicted by it.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path | None,
+        max_bytes: int = DEFAULT_STAGE_CACHE_BYTES,
+        reuse: bool = True,
+    ) -> None:
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.reuse = reuse
+        self.code_version = code_version()
+        # Entries of the current run, downstream stages may still scan them
+        self.protected: set[Path] = set()
+        if cache_dir is not None:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def stage_key(
+        self,
+        stage: str,
+        inputs: Iterable[Path] = (),
+        upstream: Iterable[str] = (),
+        params: dict | None = None,
+    ) -> str:
+        """
+        Compute the cache key of a stage.
+
+        Args:
+            stage: Stage name
+            inputs: Source files read by the stage, keyed by content hash
+            upstream: Keys of the stages it consumes
+            params: Configuration values it depends on (JSON-serializable)
+
+        Returns:
+            Hex digest identifying this exact stage output
+        """
+        description = {
+            "stage": stage,
+            "code": self.code_version,
+            "inputs": {str(path.name): content_hash(path) for path in inputs},
+            "upstream": list(upstream),
+            "params": params or {},
+        }
+        encoded = json.dumps(description, sort_keys=True, default=str).encode()
+        return hashlib.sha256(encoded).hexdigest()
+
+    def _entry_path(self, stage: str, key: str) -> Path:
+        return self.cache_dir / f"{stage}-{key[:32]}.parquet"
+
+    def load(self, stage: str, key: str) -> pl.DataFrame | None:
+        """Return the cached output for key, or None, marking it recently used."""
+        if self.cache_dir is None or not self.reuse:
+            return None
+        entry_path = self._entry_path(stage, key)
+        if not entry_path.exists():
+            return None
+        os.utime(entry_path)
+        self.protected.add(entry_path)
+        return pl.read_parquet(entry_path)
+
+    def store(self, stage: str, key: str, frame: pl.DataFrame) -> None:
+        """Write a stage output atomically, then enforce the disk quota."""
+        if self.cache_dir is None:
+            return
+        entry_path = self._entry_path(stage, key)
+        tmp_path = entry_path.with_suffix(".tmp")
+        frame.write_parquet(tmp_path)
+        os.replace(tmp_path, entry_path)
+        self.protected.add(entry_path)
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        Delete least-recently-used entries until the cache fits in max_bytes.
+
+        Entries read or written during the current run are never deleted,
+        even when they alone exceed the quota: a checkpoint may still be
+        scanned by a downstream stage, and an entry larger than the quota
+        would otherwise be deleted as soon as it is written.
+        """
+        entries = sorted(
+            self.cache_dir.glob("*.parquet"), key=lambda path: path.stat().st_mtime
+        )
+        total = sum(path.stat().st_size for path in entries)
+        for entry_path in entries:
+            if total <= self.max_bytes:
+                break
+            if entry_path in self.protected:
+                continue
+            total -= entry_path.stat().st_size
+            entry_path.unlink()
+
+    def cached(
+        self,
+        stage: str,
+        compute: Callable[[], pl.DataFrame | pl.LazyFrame],
+        inputs: Iterable[Path] = (),
+        upstream: Iterable[str] = (),
+        params: dict | None = None,
+    ) -> tuple[pl.DataFrame, str]:
+        """
+        Return a stage output from cache, or compute and store it.
+
+        Args:
+            stage: Stage name
+            compute: Zero-argument callable producing the output (lazy or not)
+            inputs: Source files read by the stage
+            upstream: Keys of the stages it consumes
+            params: Configuration values it depends on
+
+        Returns:
+            (stage output, stage key) the key is passed on as `upstream`
+            to dependent stages
+        """
+        key = self.stage_key(stage, inputs=inputs, upstream=upstream, params=params)
+
+        frame = self.load(stage, key)
+        if frame is not None:
+            print(f"Stage {stage}: loaded from cache.")
+            return frame, key
+
+        print(f"Stage {stage}: computing...")
+        with profiling.span(f"stage {stage}") as record:
+            frame = compute()
+            if isinstance(frame, pl.LazyFrame):
+                # Explaining re-optimizes the plan, only worth it when profiled
+                if profiling.is_enabled():
+                    profiling.describe_output(record, frame)
+                frame = frame.collect()
+            record["rows_out"] = len(frame)
+        self.store(stage, key, frame)
+
+        return frame, key
+
+    def checkpoint(
+        self,
+        stage: str,
+        plan: pl.LazyFrame | list[pl.LazyFrame],
+        inputs: Iterable[Path] = (),
+        upstream: Iterable[str] = (),
+        params: dict | None = None,
+        engine: str = "streaming",
+    ) -> tuple[pl.LazyFrame, str]:
+        """
+        Return a stage output as a scan of its entry, sinking the plan if missing.
+
+        Unlike cached, the output never sits in memory: it is streamed to
+        Parquet and read back lazily, so downstream stages stream from disk.
+        Entries are shared with cached, a checkpoint is a cache hit for a
+        later in-memory run and vice versa.
+
+        A list of plans is sunk one part after the other, then the parts are
+        concatenated into the entry (also streamed): a group-by split into
+        disjoint parts only ever holds the groups of one part.
+
+        Args:
+            stage: Stage name
+            plan: Lazy plan of the stage, or the plans of its parts
+            inputs: Source files read by the stage
+            upstream: Keys of the stages it consumes
+            params: Configuration values it depends on
+            engine: Polars engine executing the sink
+
+        Returns:
+            (scan of the stage output, stage key)
+        """
+        if self.cache_dir is None:
+            raise ValueError("Checkpoints need a cache directory to spill to")
+        key = self.stage_key(stage, inputs=inputs, upstream=upstream, params=params)
+        entry_path = self._entry_path(stage, key)
+
+        if self.reuse and entry_path.exists():
+            os.utime(entry_path)
+            self.protected.add(entry_path)
+            print(f"Stage {stage}: loaded from cache.")
+        else:
+            print(f"Stage {stage}: computing (checkpoint)...")
+            with profiling.span(f"stage {stage}") as record:
+                tmp_path = entry_path.with_suffix(".tmp")
+                if isinstance(plan, pl.LazyFrame):
+                    plan.sink_parquet(tmp_path, engine=engine)
+                else:
+                    with tempfile.TemporaryDirectory(dir=self.cache_dir) as parts_dir:
+                        part_paths = [
+                            Path(parts_dir) / f"part-{index}.parquet"
+                            for index in range(len(plan))
+                        ]
+                        for part, part_path in zip(plan, part_paths, strict=True):
+                            part.sink_parquet(part_path, engine=engine)
+                        pl.scan_parquet(part_paths).sink_parquet(
+                            tmp_path, engine=engine
+                        )
+                os.replace(tmp_path, entry_path)
+                self.protected.add(entry_path)
+                record["rows_out"] = (
+                    pl.scan_parquet(entry_path).select(pl.len()).collect().item()
+                )
+            self.evict()
+
+        return pl.scan_parquet(entry_path), key
+
+    def cached_all(
+        self,
+        plans: dict[str, pl.LazyFrame],
+        inputs: Iterable[Path] = (),
+        upstream: Iterable[str] = (),
+        params: dict | None = None,
+        engine: str = "auto",
+    ) -> dict[str, tuple[pl.DataFrame, str]]:
+        """
+        Return several stage outputs, collecting the missing ones in one pass.
+
+        The missing plans go through a single pl.collect_all, whose common
+        subplan elimination executes their shared upstream once (e.g. a
+        stage and the validation metrics derived from it).
+
+        Args:
+            plans: Lazy plan of each stage, by stage name
+            inputs: Source files read by the stages
+            upstream: Keys of the stages they consume
+            params: Configuration values they depend on
+            engine: Polars engine used to collect the missing plans
+
+        Returns:
+            (stage output, stage key) by stage name
+        """
+        inputs, upstream = list(inputs), list(upstream)
+        results = {}
+        missing = []
+        for stage in plans:
+            key = self.stage_key(stage, inputs=inputs, upstream=upstream, params=params)
+            frame = self.load(stage, key)
+            if frame is None:
+                missing.append(stage)
+            else:
+                print(f"Stage {stage}: loaded from cache.")
+            results[stage] = (frame, key)
+
+        if missing:
+            print(f"Stage {', '.join(missing)}: computing...")
+            plan = (
+                pl.explain_all([plans[stage] for stage in missing])
+                if profiling.is_enabled()
+                else None
+            )
+            with profiling.span(f"stage {', '.join(missing)}") as record:
+                record["plan"] = plan
+                frames = pl.collect_all(
+                    [plans[stage] for stage in missing], engine=engine
+                )
+                record["rows_out"] = sum(len(frame) for frame in frames)
+            for stage, frame in zip(missing, frames, strict=True):
+                key = results[stage][1]
+                self.store(stage, key, frame)
+                results[stage] = (frame, key)
+
+        return results
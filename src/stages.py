@@ -0,0 +1,952 @@
+"""
+Pipeline stages shared by the notebook and headless runs.
+
+Each function is one step of the DVF / BPE graph, taking upstream frames and
+configuration values explicitly so it can be cached, timed or run outside
+marimo. The notebook documents the reasoning behind every step.
+
+The *_metrics functions derive the one-row summaries shown as validation
+from a stage plan. They are meant to be collected together with it (see
+StageCache.cached_all) rather than by re-executing the stage.
+"""
+
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+from src.commune_graph import (
+    CommuneGraph,
+    graph_radius_counts,
+    graph_rows,
+    nearest_flagged,
+)
+from src.facilities import (
+    calculate_facility_queries,
+    calculate_nearest_point_distances,
+    facility_points_from_counts,
+)
+from src.grid import GRID_KEYS, grid_price_stats
+from src.profiling import traced
+from src.schemas import (
+    BPE_DATA_COLUMNS,
+    BPE_METADATA_COLUMNS,
+    COMMUNES_COLUMNS,
+    scan_typed_csv,
+)
+from src.sketches import price_sketches, sketch_stats
+from src.utils import calculate_nearest_facility_distances, scan_dvf_parquet
+
+# Years whose prices the growth rate compares
+GROWTH_YEARS = (2021, 2024)
+# Resident memory of dvf_by_transaction per lot it groups, measured on
+# synthetic data (about 100 bytes, 280 for small parts), rounded up
+TRANSACTION_BYTES_PER_LOT = 160
+
+
+@traced
+def dvf_partitions(
+    dvf_parquet_dir: Path, years: tuple[int, ...] | None = GROWTH_YEARS
+) -> pl.LazyFrame:
+    """
+    Scan of the metropolitan partitions of the DVF Parquet dataset.
+
+    Args:
+        dvf_parquet_dir: DVF Parquet dataset built by convert_dvf_to_parquet
+        years: Partitions from the first to the last of these years are
+            read, every year if None
+
+    Returns:
+        LazyFrame of the lots of the selected partitions
+    """
+    # Partition pruning: the other partitions are never read
+    scan = scan_dvf_parquet(dvf_parquet_dir).filter(
+        ~pl.col("code_departement").str.starts_with("97")
+        & ~pl.col("code_departement").str.starts_with("98")
+    )
+    if years is not None:
+        scan = scan.filter(pl.col("annee").is_between(min(years), max(years)))
+    return scan
+
+
+@traced
+def dvf_raw_sales(
+    dvf_parquet_dir: Path,
+    partitions: pl.Expr | None = None,
+    years: tuple[int, ...] | None = GROWTH_YEARS,
+    coordinates: bool = False,
+) -> pl.LazyFrame:
+    """
+    Metropolitan sales with a positive value, one row per lot.
+
+    Args:
+        dvf_parquet_dir: DVF Parquet dataset built by convert_dvf_to_parquet
+        partitions: Optional extra filter on annee / code_departement, to
+            read a subset of the partitions
+        years: Sales from the first to the last of these years are kept
+            (2021-2024 by default), every year if None
+        coordinates: Keep the latitude and longitude of the lots
+
+    Returns:
+        Lots of the sales, without nature_mutation
+    """
+    scan = dvf_partitions(dvf_parquet_dir, years)
+    if partitions is not None:
+        scan = scan.filter(partitions)
+    if years is not None:
+        scan = scan.filter(
+            (pl.col("date_mutation") >= pl.date(min(years), 1, 1))
+            & (pl.col("date_mutation") <= pl.date(max(years), 12, 31))
+        )
+
+    return (
+        scan.select(
+            [
+                "id_mutation",
+                "date_mutation",
+                "nature_mutation",
+                "valeur_fonciere",
+                "code_commune",
+                "code_type_local",
+                "surface_reelle_bati",
+                *(["latitude", "longitude"] if coordinates else []),
+            ]
+        )
+        .filter(
+            (pl.col("nature_mutation") == "Vente")
+            & (pl.col("valeur_fonciere").is_not_null())
+            & (pl.col("valeur_fonciere") > 0)
+            & ~pl.col("code_commune").str.starts_with("97")
+            & ~pl.col("code_commune").str.starts_with("98")
+        )
+        .drop("nature_mutation")
+    )
+
+
+@traced
+def dvf_by_transaction(raw_sales: pl.LazyFrame) -> pl.LazyFrame:
+    """
+    One row per transaction, excluding those with "type 4" lots or no built surface.
+
+    The coordinates of the first lot are kept if raw_sales has them.
+    """
+    return (
+        raw_sales.group_by("id_mutation")
+        .agg(
+            [
+                pl.col("date_mutation").first(),
+                pl.col("valeur_fonciere").first(),
+                pl.col("code_commune").first(),
+                pl.col("^(latitude|longitude)$").first(),
+                (pl.col("code_type_local") == 4).any().alias("has_type_4"),
+                pl.col("surface_reelle_bati")
+                .fill_null(0)
+                .sum()
+                .alias("surface_reelle_bati"),
+            ]
+        )
+        .filter(~pl.col("has_type_4") & (pl.col("surface_reelle_bati") > 0))
+        .drop("has_type_4")
+    )
+
+
+@traced
+def dvf_by_transaction_parts(
+    dvf_parquet_dir: Path,
+    years: tuple[int, ...] | None = GROWTH_YEARS,
+    coordinates: bool = False,
+    max_part_bytes: int | None = None,
+) -> list[pl.LazyFrame]:
+    """
+    dvf_by_transaction split into plans over disjoint sets of partitions.
+
+    A mutation never spans departments or years, so the parts are disjoint
+    and concatenate into dvf_by_transaction, while each group-by only holds
+    the mutations of its own partitions.
+
+    Without max_part_bytes there is one part per department. Otherwise
+    departments are packed into parts of at most max_part_bytes of
+    estimated group-by memory (TRANSACTION_BYTES_PER_LOT per lot), and a
+    department too large on its own is split by year. A single
+    year/department partition is never split, it may exceed the size.
+
+    Args:
+        dvf_parquet_dir: DVF Parquet dataset built by convert_dvf_to_parquet
+        years: Years of the sales, as in dvf_raw_sales
+        coordinates: Keep the coordinates of the first lot
+        max_part_bytes: Memory the group-by of a part may use
+
+    Returns:
+        Plans of the transactions of each part
+    """
+    partition_lots = (
+        dvf_partitions(dvf_parquet_dir, years)
+        .group_by(["code_departement", "annee"])
+        .agg(pl.len().alias("lots"))
+        .sort(["code_departement", "annee"])
+        .collect()
+    )
+    max_lots = (
+        None
+        if max_part_bytes is None
+        else max(1, max_part_bytes // TRANSACTION_BYTES_PER_LOT)
+    )
+
+    parts, part, part_lots = [], [], 0
+    for (code_departement,), department in partition_lots.group_by(
+        "code_departement", maintain_order=True
+    ):
+        department_filter = pl.col("code_departement") == code_departement
+        if max_lots is None or department["lots"].sum() <= max_lots:
+            units = [(department_filter, department["lots"].sum())]
+        else:
+            units = [
+                (department_filter & (pl.col("annee") == annee), lots)
+                for annee, lots in department.select("annee", "lots").iter_rows()
+            ]
+        for unit, lots in units:
+            if part and (max_lots is None or part_lots + lots > max_lots):
+                parts.append(pl.any_horizontal(part))
+                part, part_lots = [], 0
+            part.append(unit)
+            part_lots += lots
+    if part:
+        parts.append(pl.any_horizontal(part))
+
+    return [
+        dvf_by_transaction(
+            dvf_raw_sales(
+                dvf_parquet_dir, partitions, years=years, coordinates=coordinates
+            )
+        )
+        for partitions in parts
+    ]
+
+
+@traced
+def dvf_by_transaction_metrics(by_transaction: pl.LazyFrame) -> pl.LazyFrame:
+    """Transaction and commune counts of dvf_by_transaction."""
+    return by_transaction.select(
+        pl.len().alias("transactions"),
+        pl.col("code_commune").n_unique().alias("communes"),
+    )
+
+
+@traced
+def dvf_price_per_sqm(
+    by_transaction: pl.LazyFrame, years: tuple[int, ...] | None = GROWTH_YEARS
+) -> pl.LazyFrame:
+    """Price per m² of each transaction of the given years (all years if None)."""
+    price_per_sqm = by_transaction.with_columns(
+        [
+            pl.col("date_mutation").dt.year().alias("year"),
+            (pl.col("valeur_fonciere") / pl.col("surface_reelle_bati")).alias(
+                "prix_m2"
+            ),
+        ]
+    ).drop(["date_mutation", "valeur_fonciere", "surface_reelle_bati"])
+
+    if years is None:
+        return price_per_sqm
+    return price_per_sqm.filter(pl.col("year").is_in(list(years)))
+
+
+@traced
+def dvf_commune_year_aggregates(price_per_sqm: pl.LazyFrame) -> pl.LazyFrame:
+    """Price statistics of every (commune, year) group."""
+    return price_per_sqm.group_by(["code_commune", "year"]).agg(
+        [
+            pl.col("prix_m2").mean().alias("avg_prix_m2"),
+            pl.col("prix_m2").median().alias("median_prix_m2"),
+            pl.col("id_mutation").count().alias("count_sales"),
+        ]
+    )
+
+
+@traced
+def dvf_partition_aggregates(
+    dvf_parquet_dir: Path,
+    partitions: pl.Expr | None = None,
+    years: tuple[int, ...] | None = GROWTH_YEARS,
+) -> pl.LazyFrame:
+    """
+    Statistics of every (commune, year) group of the given years, of a subset
+    of the DVF partitions.
+
+    A commune lies in one department and a sale in one year, so the results
+    of disjoint partition subsets are disjoint sets of complete groups, they
+    combine with a plain concat.
+
+    Args:
+        dvf_parquet_dir: DVF Parquet dataset built by convert_dvf_to_parquet
+        partitions: Filter on annee / code_departement, all partitions if None
+        years: Years of the groups (2021 and 2024 by default), every year if
+            None
+
+    Returns:
+        code_commune, year, avg_prix_m2, median_prix_m2 and count_sales
+    """
+    by_transaction = dvf_by_transaction(
+        dvf_raw_sales(dvf_parquet_dir, partitions, years=years)
+    )
+    return dvf_commune_year_aggregates(dvf_price_per_sqm(by_transaction, years=years))
+
+
+@traced
+def dvf_partition_sketches(
+    dvf_parquet_dir: Path,
+    relative_accuracy: float,
+    partitions: pl.Expr | None = None,
+    years: tuple[int, ...] | None = GROWTH_YEARS,
+) -> pl.LazyFrame:
+    """
+    Price sketches of every (commune, year) group of a subset of the DVF
+    partitions, the mergeable counterpart of dvf_partition_aggregates.
+
+    Args:
+        dvf_parquet_dir: DVF Parquet dataset built by convert_dvf_to_parquet
+        relative_accuracy: Relative accuracy of the sketches (see src.sketches)
+        partitions: Filter on annee / code_departement, all partitions if None
+        years: Years of the groups (2021 and 2024 by default), every year if
+            None
+
+    Returns:
+        Output of price_sketches, read back with sketch_stats
+    """
+    by_transaction = dvf_by_transaction(
+        dvf_raw_sales(dvf_parquet_dir, partitions, years=years)
+    )
+    return price_sketches(
+        dvf_price_per_sqm(by_transaction, years=years), relative_accuracy
+    )
+
+
+@traced
+def dvf_commune_yearly_stats(
+    price_per_sqm: pl.LazyFrame,
+    min_sales: int,
+    median_accuracy: float | None = None,
+) -> pl.LazyFrame:
+    """
+    Price statistics per (commune, year), keeping groups with at least min_sales.
+
+    Args:
+        price_per_sqm: Output of dvf_price_per_sqm
+        min_sales: Minimum number of sales of a kept group
+        median_accuracy: If set, medians are read from mergeable quantile
+            sketches with this relative accuracy (see src.sketches) instead
+            of being computed exactly
+
+    Returns:
+        code_commune, year, avg_prix_m2, median_prix_m2 and count_sales
+    """
+    if median_accuracy is None:
+        aggregates = dvf_commune_year_aggregates(price_per_sqm)
+    else:
+        aggregates = sketch_stats(
+            price_sketches(price_per_sqm, median_accuracy), median_accuracy
+        )
+
+    return aggregates.filter(pl.col("count_sales") >= min_sales)
+
+
+@traced
+def dvf_yearly_metrics(yearly_stats: pl.LazyFrame) -> pl.LazyFrame:
+    """Commune count and median of the commune medians, per year."""
+    return (
+        yearly_stats.group_by("year")
+        .agg(
+            pl.len().alias("communes"),
+            pl.col("median_prix_m2").median().alias("median_prix_m2"),
+        )
+        .sort("year")
+    )
+
+
+@traced
+def dvf_complete_years(yearly_stats: pl.LazyFrame) -> pl.LazyFrame:
+    """Keep communes with statistics for both 2021 and 2024."""
+    communes_with_both_years = (
+        yearly_stats.group_by("code_commune")
+        .agg(pl.col("year").unique().alias("years"))
+        .filter(
+            pl.col("years").list.contains(2021) & pl.col("years").list.contains(2024)
+        )
+        .select(["code_commune"])
+    )
+
+    return yearly_stats.join(communes_with_both_years, on="code_commune", how="semi")
+
+
+@traced
+def dvf_final(
+    complete_years: pl.DataFrame,
+    min_growth_percent: float,
+    max_growth_percent: float,
+    years_between: int,
+) -> pl.DataFrame:
+    """
+    Pivot 2021/2024 statistics and compute the standardized annual growth.
+
+    Args:
+        complete_years: Output of dvf_complete_years, collected
+        min_growth_percent: Lower bound of the kept annual growth (%)
+        max_growth_percent: Upper bound of the kept annual growth (%)
+        years_between: Number of years the growth is annualized over
+
+    Returns:
+        One row per commune with 2024 prices and growth_prix_m2(_standardized)
+    """
+    dvf_pivoted = complete_years.pivot(
+        on="year",
+        values=["avg_prix_m2", "median_prix_m2", "count_sales"],
+        index="code_commune",
+    )
+
+    return (
+        dvf_pivoted.with_columns(
+            growth_prix_m2=(
+                (pl.col("median_prix_m2_2024") - pl.col("median_prix_m2_2021"))
+                / pl.col("median_prix_m2_2021")
+                * 100
+                / years_between
+            )
+        )
+        .filter(
+            (pl.col("growth_prix_m2") >= min_growth_percent)
+            & (pl.col("growth_prix_m2") <= max_growth_percent)
+        )
+        .select(
+            [
+                # Categorical like the BPE side it is joined with
+                pl.col("code_commune").cast(pl.Categorical),
+                pl.col("avg_prix_m2_2024").alias("avg_prix_m2"),
+                pl.col("median_prix_m2_2024").alias("median_prix_m2"),
+                pl.col("count_sales_2024").alias("count_sales"),
+                "growth_prix_m2",
+            ]
+        )
+        .with_columns(
+            (
+                (pl.col("growth_prix_m2") - pl.col("growth_prix_m2").mean())
+                / pl.col("growth_prix_m2").std()
+            ).alias("growth_prix_m2_standardized")
+        )
+    )
+
+
+@traced
+def dvf_panel(
+    yearly_stats: pl.LazyFrame, min_growth_percent: float, max_growth_percent: float
+) -> pl.LazyFrame:
+    """
+    Growth of every commune between every pair of years of the statistics.
+
+    Each (commune, year) row is paired with the later years of its commune
+    in one self-join, so all windows come from a single pass over the
+    statistics. A window is annualized over the years elapsed between its
+    two sales years, years_between = year_end - year_start (3 for
+    2021 → 2024, where dvf_final divides by its years_between argument, 4
+    calendar years by default), and standardized across the communes of the
+    same window. Rolling windows spanning n years are the rows with
+    years_between == n, e.g. year-over-year growth for n = 1.
+
+    Args:
+        yearly_stats: Output of dvf_commune_yearly_stats, all years kept
+        min_growth_percent: Lower bound of the kept annual growth (%)
+        max_growth_percent: Upper bound of the kept annual growth (%)
+
+    Returns:
+        One row per (code_commune, year_start, year_end) with the end year
+        prices, the start year median and count, growth_prix_m2 and
+        growth_prix_m2_standardized
+    """
+    window = ["year_start", "year_end"]
+    start_stats = yearly_stats.select(
+        "code_commune",
+        pl.col("year").alias("year_start"),
+        pl.col("median_prix_m2").alias("median_prix_m2_start"),
+        pl.col("count_sales").alias("count_sales_start"),
+    )
+    end_stats = yearly_stats.rename({"year": "year_end"})
+
+    return (
+        start_stats.join(end_stats, on="code_commune", how="inner")
+        .filter(pl.col("year_end") > pl.col("year_start"))
+        .with_columns(
+            (pl.col("year_end") - pl.col("year_start")).alias("years_between")
+        )
+        .with_columns(
+            growth_prix_m2=(
+                (pl.col("median_prix_m2") - pl.col("median_prix_m2_start"))
+                / pl.col("median_prix_m2_start")
+                * 100
+                / pl.col("years_between")
+            )
+        )
+        .filter(
+            (pl.col("growth_prix_m2") >= min_growth_percent)
+            & (pl.col("growth_prix_m2") <= max_growth_percent)
+        )
+        .with_columns(
+            # Categorical like the BPE side it is joined with
+            pl.col("code_commune").cast(pl.Categorical),
+            (
+                (
+                    pl.col("growth_prix_m2")
+                    - pl.col("growth_prix_m2").mean().over(window)
+                )
+                / pl.col("growth_prix_m2").std().over(window)
+            ).alias("growth_prix_m2_standardized"),
+        )
+        .select(
+            "code_commune",
+            *window,
+            "years_between",
+            "avg_prix_m2",
+            "median_prix_m2",
+            "count_sales",
+            "median_prix_m2_start",
+            "count_sales_start",
+            "growth_prix_m2",
+            "growth_prix_m2_standardized",
+        )
+        .sort(["code_commune", *window])
+    )
+
+
+@traced
+def dvf_grid_stats(
+    dvf_parquet_dir: Path,
+    shape: str,
+    resolutions_km: list[float],
+    min_sales: int,
+    years: tuple[int, ...] | None = GROWTH_YEARS,
+    by_transaction: pl.LazyFrame | None = None,
+) -> pl.LazyFrame:
+    """
+    Price statistics per grid cell and year, binned in a single streaming pass.
+
+    Transactions are built as in dvf_by_transaction, located at their first
+    lot, and counted in one cell per resolution (see src.grid). Transactions
+    without coordinates are left out.
+
+    Args:
+        dvf_parquet_dir: DVF Parquet dataset built by convert_dvf_to_parquet
+        shape: Cell shape, one of src.grid.GRID_SHAPES
+        resolutions_km: Cell sizes in km
+        min_sales: Minimum number of sales of a kept (cell, year)
+        years: Years of the statistics, as in dvf_price_per_sqm
+        by_transaction: Transactions of these years with their coordinates
+            (e.g. a checkpoint), built from dvf_parquet_dir if None
+
+    Returns:
+        resolution_km, cell_x, cell_y, year, avg_prix_m2, median_prix_m2,
+        count_sales and the latitude/longitude of the cell centre
+    """
+    if by_transaction is None:
+        by_transaction = dvf_by_transaction(
+            dvf_raw_sales(dvf_parquet_dir, years=years, coordinates=True)
+        )
+    return grid_price_stats(
+        dvf_price_per_sqm(by_transaction, years).drop("code_commune"),
+        shape,
+        resolutions_km,
+    ).filter(pl.col("count_sales") >= min_sales)
+
+
+@traced
+def grid_with_distances(
+    grid_stats: pl.DataFrame | pl.LazyFrame,
+    facility_points: pl.DataFrame,
+    facility_columns: list[str],
+    metric: str,
+) -> pl.LazyFrame:
+    """
+    distance_{facility} columns from every cell centre to the nearest facility.
+
+    Args:
+        grid_stats: Output of dvf_grid_stats, collected or checkpointed
+        facility_points: Facility points, geolocated (load_facility_points)
+            or at commune centres (facility_points_from_counts)
+        facility_columns: Facility labels to compute distances for
+        metric: Distance metric, one of DISTANCE_METRICS
+
+    Returns:
+        grid_stats with the distance columns, one KD-tree query per cell
+        whatever its number of years
+    """
+    return calculate_nearest_point_distances(
+        grid_stats.lazy(), facility_points, facility_columns, metric, key=GRID_KEYS
+    )
+
+
+@traced
+def bpe_raw_facilities(bpe_data_file: Path, facility_types: list[str]) -> pl.LazyFrame:
+    """Metropolitan commune/arrondissement counts of the selected facility types."""
+    return (
+        scan_typed_csv(bpe_data_file, BPE_DATA_COLUMNS, separator=";")
+        .select(
+            [
+                "GEO",
+                "GEO_OBJECT",
+                "FACILITY_TYPE",
+                "OBS_VALUE",
+            ]
+        )
+        .filter(pl.col("GEO_OBJECT").is_in(["ARM", "COM"]))
+        .filter(pl.col("FACILITY_TYPE").is_in(facility_types))
+        .filter(
+            ~pl.col("GEO").cat.starts_with("97") & ~pl.col("GEO").cat.starts_with("98")
+        )
+        .drop("GEO_OBJECT")
+    )
+
+
+@traced
+def facility_label_mapping(
+    bpe_metadata_file: Path, facility_types: list[str]
+) -> dict[str, str]:
+    """
+    Map facility codes (e.g. D265) to their labels (e.g. Médecin généraliste).
+
+    Codes keep the order of the metadata file, so the facility columns and
+    the cache keys derived from the mapping are the same on every run.
+    """
+    facility_type_labels = (
+        scan_typed_csv(bpe_metadata_file, BPE_METADATA_COLUMNS, separator=";")
+        .filter(pl.col("COD_VAR") == "FACILITY_TYPE")
+        .select(["COD_MOD", "LIB_MOD"])
+        .filter(pl.col("COD_MOD").is_in(facility_types))
+        .unique(maintain_order=True)
+        .collect()
+    )
+
+    return {row["COD_MOD"]: row["LIB_MOD"] for row in facility_type_labels.to_dicts()}
+
+
+@traced
+def bpe_by_commune(
+    raw_facilities: pl.LazyFrame, label_mapping: dict[str, str]
+) -> pl.DataFrame:
+    """One column of counts per facility label, plus their Total, per commune."""
+    return (
+        raw_facilities.collect()
+        .rename({"GEO": "code_commune"})
+        .pivot(
+            on="FACILITY_TYPE",
+            values="OBS_VALUE",
+            index="code_commune",
+            aggregate_function="sum",
+        )
+        .fill_null(0)
+        .rename(label_mapping)
+        .with_columns(pl.sum_horizontal(pl.exclude("code_commune")).alias("Total"))
+    )
+
+
+def commune_centres(communes_path: Path) -> pl.LazyFrame:
+    """code_commune with the latitude/longitude of its centre."""
+    return scan_typed_csv(communes_path, COMMUNES_COLUMNS).select(
+        pl.col("code_insee").alias("code_commune"),
+        pl.col("latitude_centre").alias("latitude"),
+        pl.col("longitude_centre").alias("longitude"),
+    )
+
+
+@traced
+def bpe_with_gps(bpe_by_commune: pl.DataFrame, communes_path: Path) -> pl.LazyFrame:
+    """Attach commune centre coordinates as latitude/longitude."""
+    return bpe_by_commune.lazy().join(
+        commune_centres(communes_path), on="code_commune", how="left"
+    )
+
+
+@traced
+def facility_distances(
+    bpe_by_commune: pl.DataFrame,
+    communes_path: Path,
+    facility_column: str,
+    metric: str,
+    facility_points: pl.DataFrame | None = None,
+    graph: CommuneGraph | None = None,
+) -> pl.DataFrame:
+    """
+    Distance from every commune centre to the nearest facility of one type.
+
+    Computed for all the communes of communes_path, not only those of
+    bpe_by_commune, so the result depends on the facility type alone and can
+    be cached per type whatever the other selected types (see
+    join_facility_distances).
+
+    Args:
+        bpe_by_commune: Output of bpe_by_commune
+        communes_path: Communes file providing the commune centres
+        facility_column: Facility label to compute distances for
+        metric: Distance metric, one of DISTANCE_METRICS
+        facility_points: Geolocated facilities (see load_facility_points),
+            distances then go to the nearest actual facility instead of the
+            nearest commune centre holding one
+        graph: Commune graph of the metric (see src.commune_graph), commune
+            centre distances are then looked up instead of recomputed
+
+    Returns:
+        code_commune and distance (km) of every located commune
+    """
+    if facility_points is not None:
+        distances = calculate_nearest_point_distances(
+            commune_centres(communes_path).drop_nulls(),
+            facility_points.filter(pl.col("facility") == facility_column),
+            [facility_column],
+            metric=metric,
+        )
+    elif graph is not None:
+        holders = bpe_by_commune.filter(pl.col(facility_column) > 0)
+        rows = graph_rows(graph, holders["code_commune"].cast(pl.String).to_numpy())
+        flagged = np.zeros(len(graph.codes), dtype=bool)
+        flagged[rows[rows >= 0]] = True
+        distances = pl.LazyFrame(
+            {
+                "code_commune": pl.Series(graph.codes, dtype=pl.Categorical),
+                f"distance_{facility_column}": nearest_flagged(graph, flagged),
+            }
+        )
+    else:
+        # Communes outside bpe_by_commune hold none of the selected types
+        distances = calculate_nearest_facility_distances(
+            commune_centres(communes_path)
+            .drop_nulls()
+            .join(
+                bpe_by_commune.lazy().select("code_commune", facility_column),
+                on="code_commune",
+                how="left",
+            )
+            .with_columns(pl.col(facility_column).fill_null(0)),
+            [facility_column],
+            metric=metric,
+        )
+
+    return (
+        distances.select(
+            "code_commune",
+            pl.col(f"distance_{facility_column}").alias("distance"),
+        )
+        .unique("code_commune", keep="first")
+        .collect()
+    )
+
+
+@traced
+def join_facility_distances(
+    bpe_by_commune: pl.DataFrame,
+    communes_path: Path,
+    distances: dict[str, pl.DataFrame],
+    facility_points: bool = False,
+) -> pl.LazyFrame:
+    """
+    Attach coordinates and the distance_{facility} columns to bpe_by_commune.
+
+    Args:
+        bpe_by_commune: Output of bpe_by_commune
+        communes_path: Communes file providing the commune centres
+        distances: Output of facility_distances by facility label
+        facility_points: Whether distances go to geolocated facilities,
+            otherwise a commune holding the facility is at 0 km
+
+    Returns:
+        bpe_by_commune with latitude, longitude and the distance columns
+    """
+    with_distances = bpe_with_gps(bpe_by_commune, communes_path)
+    for facility_column, facility_distance in distances.items():
+        name = f"distance_{facility_column}"
+        with_distances = with_distances.join(
+            facility_distance.lazy().rename({"distance": name}),
+            on="code_commune",
+            how="left",
+        )
+        if not facility_points:
+            # Unlocated communes without the facility stay NaN, like the
+            # matrix engines
+            with_distances = with_distances.with_columns(
+                pl.when(pl.col(facility_column).is_null())
+                .then(None)
+                .when(pl.col(facility_column) > 0)
+                .then(0.0)
+                .otherwise(pl.col(name).fill_null(float("nan")))
+                .alias(name)
+            )
+
+    return with_distances
+
+
+@traced
+def bpe_with_distances(
+    bpe_by_commune: pl.DataFrame,
+    communes_path: Path,
+    facility_columns: list[str],
+    metric: str,
+    facility_points: pl.DataFrame | None = None,
+    graph: CommuneGraph | None = None,
+) -> pl.LazyFrame:
+    """
+    Coordinates plus distance_{facility} columns for every facility label.
+
+    Args:
+        bpe_by_commune: Output of bpe_by_commune
+        communes_path: Communes file providing the commune centres
+        facility_columns: Facility labels to compute distances for
+        metric: Distance metric, one of DISTANCE_METRICS
+        facility_points: Geolocated facilities, see facility_distances
+        graph: Commune graph of the metric, see facility_distances
+
+    Returns:
+        bpe_by_commune with latitude, longitude and the distance columns
+    """
+    print(f"Calculating distances to {len(facility_columns)} facility types...")
+    with_distances = join_facility_distances(
+        bpe_by_commune,
+        communes_path,
+        {
+            facility_column: facility_distances(
+                bpe_by_commune,
+                communes_path,
+                facility_column,
+                metric,
+                facility_points=facility_points,
+                graph=graph,
+            )
+            for facility_column in facility_columns
+        },
+        facility_points=facility_points is not None,
+    )
+    print("Distance calculations complete!")
+
+    return with_distances
+
+
+@traced
+def bpe_facility_queries(
+    bpe_with_distances: pl.DataFrame,
+    facility_columns: list[str],
+    metric: str,
+    k: list[int] | tuple[int, ...] = (),
+    radii_km: list[float] | tuple[float, ...] = (),
+    nearest_commune: bool = False,
+    facility_points: pl.DataFrame | None = None,
+    graph: CommuneGraph | None = None,
+) -> pl.LazyFrame:
+    """
+    Append kNN distances, nearest providers and radius counts per facility.
+
+    Args:
+        bpe_with_distances: Output of bpe_with_distances
+        facility_columns: Facility labels to query
+        metric: Distance metric, one of DISTANCE_METRICS
+        k: Ranks of the distance_{facility}_k{n} columns
+        radii_km: Radii of the count_{facility}_within_{r}km columns
+        nearest_commune: Add the nearest_commune_{facility} columns
+        facility_points: Geolocated facilities (see load_facility_points),
+            commune centres weighted by their counts otherwise
+        graph: Commune graph of the metric (see src.commune_graph), radius
+            counts over commune centres within its radius are then summed
+            from it
+
+    Returns:
+        bpe_with_distances with the query columns
+    """
+    graph_radii = []
+    if facility_points is None and graph is not None:
+        graph_radii = [radius for radius in radii_km if radius <= graph.radius_km]
+    tree_radii = [radius for radius in radii_km if radius not in graph_radii]
+
+    with_queries = bpe_with_distances.lazy()
+    if k or tree_radii or nearest_commune:
+        if facility_points is None:
+            facility_points = facility_points_from_counts(
+                bpe_with_distances, facility_columns
+            )
+        print(f"Running batch queries on {len(facility_points)} facility points...")
+        with_queries = calculate_facility_queries(
+            with_queries,
+            facility_points,
+            facility_columns,
+            metric=metric,
+            k=k,
+            radii_km=tree_radii,
+            nearest_commune=nearest_commune,
+        )
+    if graph_radii:
+        with_queries = graph_radius_counts(
+            with_queries, graph, facility_columns, graph_radii
+        )
+
+    # Columns in the order of the batch queries, whichever answered them
+    query_columns = [
+        column
+        for facility in facility_columns
+        for column in (
+            *(f"distance_{facility}_k{n}" for n in k),
+            *([f"nearest_commune_{facility}"] if nearest_commune else []),
+            *(f"count_{facility}_within_{radius:g}km" for radius in radii_km),
+        )
+    ]
+    return with_queries.select(
+        *bpe_with_distances.collect_schema().names(), *query_columns
+    )
+
+
+@traced
+def final_dataset(
+    dvf_final: pl.DataFrame, bpe_with_distances: pl.LazyFrame
+) -> pl.LazyFrame:
+    """Inner join of DVF communes with their facilities and distances."""
+    return dvf_final.lazy().join(
+        bpe_with_distances.unique(), on="code_commune", how="inner"
+    )
+
+
+# Cache parameters of the stages run by both the notebook and headless runs.
+# Both build their keys from these, so a headless run warms the notebook and
+# vice versa.
+
+
+def dvf_transaction_params(years: tuple[int, ...] | None = GROWTH_YEARS) -> dict:
+    """Cache parameters of dvf_by_transaction and its metrics."""
+    return {"years": years}
+
+
+def dvf_stats_params(min_sales: int, median_accuracy: float | None = None) -> dict:
+    """Cache parameters of the stages derived from dvf_commune_yearly_stats."""
+    return {"min_sales": min_sales, "median_accuracy": median_accuracy}
+
+
+def dvf_final_params(
+    min_growth_percent: float, max_growth_percent: float, years_between: int
+) -> dict:
+    """Cache parameters of dvf_final."""
+    return {
+        "min_growth_percent": min_growth_percent,
+        "max_growth_percent": max_growth_percent,
+        "years_between": years_between,
+    }
+
+
+def bpe_by_commune_params(facility_types: list[str]) -> dict:
+    """
+    Cache parameters of bpe_by_commune.
+
+    Its columns follow the metadata file (see facility_label_mapping), so
+    the selection is keyed as a set, in whatever order it was given.
+    """
+    return {"facility_types": sorted(set(facility_types))}
+
+
+def facility_distances_params(
+    facility_type: str, metric: str, facility_points: bool
+) -> dict:
+    """Cache parameters of facility_distances for one facility type."""
+    return {
+        "facility_type": facility_type,
+        "metric": metric,
+        "facility_points": facility_points,
+    }
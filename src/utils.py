@@ -1,37 +1,388 @@
 import gzip
+import hashlib
+import json
+import os
 import shutil
+import threading
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache, partial
 from pathlib import Path
 
+import numpy as np
 import polars as pl
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.dataset as pa_ds
 import requests
+from requests.adapters import HTTPAdapter
+from scipy.spatial import cKDTree
+
+from src.profiling import traced
+from src.schemas import DVF_COLUMNS, DVF_PARTITION_COLUMNS
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_SEGMENTS = 4
+MIN_SEGMENT_SIZE = 32 * 1024**2
+DOWNLOAD_TIMEOUT = (10, 60)
+MANIFEST_FILE = "manifest.json"
+HASH_CHUNK_SIZE = 8 * 1024**2
+KM_PER_DEGREE = 111.0
+EARTH_RADIUS_KM = 6371.0
+DEFAULT_MAX_BLOCK_BYTES = 256 * 1024**2
+CSV_READ_BLOCK_SIZE = 64 * 1024**2
+
+# Hive partitions of the DVF Parquet dataset, by year and department
+DVF_PARTITION_SCHEMA = pa.schema(
+    [("annee", pa.int32()), ("code_departement", pa.string())]
+)
+DVF_PARQUET_SOURCE_FILE = "_source.json"
+
+
+_MANIFEST_LOCK = threading.Lock()
+
+
+def load_manifest(directory: Path) -> dict[str, dict]:
+    """Return the manifest of files in directory, keyed by file name."""
+    manifest_path = directory / MANIFEST_FILE
+    if not manifest_path.exists():
+        return {}
+    return json.loads(manifest_path.read_text())
+
+
+def _update_manifest(path: Path, **fields) -> dict:
+    """Record fields for path in its directory manifest and return the entry."""
+    with _MANIFEST_LOCK:
+        manifest = load_manifest(path.parent)
+        entry = {**manifest.get(path.name, {}), **fields}
+        manifest[path.name] = entry
+        (path.parent / MANIFEST_FILE).write_text(json.dumps(manifest, indent=2))
+    return entry
+
+
+@traced
+def file_sha256(path: Path) -> str:
+    """Compute the sha256 hex digest of a file, streaming it in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@traced
+def content_hash(path: Path) -> str:
+    """
+    Return the sha256 of a file, reusing the manifest when it is still valid.
+
+    The manifest entry is trusted while the file size and mtime match what
+    was recorded, otherwise the file is hashed again and the entry updated.
+    Caches derived from a file should be keyed on this value.
+    """
+    stat = path.stat()
+    entry = load_manifest(path.parent).get(path.name, {})
+    if (
+        entry.get("sha256")
+        and entry.get("size") == stat.st_size
+        and entry.get("mtime_ns") == stat.st_mtime_ns
+    ):
+        return entry["sha256"]
+
+    return _update_manifest(
+        path,
+        size=stat.st_size,
+        mtime_ns=stat.st_mtime_ns,
+        sha256=file_sha256(path),
+    )["sha256"]
+
+
+@cache
+def get_http_session() -> requests.Session:
+    """Return a process-wide HTTP session with a connection pool sized for downloads."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4 * DOWNLOAD_SEGMENTS)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _segment_bounds(size: int, segments: int) -> list[tuple[int, int]]:
+    """Split [0, size) into at most `segments` inclusive byte ranges."""
+    segments = max(1, min(segments, size // MIN_SEGMENT_SIZE))
+    step = -(-size // segments)
+    return [(start, min(start + step, size) - 1) for start in range(0, size, step)]
+
+
+def _download_segment(
+    session: requests.Session,
+    url: str,
+    part_path: Path,
+    start: int,
+    end: int,
+    progress: dict[str, int],
+    progress_path: Path,
+    lock: threading.Lock,
+) -> None:
+    """Fetch bytes [start + already written, end] into part_path at their offset."""
+    offset = start + progress.get(str(start), 0)
+    if offset > end:
+        return
+
+    headers = {"Range": f"bytes={offset}-{end}"}
+    with session.get(
+        url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT
+    ) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise RuntimeError(f"Server ignored range request for {url}")
 
-DOWNLOAD_CHUNK_SIZE = 8192
+        with open(part_path, "r+b") as f:
+            f.seek(offset)
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                offset += len(chunk)
+                f.flush()
+                with lock:
+                    progress[str(start)] = offset - start
+                    progress_path.write_text(json.dumps(progress))
+
+    if offset != end + 1:
+        raise RuntimeError(f"Incomplete segment {start}-{end} for {url}")
+
+
+def _download_segmented(
+    session: requests.Session,
+    url: str,
+    part_path: Path,
+    size: int,
+    segments: int,
+    etag: str | None = None,
+) -> None:
+    """Download a file as parallel byte ranges, resuming from a progress sidecar."""
+    progress_path = part_path.with_name(f"{part_path.name}.progress")
+    bounds = _segment_bounds(size, segments)
+    expected = {"size": size, "segments": len(bounds), "etag": etag}
+
+    progress: dict = {}
+    if part_path.exists() and progress_path.exists():
+        progress = json.loads(progress_path.read_text())
+        if any(progress.get(key) != value for key, value in expected.items()):
+            # Remote file changed since the partial download, start over
+            progress = {}
+    if not progress:
+        with open(part_path, "wb") as f:
+            f.truncate(size)
+        progress = dict(expected)
+        progress_path.write_text(json.dumps(progress))
+
+    lock = threading.Lock()
+    with ThreadPoolExecutor(max_workers=len(bounds)) as executor:
+        futures = [
+            executor.submit(
+                _download_segment,
+                session,
+                url,
+                part_path,
+                start,
+                end,
+                progress,
+                progress_path,
+                lock,
+            )
+            for start, end in bounds
+        ]
+        for future in futures:
+            future.result()
+
+    progress_path.unlink()
+
+
+def _content_range_total(response: requests.Response) -> int | None:
+    """Total size of a Content-Range header ("bytes a-b/total"), if known."""
+    total = response.headers.get("Content-Range", "").rpartition("/")[2]
+    return int(total) if total.isdigit() else None
+
+
+def _download_stream(
+    session: requests.Session, url: str, part_path: Path, validator: str | None
+) -> int | None:
+    """
+    Download a file as a single stream, resuming a partial file when possible.
 
+    A partial file is only resumed when it was written for the same
+    validator (ETag or Last-Modified, recorded in a sidecar), and the range
+    request carries it as If-Range: a server whose file changed answers
+    with the whole file, which then replaces the partial one.
 
-def download_file(url: str, dest_path: Path) -> None:
-    """Download a file from URL to destination path with streaming."""
-    dest_path.parent.mkdir(parents=True, exist_ok=True)
-    if not dest_path.exists():
-        print(f"Downloading {url} to {dest_path}...")
-        response = requests.get(url, stream=True)
+    Returns:
+        Size the complete file must have, None if the server does not say
+    """
+    progress_path = part_path.with_name(f"{part_path.name}.progress")
+    offset = 0
+    if validator and part_path.exists() and progress_path.exists():
+        if json.loads(progress_path.read_text()).get("validator") == validator:
+            offset = part_path.stat().st_size
+    progress_path.write_text(json.dumps({"validator": validator}))
+
+    headers = {"Range": f"bytes={offset}-", "If-Range": validator} if offset else {}
+    with session.get(
+        url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT
+    ) as response:
+        if response.status_code == 416:
+            # Only complete if the server's size is the partial file's
+            if _content_range_total(response) == offset:
+                return offset
+            part_path.unlink()
+            return _download_stream(session, url, part_path, validator)
         response.raise_for_status()
-        with open(dest_path, "wb") as f:
+        if response.status_code == 206:
+            if not response.headers.get("Content-Range", "").startswith(
+                f"bytes {offset}-"
+            ):
+                raise RuntimeError(f"Server sent another range than asked for {url}")
+            mode, size = "ab", _content_range_total(response)
+        else:
+            # Anything but a partial answer is the whole file, start over
+            mode = "wb"
+            size = (
+                int(response.headers["Content-Length"])
+                if "Content-Length" in response.headers
+                and "Content-Encoding" not in response.headers
+                else None
+            )
+        with open(part_path, mode) as f:
             for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
                 f.write(chunk)
-        print("Download complete.")
-    else:
+
+    return size
+
+
+@traced
+def download_file(
+    url: str,
+    dest_path: Path,
+    segments: int = DOWNLOAD_SEGMENTS,
+    session: requests.Session | None = None,
+    refresh: bool = False,
+) -> bool:
+    """
+    Download a file from URL to destination path, resumable and atomic.
+
+    Data goes to `{dest_path}.part` and is renamed to dest_path only once
+    complete, so an existing dest_path is always a full file. When the server
+    advertises byte ranges, large files are fetched as `segments` parallel
+    ranges, and an interrupted download resumes where it stopped, unless
+    the file changed on the server since (ETag / Last-Modified). The size of
+    the complete file is checked against the server's before the rename.
+
+    ETag, Last-Modified, size and sha256 of every download are recorded in
+    the directory manifest. With refresh=True an existing file is revalidated
+    with If-None-Match / If-Modified-Since, and only re-downloaded when the
+    server reports a change.
+
+    Args:
+        url: Source URL
+        dest_path: Final file path
+        segments: Maximum number of parallel byte-range requests
+        session: HTTP session to reuse, defaults to get_http_session()
+        refresh: Revalidate an existing file against the server
+
+    Returns:
+        True if new content was written to dest_path
+    """
+    dest_path.parent.mkdir(parents=True, exist_ok=True)
+    entry = load_manifest(dest_path.parent).get(dest_path.name, {})
+
+    if dest_path.exists() and not refresh:
         print(f"File {dest_path} already exists.")
+        return False
+
+    conditional_headers = {}
+    if dest_path.exists():
+        if entry.get("etag"):
+            conditional_headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            conditional_headers["If-Modified-Since"] = entry["last_modified"]
+
+    session = session or get_http_session()
+    head = session.head(
+        url, headers=conditional_headers, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT
+    )
+    etag = head.headers.get("ETag") if head.ok else None
+    # Some servers ignore conditional HEAD requests but still send the ETag
+    if head.status_code == 304 or (
+        dest_path.exists() and etag and etag == entry.get("etag")
+    ):
+        print(f"File {dest_path} is up to date.")
+        return False
+
+    part_path = dest_path.with_name(f"{dest_path.name}.part")
+    size = int(head.headers.get("Content-Length", 0)) if head.ok else 0
+    accepts_ranges = head.ok and head.headers.get("Accept-Ranges") == "bytes"
+
+    print(f"Downloading {url} to {dest_path}...")
+    if accepts_ranges and size >= 2 * MIN_SEGMENT_SIZE and segments > 1:
+        _download_segmented(session, head.url, part_path, size, segments, etag)
+    else:
+        # Weak ETags cannot validate a range, the date still can
+        validator = (
+            etag
+            if etag and not etag.startswith("W/")
+            else head.headers.get("Last-Modified")
+            if head.ok
+            else None
+        )
+        size = _download_stream(
+            session, head.url if head.ok else url, part_path, validator
+        )
+
+    # A short or overlong file stays a .part, never reaches dest_path
+    written = part_path.stat().st_size
+    if size and written != size:
+        raise RuntimeError(
+            f"Downloaded {written:,} bytes of {url}, the server announced {size:,}"
+        )
+    part_path.with_name(f"{part_path.name}.progress").unlink(missing_ok=True)
+    os.replace(part_path, dest_path)
+    stat = dest_path.stat()
+    _update_manifest(
+        dest_path,
+        url=url,
+        etag=etag,
+        last_modified=head.headers.get("Last-Modified") if head.ok else None,
+        size=stat.st_size,
+        mtime_ns=stat.st_mtime_ns,
+        sha256=file_sha256(dest_path),
+    )
+    print("Download complete.")
 
+    return True
+
+
+@traced
+def extract_zip(
+    zip_path: Path, extract_to: Path, members: list[str] | None = None
+) -> None:
+    """
+    Extract a ZIP archive to the specified directory.
 
-def extract_zip(zip_path: Path, extract_to: Path) -> None:
-    """Extract a ZIP archive to the specified directory."""
+    When members is given, only those entries are extracted (missing ones are
+    skipped), otherwise the whole archive is.
+    """
     print(f"Extracting {zip_path} to {extract_to}...")
     with zipfile.ZipFile(zip_path, "r") as zip_ref:
-        zip_ref.extractall(extract_to)
+        if members is None:
+            zip_ref.extractall(extract_to)
+        else:
+            available = set(zip_ref.namelist())
+            for member in members:
+                if member in available:
+                    zip_ref.extract(member, extract_to)
     print("Extraction complete.")
 
 
+@traced
 def extract_gzip(gz_path: Path, dest_path: Path) -> None:
     """Extract a GZIP compressed file to destination path."""
     print(f"Extracting {gz_path} to {dest_path}...")
@@ -46,34 +397,58 @@ def setup_data_directory() -> Path:
     return Path(__file__).parent.parent / "data"
 
 
-def download_dvf_dataset(data_dir: Path) -> Path:
-    """Download and extract DVF (Land Value) dataset."""
+@traced
+def download_dvf_dataset(
+    data_dir: Path, extract: bool = False, refresh: bool = False
+) -> Path:
+    """
+    Download DVF (Land Value) dataset.
+
+    The compressed file is returned as is, readers decompress it on the fly
+    (see convert_dvf_to_parquet). Pass extract=True to also materialize the
+    uncompressed CSV (~4 GB) and get its path instead. Pass refresh=True to
+    revalidate the local copy against the server.
+    """
     dvf_url = "https://static.data.gouv.fr/resources/demandes-de-valeurs-foncieres-geolocalisees/20251105-140205/dvf.csv.gz"
     dvf_gz_path = data_dir / "dvf.csv.gz"
     dvf_csv_path = data_dir / "dvf.csv"
 
-    download_file(dvf_url, dvf_gz_path)
+    updated = download_file(dvf_url, dvf_gz_path, refresh=refresh)
 
-    if not dvf_csv_path.exists():
+    if not extract:
+        return dvf_gz_path
+
+    if updated or not dvf_csv_path.exists():
         extract_gzip(dvf_gz_path, dvf_csv_path)
 
     return dvf_csv_path
 
 
-def download_bpe_dataset(data_dir: Path) -> tuple[Path, Path]:
-    """Download and extract BPE (Facilities) dataset."""
+@traced
+def download_bpe_dataset(data_dir: Path, refresh: bool = False) -> tuple[Path, Path]:
+    """
+    Download BPE (Facilities) dataset and extract only its data and metadata files.
+
+    Pass refresh=True to revalidate the local archive against the server,
+    members are extracted again when it changed.
+    """
     bpe_url = "https://www.insee.fr/fr/statistiques/fichier/8217527/DS_BPE_CSV_FR.zip"
     bpe_zip_path = data_dir / "bpe.zip"
     bpe_extract_dir = data_dir / "bpe"
 
-    download_file(bpe_url, bpe_zip_path)
-
-    if not bpe_extract_dir.exists():
-        extract_zip(bpe_zip_path, bpe_extract_dir)
+    updated = download_file(bpe_url, bpe_zip_path, refresh=refresh)
 
     bpe_data_file = bpe_extract_dir / "DS_BPE_2024_data.csv"
     bpe_metadata_file = bpe_extract_dir / "DS_BPE_2024_metadata.csv"
 
+    missing_members = [
+        path.name
+        for path in (bpe_data_file, bpe_metadata_file)
+        if updated or not path.exists()
+    ]
+    if missing_members:
+        extract_zip(bpe_zip_path, bpe_extract_dir, members=missing_members)
+
     if not bpe_data_file.exists():
         raise FileNotFoundError(f"BPE data file not found: {bpe_data_file}")
     if not bpe_metadata_file.exists():
@@ -82,86 +457,397 @@ def download_bpe_dataset(data_dir: Path) -> tuple[Path, Path]:
     return bpe_data_file, bpe_metadata_file
 
 
-def download_communes_dataset(data_dir: Path) -> Path:
-    """Download and extract communes (geographic coordinates) dataset."""
+@traced
+def download_communes_dataset(
+    data_dir: Path, extract: bool = False, refresh: bool = False
+) -> Path:
+    """
+    Download communes (geographic coordinates) dataset.
+
+    The compressed file is returned as is, pl.scan_csv decompresses it on the
+    fly. Pass extract=True to also materialize the uncompressed CSV and get
+    its path instead. Pass refresh=True to revalidate the local copy against
+    the server.
+    """
     communes_url = (
         "https://www.data.gouv.fr/api/1/datasets/r/d488255f-7902-4a5d-8e46-e23309745fe5"
     )
     communes_gz_path = data_dir / "communes.csv.gz"
     communes_csv_path = data_dir / "communes.csv"
 
-    download_file(communes_url, communes_gz_path)
+    updated = download_file(communes_url, communes_gz_path, refresh=refresh)
+
+    if not extract:
+        return communes_gz_path
 
-    if not communes_csv_path.exists():
+    if updated or not communes_csv_path.exists():
         extract_gzip(communes_gz_path, communes_csv_path)
 
     return communes_csv_path
 
 
-def calculate_nearest_facility_distance_matrix(
-    dataset: "pl.LazyFrame", facility_code: str
-) -> "pl.LazyFrame":
+@traced
+def download_datasets(
+    data_dir: Path, refresh: bool = False
+) -> tuple[Path, tuple[Path, Path], Path]:
     """
-    Calculate distance to nearest facility of a given type for each municipality.
+    Download DVF, BPE and communes datasets concurrently.
+
+    With refresh=True each dataset is revalidated against the server, an
+    unchanged file costs a single conditional HEAD request.
+
+    Returns:
+        (DVF path, (BPE data file, BPE metadata file), communes path)
+    """
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        dvf = executor.submit(download_dvf_dataset, data_dir, refresh=refresh)
+        bpe = executor.submit(download_bpe_dataset, data_dir, refresh=refresh)
+        communes = executor.submit(download_communes_dataset, data_dir, refresh=refresh)
+        return dvf.result(), bpe.result(), communes.result()
 
-    For municipalities with the facility (count > 0), distance is 0.
-    For municipalities without, calculates geodesic distance to nearest facility
-    using Haversine approximation (1 degree ≈ 111 km).
+
+def _source_fingerprint(source_path: Path) -> dict:
+    """Describe a source file by content so caches built from it can detect changes."""
+    return {"source": source_path.name, "sha256": content_hash(source_path)}
+
+
+@traced
+def convert_dvf_to_parquet(dvf_gz_path: Path, dataset_dir: Path) -> Path:
+    """
+    Convert the DVF .csv.gz once into a typed, partitioned Parquet dataset.
+
+    The CSV is streamed batch by batch (never fully in memory) and written as
+    hive partitions annee=YYYY/code_departement=XX. Later runs reuse the
+    dataset as long as the source file and the column set are unchanged,
+    otherwise it is rebuilt.
 
     Args:
-        dataset: LazyFrame with columns [code_commune, latitude, longitude, {facility_code}]
-        facility_code: Name of the facility column to calculate distances for
+        dvf_gz_path: Path to the downloaded dvf.csv.gz
+        dataset_dir: Directory holding the Parquet dataset
 
     Returns:
-        LazyFrame with added column: distance_{facility_code}
+        Path to the Parquet dataset directory
     """
-    import numpy as np
-    import polars as pl
+    fingerprint = {
+        **_source_fingerprint(dvf_gz_path),
+        "columns": {name: str(dtype) for name, dtype in DVF_COLUMNS.items()},
+    }
+    source_file = dataset_dir / DVF_PARQUET_SOURCE_FILE
+
+    if source_file.exists() and json.loads(source_file.read_text()) == fingerprint:
+        print(f"DVF Parquet dataset {dataset_dir} is up to date.")
+        return dataset_dir
+
+    print(f"Converting {dvf_gz_path} to Parquet dataset {dataset_dir}...")
+    reader = pa_csv.open_csv(
+        dvf_gz_path,
+        read_options=pa_csv.ReadOptions(block_size=CSV_READ_BLOCK_SIZE),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=list(DVF_COLUMNS),
+            column_types=DVF_COLUMNS,
+        ),
+    )
+    schema = reader.schema.append(DVF_PARTITION_SCHEMA.field("annee"))
+
+    def batches_with_year():
+        for batch in reader:
+            year = pc.cast(pc.year(batch["date_mutation"]), pa.int32())
+            yield batch.append_column("annee", year)
+
+    # Build next to the target and swap at the end, a crash never leaves a
+    # half-written dataset behind a valid source file
+    tmp_dir = dataset_dir.with_name(f"{dataset_dir.name}.tmp")
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+
+    pa_ds.write_dataset(
+        pa.RecordBatchReader.from_batches(schema, batches_with_year()),
+        tmp_dir,
+        format="parquet",
+        partitioning=pa_ds.partitioning(DVF_PARTITION_SCHEMA, flavor="hive"),
+        file_options=pa_ds.ParquetFileFormat().make_write_options(compression="zstd"),
+    )
+    (tmp_dir / DVF_PARQUET_SOURCE_FILE).write_text(json.dumps(fingerprint))
 
-    KM_PER_DEGREE = 111.0
+    if dataset_dir.exists():
+        shutil.rmtree(dataset_dir)
+    tmp_dir.rename(dataset_dir)
+    print("Conversion complete.")
 
-    facility_coords = (
-        dataset.filter(pl.col(facility_code) > 0)
-        .select(["latitude", "longitude"])
-        .unique()
-        .collect()
-    )
+    return dataset_dir
 
-    with_facility = (
-        dataset.filter(pl.col(facility_code) > 0)
-        .select(["code_commune"])
-        .unique()
-        .with_columns(pl.lit(0.0).alias(f"distance_{facility_code}"))
+
+@traced
+def scan_dvf_parquet(dataset_dir: Path) -> "pl.LazyFrame":
+    """
+    Lazily scan the DVF Parquet dataset built by convert_dvf_to_parquet.
+
+    Filters on `annee` and `code_departement` prune whole partitions, filters
+    on other columns skip row groups using Parquet statistics.
+    """
+    return pl.scan_parquet(
+        dataset_dir / "**" / "*.parquet",
+        hive_partitioning=True,
+        hive_schema=DVF_PARTITION_COLUMNS,
     )
 
-    without_facility = (
-        dataset.filter(pl.col(facility_code) == 0)
-        .select(["code_commune", "latitude", "longitude"])
-        .unique()
-        .collect()
+
+def _project_flat(coordinates: np.ndarray) -> np.ndarray:
+    """Keep (latitude, longitude) in degrees, distances are taken on that plane."""
+    return coordinates
+
+
+def _flat_to_km(distances: np.ndarray) -> np.ndarray:
+    """Convert planar degree distances to km (1 degree ≈ 111 km)."""
+    return distances * KM_PER_DEGREE
+
+
+def _project_unit_sphere(coordinates: np.ndarray) -> np.ndarray:
+    """Project (latitude, longitude) in degrees to xyz on the unit sphere."""
+    latitude = np.radians(coordinates[:, 0])
+    longitude = np.radians(coordinates[:, 1])
+    cos_latitude = np.cos(latitude)
+
+    return np.column_stack(
+        [
+            cos_latitude * np.cos(longitude),
+            cos_latitude * np.sin(longitude),
+            np.sin(latitude),
+        ]
     )
 
-    facilities_array = facility_coords.select(["latitude", "longitude"]).to_numpy()
-    communes_array = without_facility.select(["latitude", "longitude"]).to_numpy()
 
+def _chord_to_haversine_km(chords: np.ndarray) -> np.ndarray:
+    """Convert unit-sphere chord lengths to great-circle distances in km."""
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(chords / 2, 0.0, 1.0))
+
+
+# Each metric projects coordinates to a space where Euclidean distance is
+# monotonic with the metric, so every engine (including the KD-tree) finds
+# the true nearest facility, then maps that Euclidean distance back to km.
+DISTANCE_METRICS = {
+    "flat": (_project_flat, _flat_to_km),
+    "haversine": (_project_unit_sphere, _chord_to_haversine_km),
+}
+
+
+def _nearest_distances_brute_force(
+    communes_array: np.ndarray, facilities_array: np.ndarray
+) -> np.ndarray:
+    """
+    Reference implementation: dense (communes × facilities) distance matrix.
+
+    Memory grows as O(N·M), keep it for validation on small inputs only.
+    """
     squared_diff = (
         communes_array[:, np.newaxis, :] - facilities_array[np.newaxis, :, :]
     ) ** 2
-    distances_matrix = np.sqrt(squared_diff.sum(axis=2)) * KM_PER_DEGREE
+    distances_matrix = np.sqrt(squared_diff.sum(axis=2))
 
-    min_distances = np.nanmin(distances_matrix, axis=1)
+    return np.nanmin(distances_matrix, axis=1)
 
-    without_facility_distances = pl.DataFrame(
-        {
-            "code_commune": without_facility.select("code_commune")
-            .to_series()
-            .to_list(),
-            f"distance_{facility_code}": min_distances.tolist(),
-        }
-    )
 
-    distances_complete = pl.concat(
-        [with_facility.collect(), without_facility_distances]
+def _nearest_distances_kdtree(
+    communes_array: np.ndarray, facilities_array: np.ndarray
+) -> np.ndarray:
+    """
+    Nearest facility distance using a KD-tree built over facility coordinates.
+
+    Runs in O(N log M) time with memory linear in the number of points.
+    Communes without valid coordinates get NaN, like the brute-force path.
+    """
+    min_distances = np.full(len(communes_array), np.nan)
+
+    facilities_array = facilities_array[np.isfinite(facilities_array).all(axis=1)]
+    valid_communes = np.isfinite(communes_array).all(axis=1)
+    if len(facilities_array) == 0 or not valid_communes.any():
+        return min_distances
+
+    tree = cKDTree(facilities_array)
+    nearest, _ = tree.query(communes_array[valid_communes], k=1, workers=-1)
+    min_distances[valid_communes] = nearest
+
+    return min_distances
+
+
+def _nearest_distances_blocked(
+    communes_array: np.ndarray,
+    facilities_array: np.ndarray,
+    max_bytes: int = DEFAULT_MAX_BLOCK_BYTES,
+) -> np.ndarray:
+    """
+    Nearest facility distance streamed through (communes × facilities) tiles.
+
+    Each tile holds float32 squared distances sized to stay under max_bytes,
+    a running min/argmin is kept per commune, so peak memory does not depend
+    on the number of communes or facilities. The winning pair is re-measured
+    in float64, only near-ties below float32 precision may resolve differently.
+    """
+    min_distances = np.full(len(communes_array), np.nan)
+
+    facilities_array = facilities_array[np.isfinite(facilities_array).all(axis=1)]
+    if len(facilities_array) == 0 or len(communes_array) == 0:
+        return min_distances
+
+    # Centering before the float32 cast keeps sub-meter resolution on coordinates
+    origin = facilities_array.mean(axis=0)
+    communes_f32 = (communes_array - origin).astype(np.float32)
+    facilities_f32 = (facilities_array - origin).astype(np.float32)
+
+    # Two float32 tiles, squared distances and the difference along one axis,
+    # allocated once: every tile is a view of them, nothing else grows with it
+    pairs_per_tile = max(1, max_bytes // (2 * np.dtype(np.float32).itemsize))
+    block_cols = min(len(facilities_f32), pairs_per_tile)
+    block_rows = max(1, pairs_per_tile // block_cols)
+    squared_buffer = np.empty(block_rows * block_cols, dtype=np.float32)
+    delta_buffer = np.empty_like(squared_buffer)
+
+    best_squared = np.full(len(communes_f32), np.inf, dtype=np.float32)
+    best_index = np.full(len(communes_f32), -1, dtype=np.intp)
+
+    for row_start in range(0, len(communes_f32), block_rows):
+        rows = slice(row_start, row_start + block_rows)
+        communes_block = communes_f32[rows]
+        row_positions = np.arange(len(communes_block))
+
+        for col_start in range(0, len(facilities_f32), block_cols):
+            facilities_block = facilities_f32[col_start : col_start + block_cols]
+            shape = (len(communes_block), len(facilities_block))
+            squared = squared_buffer[: shape[0] * shape[1]].reshape(shape)
+            delta = delta_buffer[: shape[0] * shape[1]].reshape(shape)
+
+            squared.fill(0)
+            for axis in range(communes_block.shape[1]):
+                np.subtract.outer(
+                    communes_block[:, axis], facilities_block[:, axis], out=delta
+                )
+                np.square(delta, out=delta)
+                squared += delta
+
+            local_index = squared.argmin(axis=1)
+            local_best = squared[row_positions, local_index]
+            improved = local_best < best_squared[rows]
+            best_squared[rows][improved] = local_best[improved]
+            best_index[rows][improved] = local_index[improved] + col_start
+
+    found = best_index >= 0
+    nearest = facilities_array[best_index[found]]
+    min_distances[found] = np.sqrt(((communes_array[found] - nearest) ** 2).sum(axis=1))
+
+    return min_distances
+
+
+NEAREST_FACILITY_METHODS = {
+    "kdtree": _nearest_distances_kdtree,
+    "blocked": _nearest_distances_blocked,
+    "brute_force": _nearest_distances_brute_force,
+}
+
+
+@traced
+def calculate_nearest_facility_distances(
+    dataset: "pl.LazyFrame",
+    facility_codes: list[str],
+    method: str = "kdtree",
+    max_bytes: int = DEFAULT_MAX_BLOCK_BYTES,
+    metric: str = "flat",
+) -> "pl.LazyFrame":
+    """
+    Calculate distance to nearest facility for several facility types at once.
+
+    The dataset is collected a single time, every distance_{facility_code}
+    column is computed from the same in-memory coordinates, and the result is
+    joined back in one step. Cost grows linearly with the number of types.
+
+    For municipalities with the facility (count > 0), distance is 0.
+    For municipalities without, calculates distance in km to nearest facility
+    using the selected metric.
+
+    Args:
+        dataset: LazyFrame with columns [code_commune, latitude, longitude, *facility_codes]
+        facility_codes: Names of the facility columns to calculate distances for
+        method: Nearest-neighbor engine, one of NEAREST_FACILITY_METHODS.
+            "kdtree" (default) queries a spatial index in O(N log M),
+            "blocked" streams memory-bounded float32 tiles,
+            "brute_force" builds the dense distance matrix (reference mode).
+        max_bytes: Working-set budget per tile for the "blocked" method
+        metric: Distance metric, one of DISTANCE_METRICS.
+            "flat" (default) is the legacy planar approximation (1 degree ≈ 111 km),
+            "haversine" is the great-circle distance on a spherical Earth.
+
+    Returns:
+        LazyFrame with added columns: distance_{facility_code} for each code
+    """
+    if method not in NEAREST_FACILITY_METHODS:
+        raise ValueError(
+            f"Unknown method {method!r}, expected one of {list(NEAREST_FACILITY_METHODS)}"
+        )
+    if metric not in DISTANCE_METRICS:
+        raise ValueError(
+            f"Unknown metric {metric!r}, expected one of {list(DISTANCE_METRICS)}"
+        )
+
+    engine = NEAREST_FACILITY_METHODS[method]
+    if method == "blocked":
+        engine = partial(engine, max_bytes=max_bytes)
+    project, to_km = DISTANCE_METRICS[metric]
+
+    collected = dataset.collect()
+    communes = collected.select(
+        ["code_commune", "latitude", "longitude", *facility_codes]
+    ).unique()
+    points = project(communes.select(["latitude", "longitude"]).to_numpy())
+
+    distance_columns = []
+    for facility_code in facility_codes:
+        counts = communes[facility_code]
+        has_facility = (counts > 0).fill_null(False).to_numpy()
+        lacks_facility = (counts == 0).fill_null(False).to_numpy()
+
+        distances = np.full(len(communes), np.nan)
+        distances[has_facility] = 0.0
+        distances[lacks_facility] = to_km(
+            engine(points[lacks_facility], np.unique(points[has_facility], axis=0))
+        )
+
+        # Communes with an unknown count keep a null distance, as after a left join
+        distance_columns.append(
+            pl.when(pl.col(facility_code).is_not_null())
+            .then(pl.Series(distances))
+            .alias(f"distance_{facility_code}")
+        )
+
+    distances_complete = communes.select(["code_commune", *distance_columns])
+
+    return collected.lazy().join(
+        distances_complete.lazy(), on="code_commune", how="left"
     )
 
-    return dataset.join(distances_complete.lazy(), on="code_commune", how="left")
+
+@traced
+def calculate_nearest_facility_distance_matrix(
+    dataset: "pl.LazyFrame",
+    facility_code: str,
+    method: str = "kdtree",
+    max_bytes: int = DEFAULT_MAX_BLOCK_BYTES,
+    metric: str = "flat",
+) -> "pl.LazyFrame":
+    """
+    Calculate distance to nearest facility of a given type for each municipality.
+
+    Single-facility shortcut for calculate_nearest_facility_distances, prefer
+    the batched function when several facility types are needed.
+
+    Args:
+        dataset: LazyFrame with columns [code_commune, latitude, longitude, {facility_code}]
+        facility_code: Name of the facility column to calculate distances for
+        method: Nearest-neighbor engine, one of NEAREST_FACILITY_METHODS
+        max_bytes: Working-set budget per tile for the "blocked" method
+        metric: Distance metric, one of DISTANCE_METRICS
+
+    Returns:
+        LazyFrame with added column: distance_{facility_code}
+    """
+    return calculate_nearest_facility_distances(
+        dataset, [facility_code], method=method, max_bytes=max_bytes, metric=metric
+    )
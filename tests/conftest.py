@@ -0,0 +1,71 @@
+"""
+Shared fixtures: small synthetic sources and a pipeline runner over them.
+
+The sources come from benchmarks/synthetic_data.py, generated once per
+session. Every test gets its own copy of them, so stage caches, Parquet
+datasets and shards never leak between tests, and downloads are replaced
+by the generated files.
+"""
+
+import shutil
+from pathlib import Path
+
+import polars as pl
+import pytest
+
+from benchmarks.synthetic_data import generate_datasets
+from src import cli
+
+SYNTHETIC_COMMUNES = 300
+SYNTHETIC_DVF_ROWS = 30_000
+
+
+@pytest.fixture(scope="session")
+def synthetic_sources(tmp_path_factory: pytest.TempPathFactory) -> Path:
+    """Directory holding the synthetic DVF, BPE and communes files."""
+    data_dir = tmp_path_factory.mktemp("synthetic")
+    generate_datasets(
+        data_dir, communes=SYNTHETIC_COMMUNES, dvf_rows=SYNTHETIC_DVF_ROWS
+    )
+    return data_dir
+
+
+@pytest.fixture
+def data_dir(tmp_path: Path, synthetic_sources: Path) -> Path:
+    """Fresh data directory holding a copy of the synthetic sources."""
+    data_dir = tmp_path / "data"
+    shutil.copytree(synthetic_sources, data_dir)
+    return data_dir
+
+
+@pytest.fixture
+def run_pipeline(data_dir: Path, monkeypatch: pytest.MonkeyPatch):
+    """
+    Run cli.run_pipeline on the synthetic sources and read its output back.
+
+    The returned function takes the keyword options of run_pipeline
+    (use_cache defaults to False) and returns the written dataset.
+    """
+    sources = (
+        data_dir / "dvf.csv.gz",
+        (
+            data_dir / "bpe" / "DS_BPE_2024_data.csv",
+            data_dir / "bpe" / "DS_BPE_2024_metadata.csv",
+        ),
+        data_dir / "communes.csv.gz",
+    )
+    monkeypatch.setattr(cli, "download_datasets", lambda *_, **__: sources)
+    runs = iter(range(1_000))
+
+    def run(**options) -> pl.DataFrame:
+        options.setdefault("use_cache", False)
+        output_file = data_dir / f"output_{next(runs)}.parquet"
+        cli.run_pipeline(data_dir, output_file, output_format="parquet", **options)
+        return pl.read_parquet(output_file)
+
+    return run
+
+
+def sorted_rows(frame: pl.DataFrame, keys: list[str]) -> pl.DataFrame:
+    """frame with Categorical columns as strings, sorted by keys."""
+    return frame.with_columns(pl.col(pl.Categorical).cast(pl.String)).sort(keys)
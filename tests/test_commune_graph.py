@@ -0,0 +1,97 @@
+import gzip
+
+import numpy as np
+import polars as pl
+import pytest
+from polars.testing import assert_frame_equal
+
+from src import stages
+from src.cli import DEFAULT_FACILITY_TYPES
+from src.commune_graph import commune_graph, nearest_flagged, radius_sum
+from tests.conftest import sorted_rows
+
+
+@pytest.fixture(scope="module")
+def bpe_counts(synthetic_sources):
+    """bpe_by_commune of the synthetic BPE and its facility labels."""
+    bpe_dir = synthetic_sources / "bpe"
+    label_mapping = stages.facility_label_mapping(
+        bpe_dir / "DS_BPE_2024_metadata.csv", DEFAULT_FACILITY_TYPES
+    )
+    counts = stages.bpe_by_commune(
+        stages.bpe_raw_facilities(
+            bpe_dir / "DS_BPE_2024_data.csv", DEFAULT_FACILITY_TYPES
+        ),
+        label_mapping,
+    )
+    return counts, list(label_mapping.values())
+
+
+# k=2 leaves most communes without a holder among their neighbours, they
+# fall back to the KD-tree
+@pytest.mark.parametrize("k", [2, 32])
+@pytest.mark.parametrize("metric", ["flat", "haversine"])
+def test_graph_distances_match_kdtree(
+    synthetic_sources, tmp_path, bpe_counts, metric, k
+):
+    counts, facilities = bpe_counts
+    communes_path = synthetic_sources / "communes.csv.gz"
+    graph = commune_graph(communes_path, tmp_path, metric, k=k)
+
+    for facility in facilities:
+        assert_frame_equal(
+            sorted_rows(
+                stages.facility_distances(
+                    counts, communes_path, facility, metric, graph=graph
+                ),
+                ["code_commune"],
+            ),
+            sorted_rows(
+                stages.facility_distances(counts, communes_path, facility, metric),
+                ["code_commune"],
+            ),
+        )
+
+
+@pytest.mark.parametrize("metric", ["flat", "haversine"])
+def test_graph_radius_counts_match_kdtree(
+    synthetic_sources, tmp_path, bpe_counts, metric
+):
+    counts, facilities = bpe_counts
+    communes_path = synthetic_sources / "communes.csv.gz"
+    graph = commune_graph(communes_path, tmp_path, metric)
+    located = stages.bpe_with_gps(counts, communes_path).collect()
+    radii_km = [2.0, graph.radius_km]
+
+    with_graph, with_tree = (
+        stages.bpe_facility_queries(
+            located, facilities, metric, radii_km=radii_km, graph=queried_graph
+        ).collect()
+        for queried_graph in (graph, None)
+    )
+
+    # Neighbouring facilities are counted, not only those of the commune
+    assert with_graph.select(
+        pl.sum_horizontal(pl.col("^count_.*$").sum())
+    ).item() > counts.select(pl.sum_horizontal(facilities).sum()).item() * len(radii_km)
+    assert_frame_equal(
+        sorted_rows(with_graph, ["code_commune"]),
+        sorted_rows(with_tree, ["code_commune"]),
+    )
+
+
+@pytest.mark.parametrize("metric", ["flat", "haversine"])
+def test_single_commune_graph(synthetic_sources, tmp_path, metric):
+    communes = pl.read_csv(synthetic_sources / "communes.csv.gz", infer_schema=False)
+    communes_path = tmp_path / "communes.csv.gz"
+    with gzip.open(communes_path, "wb") as communes_file:
+        communes.head(1).write_csv(communes_file)
+
+    graph = commune_graph(communes_path, tmp_path / "graph", metric)
+
+    assert len(graph.codes) == 1
+    assert graph.knn_indptr.tolist() == [0, 0]
+    assert len(graph.knn_indices) == len(graph.radius_indices) == 0
+    assert nearest_flagged(graph, np.array([True])).tolist() == [0.0]
+    assert np.isnan(nearest_flagged(graph, np.array([False]))).all()
+    assert radius_sum(graph, np.array([3.0]), graph.radius_km).tolist() == [3.0]
@@ -0,0 +1,42 @@
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from src.utils import NEAREST_FACILITY_METHODS, _nearest_distances_blocked
+
+
+def _points(count: int, seed: int) -> np.ndarray:
+    return np.random.default_rng(seed).uniform([41, -5], [51, 9], (count, 2))
+
+
+@pytest.mark.filterwarnings("ignore:All-NaN slice")
+@pytest.mark.parametrize("method", ["blocked", "brute_force"])
+def test_engines_match_kdtree(method):
+    communes, facilities = _points(500, seed=0), _points(700, seed=1)
+    communes[3] = np.nan
+
+    expected = NEAREST_FACILITY_METHODS["kdtree"](communes, facilities)
+    distances = NEAREST_FACILITY_METHODS[method](communes, facilities)
+
+    np.testing.assert_allclose(distances, expected, rtol=1e-6)
+
+
+def test_blocked_engine_stays_within_max_bytes():
+    communes, facilities = _points(3_000, seed=2), _points(5_000, seed=3)
+    max_bytes = 4 * 1024**2
+
+    tracemalloc.start()
+    try:
+        distances = _nearest_distances_blocked(communes, facilities, max_bytes)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    # Arrays over the points (float32 copies, running minima, distances)
+    # come on top of the tiles
+    point_bytes = 64 * (len(communes) + len(facilities))
+    assert peak <= max_bytes + point_bytes
+    np.testing.assert_allclose(
+        distances, NEAREST_FACILITY_METHODS["kdtree"](communes, facilities), rtol=1e-6
+    )
@@ -0,0 +1,238 @@
+import hashlib
+import threading
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from src import utils
+from src.utils import content_hash, download_file, load_manifest
+
+
+class RangeServer(ThreadingHTTPServer):
+    """Serves one file with ETag, Last-Modified and byte ranges."""
+
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), RangeHandler)
+        self.ranges: list[str | None] = []
+        self.head_headers: list[dict[str, str]] = []
+        self.truncate_after: int | None = None
+        self.send_etag = True
+        self.version = 0
+        self.set_content(b"")
+
+    def set_content(self, content: bytes) -> None:
+        self.content = content
+        self.etag = f'"{hashlib.sha256(content).hexdigest()[:16]}"'
+        self.version += 1
+        self.last_modified = formatdate(1_700_000_000 + self.version, usegmt=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/data.bin"
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    server: RangeServer
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def _headers(self, status: int, length: int, extra: dict | None = None) -> None:
+        self.send_response(status)
+        if self.server.send_etag:
+            self.send_header("ETag", self.server.etag)
+        self.send_header("Last-Modified", self.server.last_modified)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(length))
+        for name, value in (extra or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+    def do_HEAD(self) -> None:
+        self.server.head_headers.append(dict(self.headers))
+        if self.headers.get("If-None-Match") == self.server.etag or (
+            self.headers.get("If-Modified-Since") == self.server.last_modified
+        ):
+            self._headers(304, 0)
+        else:
+            self._headers(200, len(self.server.content))
+
+    def do_GET(self) -> None:
+        content = self.server.content
+        requested = self.headers.get("Range")
+        self.server.ranges.append(requested)
+        if_range = self.headers.get("If-Range")
+        if requested and if_range not in (
+            None,
+            self.server.etag,
+            self.server.last_modified,
+        ):
+            requested = None
+
+        if requested is None:
+            self._headers(200, len(content))
+            body = content
+        else:
+            start, _, end = requested.removeprefix("bytes=").partition("-")
+            start, end = int(start), int(end) if end else len(content) - 1
+            if start >= len(content):
+                self._headers(416, 0, {"Content-Range": f"bytes */{len(content)}"})
+                return
+            body = content[start : end + 1]
+            self._headers(
+                206,
+                len(body),
+                {"Content-Range": f"bytes {start}-{end}/{len(content)}"},
+            )
+
+        if self.server.truncate_after is not None:
+            # Interrupted transfer: the announced length is never reached
+            body, self.server.truncate_after = body[: self.server.truncate_after], None
+            self.wfile.write(body)
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    server = RangeServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    """Write interrupted transfers to the .part file up to the cut."""
+    monkeypatch.setattr(utils, "DOWNLOAD_CHUNK_SIZE", 100)
+
+
+def _content(size: int, seed: int) -> bytes:
+    return bytes((index * 31 + seed) % 251 for index in range(size))
+
+
+def test_segmented_download(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "MIN_SEGMENT_SIZE", 1_000)
+    server.set_content(_content(10_000, seed=1))
+    dest_path = tmp_path / "data.bin"
+
+    assert download_file(server.url, dest_path, segments=4, session=requests.Session())
+
+    assert dest_path.read_bytes() == server.content
+    assert len([requested for requested in server.ranges if requested]) == 4
+    entry = load_manifest(tmp_path)["data.bin"]
+    assert entry["sha256"] == hashlib.sha256(server.content).hexdigest()
+    assert entry["etag"] == server.etag
+
+
+def test_resume_interrupted_download(server, tmp_path, small_chunks):
+    server.set_content(_content(5_000, seed=2))
+    server.truncate_after = 1_200
+    dest_path = tmp_path / "data.bin"
+
+    with pytest.raises(requests.RequestException):
+        download_file(server.url, dest_path, segments=1, session=requests.Session())
+    assert not dest_path.exists()
+
+    assert download_file(server.url, dest_path, segments=1, session=requests.Session())
+    assert dest_path.read_bytes() == server.content
+    assert server.ranges[-1] == "bytes=1200-"
+    assert len(server.ranges) == 2
+
+
+def test_stale_part_restarts_after_content_change(server, tmp_path, small_chunks):
+    server.set_content(_content(5_000, seed=3))
+    server.truncate_after = 1_200
+    dest_path = tmp_path / "data.bin"
+    with pytest.raises(requests.RequestException):
+        download_file(server.url, dest_path, segments=1, session=requests.Session())
+
+    server.set_content(_content(5_000, seed=4))
+    assert (tmp_path / "data.bin.part").stat().st_size == 1_200
+
+    assert download_file(server.url, dest_path, segments=1, session=requests.Session())
+    assert dest_path.read_bytes() == server.content
+
+
+def test_foreign_part_is_not_resumed(server, tmp_path):
+    server.set_content(_content(5_000, seed=5))
+    dest_path = tmp_path / "data.bin"
+    # Left over by another tool or version, no validator recorded
+    (tmp_path / "data.bin.part").write_bytes(_content(400, seed=6))
+
+    assert download_file(server.url, dest_path, segments=1, session=requests.Session())
+    assert dest_path.read_bytes() == server.content
+
+
+def test_refresh_reports_up_to_date(server, tmp_path, capsys):
+    server.set_content(_content(3_000, seed=7))
+    dest_path = tmp_path / "data.bin"
+    session = requests.Session()
+    download_file(server.url, dest_path, session=session)
+    capsys.readouterr()
+
+    assert not download_file(server.url, dest_path, session=session, refresh=True)
+    assert "is up to date" in capsys.readouterr().out
+
+    server.set_content(_content(3_000, seed=8))
+    assert download_file(server.url, dest_path, session=session, refresh=True)
+    assert dest_path.read_bytes() == server.content
+
+
+def test_refresh_revalidates_with_last_modified(server, tmp_path, capsys):
+    server.send_etag = False
+    server.set_content(_content(3_000, seed=9))
+    dest_path = tmp_path / "data.bin"
+    session = requests.Session()
+    download_file(server.url, dest_path, session=session)
+    downloads = len(server.ranges)
+    capsys.readouterr()
+
+    assert not download_file(server.url, dest_path, session=session, refresh=True)
+    assert server.head_headers[-1]["If-Modified-Since"] == server.last_modified
+    assert "is up to date" in capsys.readouterr().out
+    assert len(server.ranges) == downloads
+
+    server.set_content(_content(3_000, seed=10))
+    assert download_file(server.url, dest_path, session=session, refresh=True)
+    assert dest_path.read_bytes() == server.content
+    assert load_manifest(tmp_path)["data.bin"]["last_modified"] == (
+        server.last_modified
+    )
+
+
+def test_existing_file_is_not_revalidated_without_refresh(server, tmp_path):
+    server.set_content(_content(3_000, seed=11))
+    dest_path = tmp_path / "data.bin"
+    session = requests.Session()
+    download_file(server.url, dest_path, session=session)
+    requests_made = len(server.head_headers) + len(server.ranges)
+
+    server.set_content(_content(3_000, seed=12))
+
+    assert not download_file(server.url, dest_path, session=session)
+    assert len(server.head_headers) + len(server.ranges) == requests_made
+
+
+def test_content_hash_reuses_the_manifest(tmp_path, monkeypatch):
+    hashed = []
+    file_sha256 = utils.file_sha256
+    monkeypatch.setattr(
+        utils, "file_sha256", lambda path: hashed.append(path) or file_sha256(path)
+    )
+    path = tmp_path / "source.csv"
+    path.write_bytes(_content(1_000, seed=13))
+
+    first = content_hash(path)
+    assert content_hash(path) == first
+    assert len(hashed) == 1
+
+    path.write_bytes(_content(1_001, seed=13))
+    assert content_hash(path) == hashlib.sha256(path.read_bytes()).hexdigest()
+    assert content_hash(path) != first
+    assert len(hashed) == 2
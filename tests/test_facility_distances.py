@@ -0,0 +1,47 @@
+from polars.testing import assert_frame_equal
+
+from tests.conftest import sorted_rows
+
+
+def _distance_events(output: str) -> dict[str, int]:
+    """Number of facility_distances stages computed and loaded from cache."""
+    lines = output.splitlines()
+    return {
+        event: lines.count(f"Stage facility_distances: {event}")
+        for event in ("computing...", "loaded from cache.")
+    }
+
+
+def test_changed_facility_type_only_computes_its_distances(run_pipeline, capsys):
+    run_pipeline(use_cache=True, facility_types=["B207", "D265", "A203"])
+    assert _distance_events(capsys.readouterr().out) == {
+        "computing...": 3,
+        "loaded from cache.": 0,
+    }
+
+    changed = run_pipeline(use_cache=True, facility_types=["B207", "D265", "A101"])
+
+    assert _distance_events(capsys.readouterr().out) == {
+        "computing...": 1,
+        "loaded from cache.": 2,
+    }
+    assert_frame_equal(
+        sorted_rows(changed, ["code_commune"]),
+        sorted_rows(
+            run_pipeline(facility_types=["B207", "D265", "A101"]), ["code_commune"]
+        ),
+    )
+
+
+def test_reordered_facility_types_load_from_cache(run_pipeline, capsys):
+    first = run_pipeline(use_cache=True, facility_types=["B207", "D265", "A203"])
+    capsys.readouterr()
+
+    reordered = run_pipeline(use_cache=True, facility_types=["A203", "B207", "D265"])
+
+    output = capsys.readouterr().out
+    assert _distance_events(output) == {"computing...": 0, "loaded from cache.": 3}
+    assert "Stage bpe_with_distances: loaded from cache." in output.splitlines()
+    assert_frame_equal(
+        sorted_rows(reordered, ["code_commune"]), sorted_rows(first, ["code_commune"])
+    )
@@ -0,0 +1,72 @@
+import math
+
+import numpy as np
+import polars as pl
+import pytest
+
+from src.grid import HEX_RADIUS_PER_KM, cell_centres, cell_ids, project
+
+# Axial offsets of the six neighbours of a hexagon
+HEX_NEIGHBOURS = [(1, 0), (-1, 0), (0, 1), (0, -1), (1, -1), (-1, 1)]
+
+
+def _hex_centre(q: np.ndarray, r: np.ndarray, radius: float) -> np.ndarray:
+    return np.column_stack([radius * math.sqrt(3) * (q + r / 2), radius * 1.5 * r])
+
+
+def _points(count: int = 100_000, extent_km: float = 50.0) -> pl.DataFrame:
+    rng = np.random.default_rng(0)
+    return pl.DataFrame(
+        {
+            "x": rng.uniform(-extent_km, extent_km, count),
+            "y": rng.uniform(-extent_km, extent_km, count),
+        }
+    )
+
+
+@pytest.mark.parametrize("size_km", [0.5, 2.0, 10.0])
+def test_hex_cells_hold_their_nearest_centre(size_km):
+    points = _points()
+    cells = points.select(*cell_ids("hex", size_km, pl.col("x"), pl.col("y")))
+    q, r = cells["cell_x"].to_numpy(), cells["cell_y"].to_numpy()
+    radius = size_km * HEX_RADIUS_PER_KM
+    xy = points.select("x", "y").to_numpy()
+
+    own = np.linalg.norm(xy - _hex_centre(q, r, radius), axis=1)
+    # A hexagon is the set of points closer to its centre than to any other
+    assert (own <= radius * (1 + 1e-9)).all()
+    for dq, dr in HEX_NEIGHBOURS:
+        neighbour = np.linalg.norm(xy - _hex_centre(q + dq, r + dr, radius), axis=1)
+        assert (own <= neighbour + 1e-9).all()
+
+
+def test_hex_cells_have_the_area_of_squares():
+    size_km, extent_km = 2.0, 50.0
+    points = _points(count=200_000, extent_km=extent_km)
+
+    cells = points.select(*cell_ids("hex", size_km, pl.col("x"), pl.col("y")))
+
+    # Most cells lie fully inside the sampled square and hold the points of
+    # one size_km² square, the partial cells along its border do not move
+    # the median
+    counts = cells.group_by("cell_x", "cell_y").len()
+    expected = len(points) * size_km**2 / (2 * extent_km) ** 2
+    assert counts["len"].median() == pytest.approx(expected, rel=0.1)
+
+
+@pytest.mark.parametrize("shape", ["square", "hex"])
+def test_cell_centres_fall_in_their_cell(shape):
+    cells = pl.DataFrame(
+        {
+            "resolution_km": [2.0] * 5,
+            "cell_x": [0, 3, -7, 120, 5],
+            "cell_y": [0, -2, 4, 2_500, 2_600],
+        },
+        schema_overrides={"cell_x": pl.Int32, "cell_y": pl.Int32},
+    )
+
+    centres = cells.with_columns(*cell_centres(shape))
+    x, y = project(pl.col("latitude"), pl.col("longitude"))
+    back = centres.select(*cell_ids(shape, 2.0, x, y))
+
+    assert back.equals(cells.select("cell_x", "cell_y"))
@@ -0,0 +1,50 @@
+import gzip
+from pathlib import Path
+
+import polars as pl
+import pytest
+from polars.testing import assert_frame_equal
+
+from tests.conftest import sorted_rows
+
+
+def _drop_sales(dvf_path: Path, year: int, code_departement: str) -> None:
+    """Rewrite the DVF source without every other lot of one partition."""
+    sales = pl.read_csv(dvf_path, infer_schema=False)
+    partition = pl.col("date_mutation").str.starts_with(str(year)) & (
+        pl.col("code_departement") == code_departement
+    )
+    kept = sales.filter(~partition | (pl.int_range(pl.len()) % 2 == 0))
+    assert len(kept) < len(sales)
+    with gzip.open(dvf_path, "wb") as dvf_file:
+        kept.write_csv(dvf_file)
+
+
+def test_incremental_matches_default(run_pipeline):
+    assert_frame_equal(
+        sorted_rows(run_pipeline(incremental=True), ["code_commune"]),
+        sorted_rows(run_pipeline(), ["code_commune"]),
+    )
+
+
+def test_incremental_update_matches_default(run_pipeline, data_dir, capsys):
+    run_pipeline(incremental=True)
+    _drop_sales(data_dir / "dvf.csv.gz", 2024, "01")
+    capsys.readouterr()
+
+    incremental = run_pipeline(incremental=True)
+
+    assert "recomputing 1 of" in capsys.readouterr().out
+    assert_frame_equal(
+        sorted_rows(incremental, ["code_commune"]),
+        sorted_rows(run_pipeline(), ["code_commune"]),
+    )
+
+
+def test_incremental_rejects_other_median_accuracy(run_pipeline, data_dir):
+    from src.incremental import scan_dvf_aggregates
+
+    run_pipeline(incremental=True, median_accuracy=0.01)
+
+    with pytest.raises(ValueError):
+        scan_dvf_aggregates(data_dir / "dvf_aggregates", median_accuracy=0.02)
@@ -0,0 +1,93 @@
+import numpy as np
+import polars as pl
+import pytest
+from polars.testing import assert_frame_equal
+
+from src import profiling, stages
+from src.utils import convert_dvf_to_parquet
+from tests.conftest import sorted_rows
+
+GRID_KEYS = ["year", "resolution_km", "cell_x", "cell_y"]
+
+
+@pytest.fixture
+def budget():
+    """Profile with a memory budget this many MB above the current memory."""
+
+    def enable(headroom_mb: float) -> None:
+        profiling.enable(max_rss_mb=profiling.current_rss() / 1024**2 + headroom_mb)
+
+    yield enable
+    profiling.disable()
+
+
+def test_low_memory_matches_default(run_pipeline):
+    assert_frame_equal(
+        sorted_rows(run_pipeline(low_memory=True), ["code_commune"]),
+        sorted_rows(run_pipeline(), ["code_commune"]),
+    )
+
+
+def test_low_memory_grid_matches_grid(run_pipeline):
+    grid = {"grid": "hex", "grid_km": [2.0, 10.0]}
+    assert_frame_equal(
+        sorted_rows(run_pipeline(low_memory=True, **grid), GRID_KEYS),
+        sorted_rows(run_pipeline(**grid), GRID_KEYS),
+    )
+
+
+@pytest.mark.parametrize("coordinates", [False, True])
+def test_budget_sized_parts_match_transactions(data_dir, coordinates):
+    dvf_parquet_dir = convert_dvf_to_parquet(
+        data_dir / "dvf.csv.gz", data_dir / "dvf_parquet"
+    )
+    # Room for about one year of a department per part
+    max_part_bytes = 40 * stages.TRANSACTION_BYTES_PER_LOT
+    keys = ["id_mutation"]
+
+    parts = stages.dvf_by_transaction_parts(
+        dvf_parquet_dir, coordinates=coordinates, max_part_bytes=max_part_bytes
+    )
+    by_department = stages.dvf_by_transaction_parts(
+        dvf_parquet_dir, coordinates=coordinates
+    )
+
+    assert len(parts) > len(by_department)
+    expected = stages.dvf_by_transaction(
+        stages.dvf_raw_sales(dvf_parquet_dir, coordinates=coordinates)
+    )
+    assert_frame_equal(
+        pl.concat(parts).collect().sort(keys),
+        expected.collect().sort(keys),
+    )
+
+
+def test_memory_budget_below_resident_memory(run_pipeline):
+    with pytest.raises(ValueError):
+        run_pipeline(low_memory=True, memory_budget_mb=1)
+
+
+def test_memory_budget_requires_low_memory(run_pipeline):
+    with pytest.raises(ValueError):
+        run_pipeline(memory_budget_mb=100_000)
+
+
+def test_memory_budget_names_the_crossing_span(budget):
+    budget(100)
+
+    with pytest.raises(MemoryError, match="^inner "):
+        with profiling.span("outer"):
+            with profiling.span("inner"):
+                allocated = np.ones(300 * 1024**2 // 8)
+    del allocated
+
+
+def test_memory_budget_skips_spans_starting_above_it(budget):
+    budget(100)
+
+    with pytest.raises(MemoryError, match="^outer "):
+        with profiling.span("outer"):
+            allocated = np.ones(300 * 1024**2 // 8)
+            with profiling.span("inner"):
+                pass
+    del allocated
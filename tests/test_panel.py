@@ -0,0 +1,48 @@
+import polars as pl
+from polars.testing import assert_frame_equal
+
+from tests.conftest import sorted_rows
+
+# Growth bounds keeping every commune, the two paths annualize differently
+ALL_GROWTH = {"min_growth_percent": -1e9, "max_growth_percent": 1e9}
+PRICE_COLUMNS = ["avg_prix_m2", "median_prix_m2", "count_sales"]
+
+
+def test_panel_growth_window_matches_default(run_pipeline):
+    default = sorted_rows(run_pipeline(years_between=3, **ALL_GROWTH), ["code_commune"])
+    panel = sorted_rows(run_pipeline(panel=True, **ALL_GROWTH), ["code_commune"])
+
+    window = panel.filter((pl.col("year_start") == 2021) & (pl.col("year_end") == 2024))
+
+    assert (window["years_between"] == 3).all()
+    assert_frame_equal(
+        window.select("code_commune", *PRICE_COLUMNS, "growth_prix_m2"),
+        default.select("code_commune", *PRICE_COLUMNS, "growth_prix_m2"),
+    )
+    # Facility columns are joined the same way
+    facility_columns = [
+        name for name in default.columns if name.startswith("distance_")
+    ]
+    assert facility_columns
+    assert_frame_equal(
+        window.select("code_commune", *facility_columns),
+        default.select("code_commune", *facility_columns),
+    )
+
+
+def test_panel_windows_cover_every_year_pair(run_pipeline):
+    panel = run_pipeline(panel=True, **ALL_GROWTH)
+
+    windows = panel.select("year_start", "year_end").unique()
+
+    assert (windows["year_end"] > windows["year_start"]).all()
+    assert len(windows) == 15  # pairs of the 6 synthetic years
+    assert (panel["years_between"] == panel["year_end"] - panel["year_start"]).all()
+
+
+def test_low_memory_panel_matches_panel(run_pipeline):
+    keys = ["code_commune", "year_start", "year_end"]
+    assert_frame_equal(
+        sorted_rows(run_pipeline(panel=True, low_memory=True), keys),
+        sorted_rows(run_pipeline(panel=True), keys),
+    )
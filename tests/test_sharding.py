@@ -0,0 +1,57 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from polars.testing import assert_frame_equal
+
+from src.sharding import SHARD_LOCK_TIMEOUT_SECONDS, _claim, _lock_path
+from tests.conftest import sorted_rows
+
+
+def _write_lock(set_dir, code_departement, host, pid):
+    lock_path = _lock_path(set_dir, code_departement)
+    lock_path.write_text(json.dumps({"host": host, "pid": pid, "claimed_at": 0}))
+    return lock_path
+
+
+def test_shards_match_default(run_pipeline):
+    assert_frame_equal(
+        sorted_rows(run_pipeline(workers=1), ["code_commune"]),
+        sorted_rows(run_pipeline(), ["code_commune"]),
+    )
+
+
+def test_shard_sketches_match_incremental_sketches(run_pipeline):
+    assert_frame_equal(
+        sorted_rows(run_pipeline(workers=1, median_accuracy=0.01), ["code_commune"]),
+        sorted_rows(
+            run_pipeline(incremental=True, median_accuracy=0.01), ["code_commune"]
+        ),
+    )
+
+
+def test_claim_leaves_live_owner(tmp_path):
+    _write_lock(tmp_path, "01", socket.gethostname(), os.getpid())
+
+    assert not _claim(tmp_path, "01")
+
+
+def test_claim_takes_over_dead_owner(tmp_path):
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    lock_path = _write_lock(tmp_path, "01", socket.gethostname(), dead.pid)
+
+    assert _claim(tmp_path, "01")
+    assert json.loads(lock_path.read_text())["pid"] == os.getpid()
+
+
+def test_claim_takes_over_expired_lock(tmp_path):
+    lock_path = _write_lock(tmp_path, "01", "another-host", 1)
+    expired = time.time() - SHARD_LOCK_TIMEOUT_SECONDS - 1
+    os.utime(lock_path, (expired, expired))
+
+    assert _claim(tmp_path, "01")
+    assert json.loads(lock_path.read_text())["host"] == socket.gethostname()
@@ -0,0 +1,82 @@
+import numpy as np
+import polars as pl
+import pytest
+from polars.testing import assert_frame_equal
+
+from src.sketches import SKETCH_KEYS, merge_sketches, price_sketches, sketch_stats
+
+QUANTILES = {"median_prix_m2": 0.5, "p10_prix_m2": 0.1, "p90_prix_m2": 0.9}
+
+
+def _prices(rows: int = 20_000, seed: int = 0) -> pl.LazyFrame:
+    rng = np.random.default_rng(seed)
+    return pl.LazyFrame(
+        {
+            "code_commune": rng.choice(["01001", "01002", "2A004", "75056"], rows),
+            "year": rng.choice([2021, 2024], rows).astype(np.int32),
+            # Small groups too, where interpolated ranks matter most
+            "prix_m2": np.concatenate(
+                [rng.lognormal(8, 0.6, rows - 3), [1500.0, 2500.0, 4000.0]]
+            ),
+        }
+    ).with_columns(
+        pl.when(pl.int_range(pl.len()) >= rows - 3)
+        .then(pl.lit("01999"))
+        .otherwise(pl.col("code_commune"))
+        .alias("code_commune")
+    )
+
+
+def _exact_stats(prices: pl.LazyFrame) -> pl.DataFrame:
+    return (
+        prices.group_by(SKETCH_KEYS)
+        .agg(
+            pl.col("prix_m2").mean().alias("avg_prix_m2"),
+            pl.len().cast(pl.UInt32).alias("count_sales"),
+            *(
+                pl.col("prix_m2").quantile(q, interpolation="linear").alias(name)
+                for name, q in QUANTILES.items()
+            ),
+        )
+        .sort(SKETCH_KEYS)
+        .collect()
+    )
+
+
+@pytest.mark.parametrize("relative_accuracy", [0.001, 0.01, 0.05])
+def test_sketch_quantiles_within_relative_accuracy(relative_accuracy):
+    prices = _prices()
+    exact = _exact_stats(prices)
+
+    estimated = (
+        sketch_stats(
+            price_sketches(prices, relative_accuracy), relative_accuracy, QUANTILES
+        )
+        .sort(SKETCH_KEYS)
+        .collect()
+    )
+
+    assert estimated.select(SKETCH_KEYS).equals(exact.select(SKETCH_KEYS))
+    assert (estimated["count_sales"] == exact["count_sales"]).all()
+    np.testing.assert_allclose(estimated["avg_prix_m2"], exact["avg_prix_m2"])
+    for name in QUANTILES:
+        relative_error = (estimated[name] - exact[name]).abs() / exact[name]
+        assert relative_error.max() <= relative_accuracy * (1 + 1e-9), name
+
+
+def test_merged_sketches_match_single_sketch():
+    prices = _prices()
+    halves = [
+        price_sketches(prices.filter(pl.int_range(pl.len()) % 2 == parity))
+        for parity in (0, 1)
+    ]
+
+    assert_frame_equal(
+        sketch_stats(merge_sketches(*halves)).sort(SKETCH_KEYS).collect(),
+        sketch_stats(price_sketches(prices)).sort(SKETCH_KEYS).collect(),
+    )
+
+
+def test_invalid_relative_accuracy():
+    with pytest.raises(ValueError):
+        price_sketches(_prices(), relative_accuracy=1.5)
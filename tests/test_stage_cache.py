@@ -0,0 +1,127 @@
+import os
+
+import polars as pl
+import pytest
+
+from src import profiling
+from src.stage_cache import StageCache
+
+
+@pytest.fixture
+def explain_calls(monkeypatch):
+    """Count the plans explained by LazyFrame.explain."""
+    calls = []
+    explain = pl.LazyFrame.explain
+
+    def counting_explain(self, *args, **kwargs):
+        calls.append(self)
+        return explain(self, *args, **kwargs)
+
+    monkeypatch.setattr(pl.LazyFrame, "explain", counting_explain)
+    return calls
+
+
+def test_lazy_stage_is_not_explained_without_profiling(tmp_path, explain_calls):
+    cache = StageCache(tmp_path)
+
+    frame, _ = cache.cached("stage", lambda: pl.LazyFrame({"a": [1, 2]}))
+
+    assert len(frame) == 2
+    assert not explain_calls
+
+
+def test_lazy_stage_is_explained_when_profiled(tmp_path, explain_calls):
+    cache = StageCache(tmp_path)
+    profiling.enable(functions=False)
+    try:
+        cache.cached("stage", lambda: pl.LazyFrame({"a": [1, 2]}))
+    finally:
+        records = profiling.disable()
+
+    (span,) = [record for record in records if record["kind"] == "span"]
+    assert len(explain_calls) == 1
+    assert span["plan"]
+
+
+class Computations:
+    """Stage compute function counting its calls."""
+
+    def __init__(self) -> None:
+        self.calls = 0
+
+    def __call__(self) -> pl.DataFrame:
+        self.calls += 1
+        return pl.DataFrame({"value": range(1_000)})
+
+
+def _entry_size(cache: StageCache) -> int:
+    (entry_path,) = cache.cache_dir.glob("*.parquet")
+    return entry_path.stat().st_size
+
+
+def test_stage_key_changes_with_inputs_params_upstream_and_code(tmp_path):
+    source = tmp_path / "source.csv"
+    source.write_text("a\n1\n")
+    cache, compute = StageCache(tmp_path / "cache"), Computations()
+
+    def run(**key) -> str:
+        return cache.cached("stage", compute, **{"inputs": [source], **key})[1]
+
+    key = run(params={"min_sales": 3})
+    assert run(params={"min_sales": 3}) == key
+    assert compute.calls == 1
+
+    assert run(params={"min_sales": 5}) != key
+    assert run(params={"min_sales": 3}, upstream=["other"]) != key
+    assert compute.calls == 3
+
+    source.write_text("a\n2\n")
+    assert run(params={"min_sales": 3}) != key
+    assert compute.calls == 4
+
+    cache.code_version = "edited"
+    run(params={"min_sales": 3})
+    assert compute.calls == 5
+
+
+def test_reuse_false_recomputes_but_stores(tmp_path):
+    compute = Computations()
+    StageCache(tmp_path, reuse=False).cached("stage", compute)
+    StageCache(tmp_path, reuse=False).cached("stage", compute)
+
+    assert compute.calls == 2
+    StageCache(tmp_path).cached("stage", compute)
+    assert compute.calls == 2
+
+
+def test_eviction_deletes_least_recently_used_entries(tmp_path):
+    compute = Computations()
+    StageCache(tmp_path).cached("first", compute)
+    entry_size = _entry_size(StageCache(tmp_path))
+    StageCache(tmp_path).cached("second", compute)
+    first, second = (next(tmp_path.glob(f"{stage}-*")) for stage in ("first", "second"))
+    os.utime(first, (1, 1))
+    os.utime(second, (2, 2))
+
+    # A later run reads the oldest entry, then stores a third one over the
+    # quota of two entries: the entry unused the longest goes
+    cache = StageCache(tmp_path, max_bytes=2 * entry_size + entry_size // 2)
+    cache.cached("first", compute)
+    cache.cached("third", compute)
+
+    assert compute.calls == 3
+    assert first.exists()
+    assert not second.exists()
+    assert len(list(tmp_path.glob("third-*"))) == 1
+
+
+def test_eviction_keeps_entries_of_the_current_run(tmp_path):
+    cache, compute = StageCache(tmp_path, max_bytes=1), Computations()
+
+    cache.cached("first", compute)
+    cache.cached("second", compute)
+
+    assert len(list(tmp_path.glob("*.parquet"))) == 2
+    # Unprotected in the next run, the quota then applies
+    StageCache(tmp_path, max_bytes=1).evict()
+    assert not list(tmp_path.glob("*.parquet"))